@@ -0,0 +1,274 @@
+import os
+import sys
+import gc
+import json
+import time
+import struct
+import platform
+import argparse
+import numpy as np
+import lasio
+import octree
+import colormaps
+import query
+from lascolors import CLS_MAP, COLOR_LIST
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+"""
+Benchmark the load / colorize / filter / upload pipeline on synthetic
+LAS files and compare with a saved baseline.
+
+    python bench.py --sizes 1M,10M,100M --out results.json
+    python bench.py --sizes 1M --baseline results.json
+
+Wall time, peak RSS of the process and the bytes allocated (traced by
+tracemalloc, which numpy reports to) are recorded for each stage.
+The GL stages (set_points, update_view and paintGL of the viewer) run
+when PyQt4 and a display are available, e.g. without a GPU:
+
+    LIBGL_ALWAYS_SOFTWARE=1 xvfb-run -a python bench.py
+
+Otherwise the centring and octree build of set_points are timed on
+their own. The exit code is 1 if a stage regressed against the baseline.
+"""
+
+SUFFIXES = {"K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9}
+# Points written per chunk of the synthetic files
+WRITE_CHUNK = 1 << 22
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in SUFFIXES:
+        return int(float(text[:-1]) * SUFFIXES[text[-1]])
+    return int(float(text))
+
+
+def write_synthetic(path, n, seed=42):
+    """
+    A point format 3 LAS file of n points on a 1000 x 1000 m area with
+    a few classes, 300 source ids, intensity and rgb.
+    """
+    fmt = 3
+    dtype = lasio.point_dtype(fmt, np.dtype(lasio.POINT_FORMATS[fmt]).itemsize)
+    scale, offset = 0.01, (500000.0, 6000000.0, 0.0)
+    rng = np.random.RandomState(seed)
+    header = bytearray(227)
+    header[:4] = b"LASF"
+    struct.pack_into("<BB", header, 24, 1, 2)
+    struct.pack_into("<HI", header, 94, 227, 227)
+    struct.pack_into("<BHI", header, 104, fmt, dtype.itemsize, n)
+    struct.pack_into("<3d", header, 131, scale, scale, scale)
+    struct.pack_into("<3d", header, 155, *offset)
+    struct.pack_into("<6d", header, 179, offset[0] + 1000, offset[0],
+                     offset[1] + 1000, offset[1], offset[2] + 100, offset[2])
+    with open(path, "wb") as f:
+        f.write(bytes(header))
+        for i0 in range(0, n, WRITE_CHUNK):
+            m = min(n, i0 + WRITE_CHUNK) - i0
+            records = np.zeros(m, dtype=dtype)
+            records["X"] = rng.randint(0, 100000, m)
+            records["Y"] = rng.randint(0, 100000, m)
+            # gentle terrain plus noise
+            records["Z"] = (2000 + 1000 * np.sin(records["X"] * 1e-4) +
+                            rng.randint(0, 1000, m))
+            records["intensity"] = rng.randint(0, 4096, m)
+            records["raw_classification"] = rng.choice([1, 2, 3, 5, 6, 9], m)
+            returns = rng.randint(1, 4, m)
+            records["flag_byte"] = (rng.randint(0, 8, m) % returns + 1) | (returns << 3)
+            records["pt_src_id"] = rng.randint(0, 300, m)
+            for color in ("red", "green", "blue"):
+                records[color] = rng.randint(0, 65536, m)
+            records.tofile(f)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on linux, bytes on mac
+    return rss / (1024.0 ** 2 if sys.platform == "darwin" else 1024.0)
+
+
+class Stages(object):
+    """Runs and records the stages of one benchmark."""
+
+    def __init__(self):
+        self.results = {}
+
+    def run(self, name, func, *args):
+        gc.collect()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        t = time.time()
+        result = func(*args)
+        wall = time.time() - t
+        allocated = None
+        if tracemalloc is not None:
+            allocated = tracemalloc.get_traced_memory()[1] / 1024.0 ** 2
+            tracemalloc.stop()
+        self.results[name] = {"wall": wall, "peak_rss_mb": peak_rss_mb(),
+                              "allocated_mb": allocated}
+        print("  %-22s %8.3fs  peak rss: %8.1f MB  allocated: %8.1f MB" %
+              (name, wall, self.results[name]["peak_rss_mb"] or 0,
+               allocated or 0))
+        return result
+
+
+def make_viewer():
+    """A shown viewer with a current GL context - or None."""
+    try:
+        from PyQt4 import QtGui
+        import qt_glviewer
+    except ImportError as e:
+        print("No viewer stages: %s" % e)
+        return None
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+    viewer = qt_glviewer.PointcloudViewerWidget(None)
+    viewer.resize(800, 800)
+    viewer.show()
+    app.processEvents()
+    viewer.app = app
+    return viewer
+
+
+def paint(viewer, frames):
+    from OpenGL import GL as gl
+    for i in range(frames):
+        viewer.updateGL()
+    gl.glFinish()
+
+
+def colormap_stages(stages, data):
+    def coloring(build, values, *args):
+        return build(values, *args).colors(z=values)
+    stages.run("colormap_class", coloring, colormaps.class_coloring,
+               data["raw_classification"], CLS_MAP)
+    stages.run("colormap_source_id", coloring, colormaps.discrete_coloring,
+               data["pt_src_id"], COLOR_LIST)
+    stages.run("colormap_intensity", coloring, colormaps.linear_coloring,
+               data["intensity"], (0.1,) * 3, (0.9,) * 3)
+    stages.run("colormap_z", coloring, colormaps.linear_coloring,
+               data["z"], (0.1,) * 3, (0.9,) * 3)
+
+
+def benchmark(path, viewer=None, frames=10):
+    stages = Stages()
+    header = stages.run("open", lasio.LasHeader, path)
+    try:
+        import laspy.file
+    except ImportError:
+        pass
+    else:
+        def laspy_xyz():
+            f = laspy.file.File(path)
+            xyz = f.x, f.y, f.z
+            f.close()
+            return xyz
+        stages.run("laspy_xyz", laspy_xyz)
+    names = ("x", "y", "z", "raw_classification", "pt_src_id", "intensity")
+    columns = stages.run("decode", lasio.read_dimensions, path, names, header)
+    data = dict(zip(names, columns))
+    x, y, z = data.pop("x"), data.pop("y"), data.pop("z")
+    if viewer is not None:
+        stages.run("set_points", viewer.set_points, x, y, z)
+        data["z"] = viewer.z
+    else:
+        def centre(x, y, z):
+            c = [v.mean() for v in (x, y, z)]
+            return [(v - m).astype(np.float32) for v, m in zip((x, y, z), c)]
+        xyz = stages.run("centre", centre, x, y, z)
+        stages.run("octree", octree.Octree, *xyz)
+        data["z"] = xyz[2]
+        del xyz
+    del x, y, z
+    colormap_stages(stages, data)
+    rq = query.RangeQuery(header.point_count, lambda dim: data[dim])
+    stages.run("filter_first", rq.query, {"intensity": [1000, 3000]})
+    stages.run("filter_refine", rq.query, {"intensity": [1200, 2800]})
+    if viewer is not None:
+        coloring = colormaps.class_coloring(data["raw_classification"], CLS_MAP)
+        viewer.set_coloring("raw_classification", coloring)
+
+        def update_view():
+            viewer.update_view()
+            paint(viewer, 1)  # the VBOs are uploaded on first use
+        stages.run("update_view", update_view)
+        stages.run("paint_%d_frames" % frames, paint, viewer, frames)
+    return stages.results
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """Print the change of each stage and return the regressions."""
+    regressions = []
+    for size, stages in sorted(results["sizes"].items()):
+        base_stages = baseline["sizes"].get(size)
+        if base_stages is None:
+            continue
+        for name, result in sorted(stages.items()):
+            base = base_stages.get(name)
+            if base is None or base["wall"] <= 0:
+                continue
+            ratio = result["wall"] / base["wall"]
+            flag = ""
+            # ignore noise on very short stages
+            if ratio > 1 + tolerance and result["wall"] - base["wall"] > min_delta:
+                flag = "  REGRESSION"
+                regressions.append((size, name))
+            print("%10s %-22s %8.3fs -> %8.3fs (%+.0f%%)%s" % (
+                size, name, base["wall"], result["wall"], (ratio - 1) * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="lasviewer pipeline benchmark")
+    parser.add_argument("--sizes", default="1M,10M,100M",
+                        help="comma separated point counts (default 1M,10M,100M)")
+    parser.add_argument("--data", default=os.path.join(os.getcwd(), "bench_data"),
+                        help="directory for the synthetic LAS files")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", help="results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slow down (default 0.2 = 20%%)")
+    parser.add_argument("--min-delta", type=float, default=0.05,
+                        help="slow downs of fewer seconds are noise (default 0.05)")
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--no-gl", action="store_true",
+                        help="skip the viewer stages")
+    args = parser.parse_args()
+    if not os.path.isdir(args.data):
+        os.makedirs(args.data)
+    viewer = None if args.no_gl else make_viewer()
+    results = {"machine": {"platform": platform.platform(),
+                           "python": platform.python_version(),
+                           "numpy": np.__version__,
+                           "threads": colormaps.THREADS},
+               "sizes": {}}
+    for text in args.sizes.split(","):
+        n = parse_size(text)
+        path = os.path.join(args.data, "synthetic_%d.las" % n)
+        if not os.path.exists(path):
+            print("Writing %s..." % path)
+            write_synthetic(path, n)
+        print("%d points:" % n)
+        results["sizes"][str(n)] = benchmark(path, viewer, args.frames)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to %s" % args.out)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance, args.min_delta):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
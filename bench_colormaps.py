@@ -0,0 +1,75 @@
+import sys
+import time
+import numpy as np
+import colormaps
+from lascolors import CLS_MAP, COLOR_LIST
+
+"""
+Benchmark the lookup table colormaps against the original
+mask-per-value implementations on synthetic data.
+Usage: python bench_colormaps.py [n_points] (default 100M).
+"""
+
+# The original implementations
+def class_to_color(cls, cls_map):
+    colors = np.ones((cls.shape[0], 3), dtype=np.float32) * 0.5
+    for c in cls_map:
+        colors[cls == c] = cls_map[c]
+    return colors
+
+
+def discrete_dimension_to_color(all_vals, color_list):
+    colors = np.zeros((all_vals.shape[0], 3), dtype=np.float32)
+    vals = np.unique(all_vals)
+    for i, val in enumerate(vals):
+        M = (all_vals == val)
+        colors[M] = color_list[i % len(color_list)]
+    return colors
+
+
+def linear_colormap(all_vals, color_low, color_high):
+    c1 = np.ones((all_vals.shape[0], 3), dtype=np.float32) * color_low
+    c2 = np.ones((all_vals.shape[0], 3), dtype=np.float32) * color_high
+    m1 = np.percentile(all_vals, 5)
+    m2 = np.percentile(all_vals, 95)
+    dv = ((all_vals - m1) / (m2 - m1)).reshape((all_vals.shape[0], 1))
+    dv[dv < 0] = 0
+    dv[dv > 1] = 1
+    colors = c1 + c2 * dv
+    return colors
+
+
+def timed(func, *args):
+    t = time.time()
+    result = func(*args)
+    return time.time() - t, result
+
+
+def main(n):
+    rng = np.random.RandomState(42)
+    data = {
+        "raw_classification": rng.randint(0, 20, n).astype(np.uint8),
+        "pt_src_id": rng.randint(0, 300, n).astype(np.uint16),
+        "intensity": rng.randint(0, 4096, n).astype(np.uint16),
+        "z": rng.normal(100, 20, n)}
+    cases = (("class_to_color", "raw_classification",
+              class_to_color, colormaps.class_to_color, (CLS_MAP,)),
+             ("discrete (300 source ids)", "pt_src_id",
+              discrete_dimension_to_color,
+              colormaps.discrete_dimension_to_color, (COLOR_LIST,)),
+             ("linear (intensity)", "intensity", linear_colormap,
+              colormaps.linear_colormap, ((0.1,) * 3, (0.9,) * 3)),
+             ("linear (z)", "z", linear_colormap,
+              colormaps.linear_colormap, ((0.1,) * 3, (0.9,) * 3)))
+    print("%d points, %d threads" % (n, colormaps.THREADS))
+    for name, dim, old, new, args in cases:
+        t_old, c_old = timed(old, data[dim], *args)
+        t_new, c_new = timed(new, data[dim], *args)
+        err = np.abs(c_old - c_new).max()
+        print("%-28s old: %8.2fs  new: %8.2fs  speedup: %6.1fx  max diff: %.3f" %
+              (name, t_old, t_new, t_old / t_new, err))
+        del c_old, c_new
+
+
+if __name__ == "__main__":
+    main(int(float(sys.argv[1])) if len(sys.argv) > 1 else 100000000)
@@ -0,0 +1,52 @@
+import math
+import numpy as np
+
+"""
+Camera presets and the matrices set up by gluPerspective and gluLookAt,
+in numpy - shared by the viewer and the headless thumbnail renderer.
+Not LAS specific.
+"""
+
+# Vertical field of view (degrees)
+FOV = 90.0
+PRESETS = ("top", "oblique", "side")
+
+
+def preset(name, r):
+    """
+    Location, focus and up vector of a camera preset for a cloud of
+    radius r centred on the origin. "top" is the initial view of the
+    viewer.
+    """
+    s = math.sqrt(0.5)
+    if name == "top":
+        location, up = (0.0, 0.0, 1.5 * r), (0.0, 1.0, 0.0)
+    elif name == "oblique":
+        location, up = (0.0, -1.2 * r, 1.2 * r), (0.0, s, s)
+    elif name == "side":
+        location, up = (0.0, -2.0 * r, 0.0), (0.0, 0.0, 1.0)
+    else:
+        raise ValueError("Unknown camera preset %s" % name)
+    return np.array(location), np.zeros(3), np.array(up)
+
+
+def perspective(fov, aspect, near, far):
+    """The matrix of gluPerspective."""
+    f = 1.0 / math.tan(math.radians(fov) / 2)
+    return np.array([[f / aspect, 0, 0, 0],
+                     [0, f, 0, 0],
+                     [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+                     [0, 0, -1, 0]])
+
+
+def look_at(location, focus, up):
+    """The matrix of gluLookAt."""
+    forward = np.asarray(focus, dtype=np.float64) - location
+    forward /= np.sqrt(forward.dot(forward))
+    side = np.cross(forward, up)
+    side /= np.sqrt(side.dot(side))
+    true_up = np.cross(side, forward)
+    M = np.eye(4)
+    M[0, :3], M[1, :3], M[2, :3] = side, true_up, -forward
+    M[:3, 3] = -M[:3, :3].dot(location)
+    return M
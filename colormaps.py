@@ -0,0 +1,322 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+"""
+Lookup table based colormaps.
+Every colormap builds a small table of colors and evaluates it in
+chunks, in parallel threads, writing straight into a preallocated
+n x 3 float32 output. numpy releases the GIL while indexing and doing
+arithmetic on the chunks, so the threads do run concurrently.
+"""
+
+CHUNK_SIZE = 1 << 20
+THREADS = multiprocessing.cpu_count()
+# Number of bins used when estimating percentiles
+HIST_BINS = 4096
+
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(THREADS)
+    return _pool
+
+
+def chunked(n, func, chunk_size=CHUNK_SIZE):
+    """
+    Call func(i0, i1) for consecutive ranges of n items
+    in a thread pool and return the list of results.
+    """
+    ranges = [(i0, min(n, i0 + chunk_size)) for i0 in range(0, n, chunk_size)]
+    if len(ranges) <= 1:
+        return [func(i0, i1) for i0, i1 in ranges]
+    return _get_pool().map(lambda r: func(*r), ranges)
+
+
+def _output(n, out):
+    if out is None:
+        out = np.empty((n, 3), dtype=np.float32)
+    return out
+
+
+def value_range(values):
+    mins_maxs = chunked(values.shape[0], lambda i0, i1: (
+        values[i0:i1].min(), values[i0:i1].max()))
+    return (min(m[0] for m in mins_maxs), max(m[1] for m in mins_maxs))
+
+
+def value_counts(values):
+    """
+    Counts of each value for non-negative integer values of limited
+    range (e.g. uint8 / uint16 dimensions) - or None.
+    """
+    if values.dtype.kind not in "ui" or values.shape[0] == 0:
+        return None
+    lo, hi = value_range(values)
+    if lo < 0 or hi >= (1 << 16):
+        return None
+    counts = chunked(values.shape[0], lambda i0, i1: np.bincount(
+        values[i0:i1], minlength=int(hi) + 1))
+    return np.sum(counts, axis=0)
+
+
+def percentiles(values, qs, bins=HIST_BINS):
+    """
+    Percentiles (0-100) from a histogram instead of a full sort.
+    Exact for integer values of limited range, otherwise accurate to
+    within (max - min) / bins.
+    """
+    n = values.shape[0]
+    counts = value_counts(values)
+    if counts is not None:
+        edges = np.arange(counts.shape[0] + 1, dtype=np.float64)
+        exact = True
+    else:
+        lo, hi = value_range(values)
+        if lo == hi:
+            return [float(lo)] * len(qs)
+        edges = np.linspace(float(lo), float(hi), bins + 1)
+        counts = np.sum(chunked(n, lambda i0, i1: np.histogram(
+            values[i0:i1], bins=bins, range=(float(lo), float(hi)))[0]), axis=0)
+        exact = False
+    return histogram_percentiles(counts, edges, exact, qs)
+
+
+def histogram_percentiles(counts, edges, exact, qs):
+    """
+    Percentiles (0-100) of the values counted in the bins between edges.
+    If exact, each bin holds a single value: edges[i].
+    """
+    n = int(counts.sum())
+    cum = np.cumsum(counts)
+    result = []
+    for q in qs:
+        rank = q / 100.0 * (n - 1)
+        i = min(int(np.searchsorted(cum, rank, side="right")), counts.shape[0] - 1)
+        if exact:
+            result.append(edges[i])
+        else:
+            # interpolate inside the bin
+            below = cum[i] - counts[i]
+            frac = (rank - below) / counts[i] if counts[i] > 0 else 0.0
+            result.append(edges[i] + frac * (edges[i + 1] - edges[i]))
+    return result
+
+
+def apply_lut(indices, lut, out=None):
+    """out[i] = lut[indices[i]], evaluated in chunks."""
+    out = _output(indices.shape[0], out)
+
+    def work(i0, i1):
+        np.take(lut, indices[i0:i1], axis=0, out=out[i0:i1])
+    chunked(indices.shape[0], work)
+    return out
+
+
+class ScalarColoring(object):
+    """
+    A colormap as a per point scalar (or rgb triple) plus a few
+    parameters, so that it can be evaluated on the GPU as well as here.
+
+    kind "lut": color = lut[values] (lut[values % len(lut)] if cycle)
+    kind "ramp": color = color_low + color_high * t, with
+        t = (values - vmin) * vscale clipped to [0, 1]
+    kind "rgb": color = (values - vmin) * vscale clipped to [0, 1],
+        values being an n x 3 array
+    If use_z is set, values is None and the z coordinate of the points
+    is used instead.
+    """
+
+    def __init__(self, kind, values=None, lut=None, cycle=False, vmin=0.0,
+                 vscale=1.0, color_low=(0, 0, 0), color_high=(1, 1, 1),
+                 use_z=False):
+        self.kind = kind
+        self.values = values
+        self.lut = None if lut is None else np.asarray(lut, dtype=np.float32)
+        self.cycle = cycle
+        self.vmin = float(vmin)
+        self.vscale = float(vscale)
+        self.color_low = tuple(float(c) for c in color_low)
+        self.color_high = tuple(float(c) for c in color_high)
+        self.use_z = use_z
+
+    def params(self):
+        """Everything but the arrays, e.g. for storing as json."""
+        return {"kind": self.kind, "cycle": self.cycle, "vmin": self.vmin,
+                "vscale": self.vscale, "color_low": self.color_low,
+                "color_high": self.color_high, "use_z": self.use_z}
+
+    def colors(self, z=None, out=None):
+        """Evaluate to an n x 3 float32 array."""
+        values = z if self.use_z else self.values
+        if self.kind == "lut":
+            if self.cycle:
+                size = self.lut.shape[0]
+                out = _output(values.shape[0], out)
+
+                def work(i0, i1):
+                    np.take(self.lut, values[i0:i1] % size, axis=0, out=out[i0:i1])
+                chunked(values.shape[0], work)
+                return out
+            return apply_lut(values, self.lut, out)
+        out = _output(values.shape[0], out)
+        low = np.asarray(self.color_low, dtype=np.float32)
+        high = np.asarray(self.color_high, dtype=np.float32)
+
+        def work(i0, i1):
+            o = out[i0:i1]
+            if self.kind == "rgb":
+                o[:] = values[i0:i1]
+                o -= self.vmin
+                o *= self.vscale
+                np.clip(o, 0, 1, out=o)
+            else:
+                dv = (values[i0:i1] - self.vmin).astype(np.float32)
+                dv *= self.vscale
+                np.clip(dv, 0, 1, out=dv)
+                np.multiply(dv[:, None], high, out=o)
+                o += low
+        chunked(values.shape[0], work)
+        return out
+
+
+def _lut_indices(values):
+    """
+    Small non-negative integer indices for values - the values themselves
+    if possible, else their rank - together with the sorted unique values
+    (None when the values are used directly).
+    """
+    if values.dtype.kind in "ui" and values.shape[0] > 0:
+        lo, hi = value_range(values)
+        if lo >= 0 and hi < (1 << 16):
+            return values, None
+    vals, inverse = np.unique(values, return_inverse=True)
+    inverse = inverse.ravel()
+    dtype = np.uint16 if vals.shape[0] < (1 << 16) else np.uint32
+    return inverse.astype(dtype), vals
+
+
+def class_coloring(cls, cls_map, default=0.5, hist=None):
+    """hist: a stats.Histogram of cls, if known - saves a pass."""
+    if hist is not None and hist.value_counts() is not None:
+        indices, vals = cls, None
+    else:
+        indices, vals = _lut_indices(cls)
+    if vals is None:
+        if hist is not None:
+            hi = hist.hi
+        else:
+            hi = value_range(cls)[1] if cls.shape[0] > 0 else 0
+        lut = np.full((max(int(hi), max(cls_map)) + 1, 3), default,
+                      dtype=np.float32)
+        for c in cls_map:
+            lut[c] = cls_map[c]
+    else:
+        lut = np.array([cls_map.get(v, (default,) * 3) for v in vals],
+                       dtype=np.float32).reshape((-1, 3))
+    return ScalarColoring("lut", indices, lut)
+
+
+def discrete_coloring(all_vals, color_list, hist=None):
+    colors = np.asarray(color_list, dtype=np.float32)
+    counts = value_counts(all_vals) if hist is None else hist.value_counts()
+    if counts is not None and counts.shape[0] <= 4096:
+        # rank of each present value, no sort needed
+        rank = np.cumsum(counts > 0) - 1
+        return ScalarColoring("lut", all_vals, colors[rank % colors.shape[0]])
+    if counts is not None:
+        rank = (np.cumsum(counts > 0) - 1).astype(np.uint16)
+        indices = np.empty(all_vals.shape[0], dtype=np.uint16)
+
+        def work(i0, i1):
+            np.take(rank, all_vals[i0:i1], out=indices[i0:i1])
+        chunked(all_vals.shape[0], work)
+    else:
+        indices = _lut_indices(all_vals)[0]
+    return ScalarColoring("lut", indices, colors, cycle=True)
+
+
+def linear_coloring(all_vals, color_low, color_high, low=5, high=95,
+                    use_z=False, hist=None):
+    """
+    Float values are stored relative to the low percentile,
+    so that they keep their precision as float32.
+    If use_z is set, all_vals should be the z coordinates as drawn - and
+    are not stored.
+    The percentiles are taken from hist (a stats.Histogram), if given.
+    """
+    if all_vals.shape[0] == 0:
+        return ScalarColoring("ramp", all_vals, color_low=color_low,
+                              color_high=color_high)
+    if hist is not None:
+        m1, m2 = hist.percentiles((low, high))
+    else:
+        m1, m2 = percentiles(all_vals, (low, high))
+    scale = 1.0 / (m2 - m1) if m2 > m1 else 0.0
+    if use_z:
+        return ScalarColoring("ramp", None, vmin=m1, vscale=scale,
+                              color_low=color_low, color_high=color_high,
+                              use_z=True)
+    if all_vals.dtype.kind == "f":
+        values = np.empty(all_vals.shape[0], dtype=np.float32)
+
+        def work(i0, i1):
+            np.subtract(all_vals[i0:i1], m1, out=values[i0:i1], casting="unsafe")
+        chunked(all_vals.shape[0], work)
+        m1 = 0.0
+    else:
+        values = all_vals
+    return ScalarColoring("ramp", values, vmin=m1, vscale=scale,
+                          color_low=color_low, color_high=color_high)
+
+
+def colors_to_uint8(colors, vmin=0.0, vscale=1.0):
+    """(colors - vmin) * vscale clipped to [0, 1] as n x 3 uint8 0-255."""
+    out = np.empty(colors.shape, dtype=np.uint8)
+
+    def work(i0, i1):
+        c = colors[i0:i1].astype(np.float32)
+        c -= vmin
+        c *= vscale * 255.0
+        np.clip(c, 0, 255, out=c)
+        c += 0.5
+        out[i0:i1] = c
+    chunked(colors.shape[0], work)
+    return out
+
+
+def rgb_coloring(rgb, hist=None):
+    """
+    Stretch the n x 3 rgb values between their min and max (those of
+    hist, if given). The result is stored as uint8, which is all the
+    screen can show.
+    """
+    lo, hi = value_range(rgb) if hist is None else (hist.lo, hist.hi)
+    scale = 1.0 / (float(hi) - float(lo)) if hi > lo else 0.0
+    return ScalarColoring("rgb", colors_to_uint8(rgb, lo, scale),
+                          vscale=1 / 255.0)
+
+
+def class_to_color(cls, cls_map, out=None, default=0.5):
+    """Color by class - classes not in cls_map get a gray color."""
+    return class_coloring(cls, cls_map, default).colors(out=out)
+
+
+def discrete_dimension_to_color(all_vals, color_list, out=None):
+    """
+    Cycle through color_list in the order of the sorted
+    unique values of the dimension.
+    """
+    return discrete_coloring(all_vals, color_list).colors(out=out)
+
+
+def linear_colormap(all_vals, color_low, color_high, out=None, low=5, high=95):
+    """
+    color_low + color_high * t, with t going from 0 to 1 between
+    the low and high percentiles of the values.
+    """
+    return linear_coloring(all_vals, color_low, color_high,
+                           low, high).colors(out=out)
@@ -0,0 +1,339 @@
+import struct
+import threading
+import heapq
+from collections import OrderedDict
+import numpy as np
+import lasio
+import octree
+import tiles
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:  # python 2
+    from urllib2 import Request, urlopen
+
+try:
+    import lazrs
+except ImportError:
+    lazrs = None
+
+"""
+Cloud optimized point clouds (COPC): LAZ files with the points grouped
+in the nodes of an octree, plus a hierarchy telling where the data of
+each node is. Only the header, the VLRs and the root hierarchy page are
+read when opening - from a local file or over HTTP with byte range
+requests. Nodes (and further hierarchy pages) are fetched as the view
+needs them, see CopcSet. Decoding LAZ needs lazrs (pip install lazrs).
+"""
+
+# Fixed sizes of the format
+VLR_HEADER_SIZE = 54
+INFO_SIZE = 160
+ENTRY_SIZE = 32
+# Memory for decoded nodes, kept for when they are wanted again
+CACHE_BUDGET = 1024 ** 3
+
+
+def is_copc(location):
+    name = location.lower()
+    return name.startswith(("http://", "https://")) or name.endswith(".copc.laz")
+
+
+class FileSource(object):
+    """Byte ranges of a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        self.lock = threading.Lock()
+
+    def read(self, offset, size):
+        with self.lock:
+            self.f.seek(offset)
+            return self.f.read(size)
+
+    def close(self):
+        self.f.close()
+
+
+class HttpSource(object):
+    """Byte ranges of a file on an HTTP server (with Range requests)."""
+
+    def __init__(self, url):
+        self.path = url
+
+    def read(self, offset, size):
+        request = Request(self.path, headers={
+            "Range": "bytes=%d-%d" % (offset, offset + size - 1)})
+        response = urlopen(request)
+        try:
+            data = response.read()
+            if response.getcode() == 200:
+                # the server ignored the range and sent everything
+                data = data[offset:offset + size]
+        finally:
+            response.close()
+        if len(data) != size:
+            raise IOError("Got %d of %d bytes at %d from %s" %
+                          (len(data), size, offset, self.path))
+        return data
+
+    def close(self):
+        pass
+
+
+def open_source(location):
+    if location.lower().startswith(("http://", "https://")):
+        return HttpSource(location)
+    return FileSource(location)
+
+
+class CopcNode(object):
+    """A node of the octree - loaded like a tiles.Tile."""
+
+    def __init__(self, key, offset, byte_size, point_count):
+        self.key = key  # level, x, y, z
+        self.offset = offset
+        self.byte_size = byte_size
+        self.point_count = point_count
+        self.nbytes = point_count * tiles.BYTES_PER_POINT
+        self.data = None
+        self.loading = False
+        self.failed = False
+
+    @property
+    def path(self):
+        return "node %d-%d-%d-%d" % self.key
+
+
+class CopcFile(object):
+    """The header, VLRs and hierarchy of a COPC file."""
+
+    def __init__(self, location):
+        self.source = open_source(location)
+        self.path = location
+        self.header = lasio.LasHeader(location, self.source.read(0, 375))
+        vlrs = self.source.read(self.header.header_size,
+                                self.header.data_offset - self.header.header_size)
+        self.info = None
+        self.laszip_vlr = None
+        pos = 0
+        count = struct.unpack_from("<I", self.source.read(100, 4))[0]
+        for i in range(count):
+            user_id = vlrs[pos + 2:pos + 18].split(b"\0")[0]
+            record_id, length = struct.unpack_from("<HH", vlrs, pos + 18)
+            data = vlrs[pos + VLR_HEADER_SIZE:pos + VLR_HEADER_SIZE + length]
+            if user_id == b"copc" and record_id == 1:
+                self.info = data
+            elif user_id == b"laszip encoded" and record_id == 22204:
+                self.laszip_vlr = data
+            pos += VLR_HEADER_SIZE + length
+        if self.info is None or len(self.info) < INFO_SIZE:
+            raise ValueError("%s is not a COPC file" % location)
+        (cx, cy, cz, self.halfsize, self.spacing, self.root_offset,
+         self.root_size) = struct.unpack_from("<5dQQ", self.info)
+        self.center = np.array((cx, cy, cz))
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_budget = CACHE_BUDGET
+        self.lock = threading.Lock()
+
+    def read_page(self, offset, size):
+        """
+        Entries of a hierarchy page: the nodes with data and the
+        pages below it as {key: (offset, size)}.
+        """
+        raw = self.source.read(offset, size)
+        entries = np.frombuffer(raw, dtype=np.dtype([
+            ("key", "<i4", (4,)), ("offset", "<u8"), ("byte_size", "<i4"),
+            ("point_count", "<i4")]))
+        nodes, pages = [], {}
+        for entry in entries:
+            key = tuple(int(v) for v in entry["key"])
+            if entry["point_count"] < 0:
+                pages[key] = (int(entry["offset"]), int(entry["byte_size"]))
+            else:
+                nodes.append(CopcNode(key, int(entry["offset"]),
+                                      int(entry["byte_size"]),
+                                      int(entry["point_count"])))
+        return nodes, pages
+
+    def box(self, key):
+        """Minimum and maximum corner of the cube of a node."""
+        level, x, y, z = key
+        size = 2 * self.halfsize / 2 ** level
+        lo = self.center - self.halfsize + np.array((x, y, z)) * size
+        return lo, lo + size
+
+    def read_points(self, node):
+        """The point records of a node - from the cache, if there."""
+        with self.lock:
+            records = self.cache.pop(node.key, None)
+            if records is not None:
+                self.cache[node.key] = records  # most recently used last
+                return records
+        raw = self.source.read(node.offset, node.byte_size)
+        records = self.decode(raw, node.point_count)
+        with self.lock:
+            self.cache[node.key] = records
+            self.cache_bytes += records.nbytes
+            while self.cache_bytes > self.cache_budget and len(self.cache) > 1:
+                evicted = self.cache.popitem(last=False)[1]
+                self.cache_bytes -= evicted.nbytes
+        return records
+
+    def decode(self, raw, point_count):
+        dtype = self.header.dtype
+        if not self.header.compressed:
+            return np.frombuffer(raw, dtype=dtype, count=point_count)
+        if lazrs is None:
+            raise ImportError("Decoding COPC (LAZ) needs lazrs: pip install lazrs")
+        out = bytearray(point_count * dtype.itemsize)
+        lazrs.decompress_points_with_chunk_table(
+            raw, self.laszip_vlr, out, [(point_count, len(raw))])
+        return np.frombuffer(out, dtype=dtype)
+
+    def close(self):
+        self.source.close()
+
+
+class CopcSet(tiles.TileSet):
+    """
+    The nodes of a COPC file as a tiles.TileSet: update picks the
+    visible nodes by screen space error (like octree.Octree.select),
+    coarse to fine within the memory limit, and the loader thread loads
+    them - and fetches the hierarchy pages below the nodes wanted.
+    load_tile(node) gets a CopcNode; see CopcFile.read_points.
+    """
+
+    def __init__(self, location, load_tile, release, on_loaded=None,
+                 memory_limit=4 * 1024 ** 3, on_error=None):
+        self.copc = CopcFile(location)
+        header = self.copc.header
+        self.min = header.min
+        self.max = header.max
+        self.origin = (self.min + self.max) * 0.5
+        self.point_count = header.point_count
+        self.tiles = []
+        self.index = {}
+        self.pages = {}
+        self.page_queue = []
+        self.box_min = np.zeros((0, 3))
+        self.box_max = np.zeros((0, 3))
+        self._add(*self.copc.read_page(self.copc.root_offset, self.copc.root_size))
+        self._start(load_tile, release, on_loaded, memory_limit, on_error)
+
+    def _add(self, nodes, pages):
+        """Add the entries of a hierarchy page - holding self.cond, if started."""
+        boxes = [self.copc.box(node.key) for node in nodes]
+        lo = np.array([b[0] for b in boxes]).reshape((-1, 3)) - self.origin
+        hi = np.array([b[1] for b in boxes]).reshape((-1, 3)) - self.origin
+        for node in nodes:
+            self.index[node.key] = len(self.tiles)
+            self.tiles.append(node)
+        self.pages.update(pages)
+        self.box_min = np.vstack((self.box_min, lo))
+        self.box_max = np.vstack((self.box_max, hi))
+
+    def children(self, key):
+        level, x, y, z = key
+        for d in range(8):
+            yield (level + 1, 2 * x + (d & 1), 2 * y + ((d >> 1) & 1),
+                   2 * z + ((d >> 2) & 1))
+
+    def update(self, planes, eye, proj_factor=1000.0, min_error=1.0):
+        with self.cond:
+            box_min, box_max = self.box_min, self.box_max
+            n = len(self.tiles)
+        visible = octree.boxes_visible(planes, box_min[:n], box_max[:n])
+        center = (box_min[:n] + box_max[:n]) * 0.5
+        radius = np.sqrt(((box_max[:n] - box_min[:n]) ** 2).sum(axis=1)) * 0.5
+        dist = np.maximum(np.sqrt(((center - eye) ** 2).sum(axis=1)) - radius, 1e-6)
+        # spacing of the points of a node over its distance
+        levels = np.array([node.key[0] for node in self.tiles[:n]])
+        error = self.copc.spacing / 2.0 ** levels * proj_factor / dist
+        wanted, pages = [], []
+        used = 0
+        heap = []
+        root = self.index.get((0, 0, 0, 0))
+        if root is not None:
+            heap.append((-error[root], root))
+        while heap:
+            e, i = heapq.heappop(heap)
+            if not visible[i]:
+                continue
+            node = self.tiles[i]
+            if used + node.nbytes > self.memory_limit and wanted:
+                break
+            if node.point_count > 0:
+                wanted.append(i)
+                used += node.nbytes
+            if -e < min_error:
+                continue
+            for key in self.children(node.key):
+                j = self.index.get(key)
+                if j is not None and j < n:
+                    heapq.heappush(heap, (-error[j], j))
+                elif key in self.pages:
+                    pages.append(key)
+        with self.cond:
+            self.page_queue = [key for key in pages if key in self.pages]
+            if self.page_queue:
+                self.cond.notify()
+        self._schedule(wanted, eye)
+
+    def sample(self):
+        """
+        (records, header) of the root node only: the coarsest level is
+        a sample of all of the points.
+        """
+        root = self.index.get((0, 0, 0, 0))
+        if root is not None:
+            yield self.copc.read_points(self.tiles[root]), self.copc.header
+
+    def _run(self):
+        while True:
+            page = tile = None
+            with self.cond:
+                while not self.queue and not self.page_queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                if self.page_queue:
+                    page = self.pages.pop(self.page_queue.pop(0), None)
+                else:
+                    tile = self.tiles[self.queue.pop(0)]
+                    tile.loading = True
+            if page is not None:
+                try:
+                    entries = self.copc.read_page(*page)
+                except Exception as e:
+                    # popped from self.pages, so not fetched again
+                    self._report("%s: hierarchy page: %s" % (self.copc.path, e))
+                    continue
+                with self.cond:
+                    self._add(*entries)
+                if self.on_loaded is not None:
+                    self.on_loaded()  # so that the new nodes are considered
+            elif tile is not None:
+                try:
+                    data = self.load_tile(tile)
+                except Exception as e:
+                    with self.cond:
+                        tile.loading = False
+                        tile.failed = True
+                    self._report("%s: %s" % (tile.path, e))
+                    continue
+                with self.cond:
+                    tile.loading = False
+                    if self.closed:
+                        if data is not None:
+                            self.release(data)
+                        return
+                    tile.data = data
+                if self.on_loaded is not None:
+                    self.on_loaded()
+
+    def close(self):
+        tiles.TileSet.close(self)
+        self.copc.close()
@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+"""
+Cache of decoded point dimensions.
+Sits between the viewer and the laspy file object, so that a dimension
+is only read and scaled once - as long as it fits within the budget.
+"""
+
+# "rgb" is not a dimension of the file, but is often asked for
+COMPOSITE = {"rgb": ("red", "green", "blue")}
+
+
+def compact(values):
+    """Integer values in the smallest dtype which holds them."""
+    if values.dtype.kind not in "ui" or values.shape[0] == 0:
+        return values
+    lo, hi = values.min(), values.max()
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            if np.dtype(dtype).itemsize < values.dtype.itemsize:
+                return values.astype(dtype)
+            break
+    return values
+
+
+class DimensionStore(object):
+    """
+    LRU cache of dimensions decoded by get_dimension(name), holding at
+    most budget bytes. The most recently decoded dimension is always
+    kept, even if it alone is larger than the budget.
+    """
+
+    def __init__(self, get_dimension, budget=2 * 1024 ** 3):
+        self.get_dimension = get_dimension
+        self.budget = budget
+        self.columns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            if name in self.columns:
+                self.hits += 1
+                values = self.columns.pop(name)
+                self.columns[name] = values  # most recently used last
+                return values
+            self.misses += 1
+        if name in COMPOSITE:
+            values = np.column_stack([compact(np.asarray(self.get_dimension(part)))
+                                      for part in COMPOSITE[name]])
+        else:
+            values = compact(np.asarray(self.get_dimension(name)))
+        with self.lock:
+            self.columns[name] = values
+            self._evict()
+        return values
+
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def _evict(self):
+        while len(self.columns) > 1 and self.resident_bytes > self.budget:
+            self.columns.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.columns.clear()
+
+    @property
+    def resident_bytes(self):
+        return sum(values.nbytes for values in self.columns.values())
+
+    def stats(self):
+        return ("Dimension cache: %d hits, %d misses, %.1f of %.1f MB resident (%s)" %
+                (self.hits, self.misses, self.resident_bytes / 1024.0 ** 2,
+                 self.budget / 1024.0 ** 2, ", ".join(self.columns)))
@@ -0,0 +1,90 @@
+import math
+import numpy as np
+import colormaps
+
+"""
+2D bucket grid over the x, y of a pointcloud, for cutting profiles:
+a query only looks at the points of the cells it overlaps.
+Not LAS specific.
+"""
+
+# Aim for this many points per cell on average ...
+POINTS_PER_CELL = 64
+# ... but use at most this many cells
+MAX_CELLS = 1 << 22
+
+
+class GridIndex(object):
+    """
+    The points of cell (i, j) are order[starts[k]:starts[k + 1]] with
+    k = j * nx + i, indices into the x, y arrays given.
+    """
+
+    def __init__(self, x, y, points_per_cell=POINTS_PER_CELL, max_cells=MAX_CELLS):
+        n = x.shape[0]
+        self.x_min, x_max = [float(v) for v in colormaps.value_range(x)]
+        self.y_min, y_max = [float(v) for v in colormaps.value_range(y)]
+        area = max(x_max - self.x_min, 1e-6) * max(y_max - self.y_min, 1e-6)
+        cells = min(max(n // points_per_cell, 1), max_cells)
+        self.cell = math.sqrt(area / cells)
+        self.nx = int((x_max - self.x_min) / self.cell) + 1
+        self.ny = int((y_max - self.y_min) / self.cell) + 1
+        keys = np.empty(n, dtype=np.int32)
+
+        def work(i0, i1):
+            i = ((x[i0:i1] - self.x_min) / self.cell).astype(np.int32)
+            j = ((y[i0:i1] - self.y_min) / self.cell).astype(np.int32)
+            # float32 rounding at the far edges
+            np.minimum(i, self.nx - 1, out=i)
+            np.minimum(j, self.ny - 1, out=j)
+            keys[i0:i1] = j * self.nx + i
+        colormaps.chunked(n, work)
+        self.starts = np.zeros(self.nx * self.ny + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys, minlength=self.nx * self.ny), out=self.starts[1:])
+        self.order = np.argsort(keys, kind="mergesort")
+        if n < 2 ** 32:
+            self.order = self.order.astype(np.uint32)
+        self.x = x
+        self.y = y
+
+    def corridor(self, p0, p1, width):
+        """
+        Points within width / 2 of the segment p0 - p1 (x, y) - measured
+        across it, i.e. an oriented rectangle. Returns their indices, the
+        distance along the segment from p0 and the signed distance across.
+        """
+        p0 = np.asarray(p0, dtype=np.float64)[:2]
+        p1 = np.asarray(p1, dtype=np.float64)[:2]
+        length = float(np.hypot(*(p1 - p0)))
+        empty = np.zeros(0, dtype=np.float64)
+        if length == 0 or width <= 0:
+            return np.zeros(0, dtype=self.order.dtype), empty, empty
+        u = (p1 - p0) / length
+        v = np.array((-u[1], u[0]))
+        half = width * 0.5
+        corners = np.array([p0 + v * half, p0 - v * half, p1 + v * half, p1 - v * half])
+        i0, j0 = np.floor((corners.min(axis=0) - (self.x_min, self.y_min)) / self.cell)
+        i1, j1 = np.floor((corners.max(axis=0) - (self.x_min, self.y_min)) / self.cell)
+        i0, i1 = max(int(i0), 0), min(int(i1), self.nx - 1)
+        j0, j1 = max(int(j0), 0), min(int(j1), self.ny - 1)
+        if i1 < i0 or j1 < j0:
+            return np.zeros(0, dtype=self.order.dtype), empty, empty
+        # cells whose centre is within half a diagonal of the rectangle
+        i, j = np.meshgrid(np.arange(i0, i1 + 1), np.arange(j0, j1 + 1))
+        cx = self.x_min + (i + 0.5) * self.cell - (p0[0] + p1[0]) * 0.5
+        cy = self.y_min + (j + 0.5) * self.cell - (p0[1] + p1[1]) * 0.5
+        r = self.cell * math.sqrt(0.5)
+        hit = ((np.abs(cx * u[0] + cy * u[1]) <= length * 0.5 + r) &
+               (np.abs(cx * v[0] + cy * v[1]) <= half + r))
+        keys = (j * self.nx + i)[hit]
+        # concatenate the ranges of the cells
+        counts = self.starts[keys + 1] - self.starts[keys]
+        total = int(counts.sum())
+        offsets = np.repeat(self.starts[keys] - (np.cumsum(counts) - counts), counts)
+        idx = self.order[offsets + np.arange(total)]
+        dx = self.x[idx] - p0[0]
+        dy = self.y[idx] - p0[1]
+        along = dx * u[0] + dy * u[1]
+        across = dx * v[0] + dy * v[1]
+        keep = (along >= 0) & (along <= length) & (np.abs(across) <= half)
+        return idx[keep], along[keep], across[keep]
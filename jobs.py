@@ -0,0 +1,152 @@
+import threading
+import traceback
+import time
+
+"""
+Background jobs for the GUI.
+Jobs run in a small pool of worker threads. Jobs of the same group run
+one at a time in the order they were submitted, while other groups run
+alongside. A new job supersedes (cancels) the queued and running jobs of
+the kinds it replaces - so of several quick color changes only the last
+one is done. Cancellation is cooperative: the job calls job.check() or
+job.progress() now and then, which raise JobCancelled once cancelled.
+"""
+
+WORKERS = 4
+
+
+class JobCancelled(BaseException):
+    """
+    Raised inside a cancelled job. Not an Exception, so that it is
+    not swallowed by the usual except Exception error handling.
+    """
+
+
+class Job(object):
+
+    def __init__(self, scheduler, kind, func, group):
+        self.scheduler = scheduler
+        self.kind = kind
+        self.func = func
+        self.group = group
+        self.cancelled = False
+        self.error = None
+        self.result = None
+        self.fraction = 0.0
+        self.text = ""
+        self.started = None
+        self.finished = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, fraction, text=""):
+        """Report progress (0 - 1) - and check for cancellation."""
+        self.check()
+        self.fraction = fraction
+        self.text = text
+        if self.scheduler.on_progress is not None:
+            self.scheduler.on_progress(self)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+class JobScheduler(object):
+    """
+    on_progress(job) and on_finished(job) are called from the worker
+    threads - e.g. to emit Qt signals. on_finished is also called for
+    jobs which were cancelled before they started. The next job of the
+    group does not start before on_finished returns, so it may wait for
+    the GUI thread to take the results of the job (job.result).
+    """
+
+    def __init__(self, workers=WORKERS, on_progress=None, on_finished=None):
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.queue = []
+        self.running = []
+        self.cond = threading.Condition()
+        for i in range(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, kind, func, group=None, supersedes=None):
+        """
+        Queue func(job). group defaults to the kind and supersedes to
+        (kind,) - the kinds of jobs to cancel.
+        """
+        job = Job(self, kind, func, kind if group is None else group)
+        if supersedes is None:
+            supersedes = (kind,)
+        with self.cond:
+            for other in self.queue + self.running:
+                if other.kind in supersedes:
+                    other.cancel()
+            dropped = [other for other in self.queue if other.cancelled]
+            self.queue = [other for other in self.queue if not other.cancelled]
+            self.queue.append(job)
+            self.cond.notify_all()
+        for other in dropped:
+            self._done(other)
+        return job
+
+    def busy(self, group=None):
+        """Are there queued or running jobs (of the group)?"""
+        with self.cond:
+            return any((group is None or job.group == group) and
+                       job.finished is None for job in self.queue + self.running)
+
+    def cancel_all(self):
+        with self.cond:
+            for job in self.queue + self.running:
+                job.cancel()
+            dropped = self.queue
+            self.queue = []
+        for job in dropped:
+            self._done(job)
+
+    def _next(self):
+        busy = set(job.group for job in self.running)
+        for job in self.queue:
+            if job.group not in busy:
+                return job
+            busy.add(job.group)  # keep the order within the group
+        return None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                job = self._next()
+                while job is None:
+                    self.cond.wait()
+                    job = self._next()
+                self.queue.remove(job)
+                self.running.append(job)
+            job.started = time.time()
+            try:
+                job.check()
+                job.result = job.func(job)
+            except JobCancelled:
+                job.cancelled = True
+            except Exception as e:
+                job.error = traceback.format_exc() + "\n" + str(e)
+            job.finished = time.time()
+            # still running for the group, so that on_finished can hand
+            # on the results before the next job of the group starts
+            self._done(job)
+            with self.cond:
+                self.running.remove(job)
+                self.cond.notify_all()
+
+    def _done(self, job):
+        if self.on_finished is not None:
+            self.on_finished(job)
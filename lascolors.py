@@ -0,0 +1,29 @@
+import numpy as np
+import colormaps
+
+"""
+The colormaps used for the LAS dimensions - by the viewer as well as
+by the headless thumbnail renderer, which can not import Qt.
+"""
+
+CLS_MAP = {1: (0.9, 0.9, .9), 6: (0.8, 0, 0), 9: (0, 0, 0.9), 2: (0.6, 0.5, 0), 3: (
+    0, 0.8, 0), 4: (0, 0.6, 0), 5: (0.1, 0.9, 0), 17: (0, 0.35, 0.3), 18: (0.1, 0.5, 0.5)}
+
+COLOR_LIST = ((0.9, 0, 0), (0, 0.9, 0), (0, 0, 0.9),
+              (0.7, 0.8, 0), (0, 0.8, 0.7))
+
+
+def dimension_to_coloring(dim, data, use_z=False, hist=None):
+    """
+    Pick a colormap for the dimension. For "rgb" data should
+    be an n x 3 array. hist is the stats.Histogram of data, if known.
+    """
+    if dim == "rgb":
+        return colormaps.rgb_coloring(data, hist)
+    if dim == "raw_classification":
+        return colormaps.class_coloring(data, CLS_MAP, hist=hist)
+    # percentiles do not care about scaling, so no need to normalise intensity
+    elif dim == "intensity" or data.dtype == np.float32 or data.dtype == np.float64:
+        return colormaps.linear_coloring(data, (0.1, 0.1, 0.1), (0.9, 0.9, 0.9),
+                                         use_z=use_z, hist=hist)
+    return colormaps.discrete_coloring(data, COLOR_LIST, hist)
@@ -0,0 +1,361 @@
+import os
+import struct
+import tempfile
+import multiprocessing
+import numpy as np
+
+"""
+Minimal numpy based access to the point records of LAS files.
+Reads the public header block and maps the point data region, so that
+points can be read in chunks without going through laspy.
+Dimension names follow laspy.file.File.
+"""
+
+# Points per task when decoding in parallel
+PARALLEL_CHUNK = 1 << 20
+
+# Point record layouts for the standard point formats
+_BASE_0_5 = [("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("intensity", "<u2"),
+             ("flag_byte", "u1"), ("raw_classification", "u1"),
+             ("scan_angle_rank", "i1"), ("user_data", "u1"), ("pt_src_id", "<u2")]
+_BASE_6_10 = [("X", "<i4"), ("Y", "<i4"), ("Z", "<i4"), ("intensity", "<u2"),
+              ("flag_byte", "u1"), ("classification_flags", "u1"),
+              ("raw_classification", "u1"), ("user_data", "u1"),
+              ("scan_angle", "<i2"), ("pt_src_id", "<u2"), ("gps_time", "<f8")]
+_GPS = [("gps_time", "<f8")]
+_RGB = [("red", "<u2"), ("green", "<u2"), ("blue", "<u2")]
+_NIR = [("nir", "<u2")]
+_WAVE = [("wave_packet_desc_index", "u1"), ("byte_offset_to_waveform_data", "<u8"),
+         ("waveform_packet_size", "<u4"), ("return_point_waveform_loc", "<f4"),
+         ("x_t", "<f4"), ("y_t", "<f4"), ("z_t", "<f4")]
+
+POINT_FORMATS = {0: _BASE_0_5,
+                 1: _BASE_0_5 + _GPS,
+                 2: _BASE_0_5 + _RGB,
+                 3: _BASE_0_5 + _GPS + _RGB,
+                 4: _BASE_0_5 + _GPS + _WAVE,
+                 5: _BASE_0_5 + _GPS + _RGB + _WAVE,
+                 6: _BASE_6_10,
+                 7: _BASE_6_10 + _RGB,
+                 8: _BASE_6_10 + _RGB + _NIR,
+                 9: _BASE_6_10 + _WAVE,
+                 10: _BASE_6_10 + _RGB + _NIR + _WAVE}
+
+
+class LasHeader(object):
+    """The parts of the LAS public header block which we need."""
+
+    def __init__(self, fname, raw=None):
+        """raw: the first 375 bytes of the file, if already read."""
+        if raw is None:
+            with open(fname, "rb") as f:
+                raw = f.read(375)
+        if raw[:4] != b"LASF":
+            raise ValueError("%s is not a LAS file" % fname)
+        self.version = (struct.unpack_from("<B", raw, 24)[0],
+                        struct.unpack_from("<B", raw, 25)[0])
+        self.header_size = struct.unpack_from("<H", raw, 94)[0]
+        self.data_offset = struct.unpack_from("<I", raw, 96)[0]
+        fmt = struct.unpack_from("<B", raw, 104)[0]
+        # bit 7 set means LAZ compressed
+        self.compressed = bool(fmt & 0x80)
+        self.point_format = fmt & 0x3f
+        self.record_length = struct.unpack_from("<H", raw, 105)[0]
+        self.point_count = struct.unpack_from("<I", raw, 107)[0]
+        if self.version >= (1, 4) and self.header_size >= 375:
+            count = struct.unpack_from("<Q", raw, 247)[0]
+            if count > 0:
+                self.point_count = count
+        self.scale = np.array(struct.unpack_from("<3d", raw, 131))
+        self.offset = np.array(struct.unpack_from("<3d", raw, 155))
+        bounds = struct.unpack_from("<6d", raw, 179)
+        self.max = np.array(bounds[0::2])
+        self.min = np.array(bounds[1::2])
+
+    @property
+    def dtype(self):
+        return point_dtype(self.point_format, self.record_length)
+
+
+def point_dtype(point_format, record_length):
+    """numpy dtype of a point record, padded to record_length."""
+    if point_format not in POINT_FORMATS:
+        raise ValueError("Unsupported point format %d" % point_format)
+    fields = list(POINT_FORMATS[point_format])
+    size = np.dtype(fields).itemsize
+    if record_length > size:
+        fields.append(("extra_bytes", "V%d" % (record_length - size)))
+    elif record_length < size:
+        raise ValueError("Record length %d too short for point format %d" %
+                         (record_length, point_format))
+    return np.dtype(fields)
+
+
+def map_points(fname, header=None):
+    """Read only memory map of all point records."""
+    if header is None:
+        header = LasHeader(fname)
+    if header.compressed:
+        raise ValueError("Compressed (LAZ) files can not be mapped")
+    return np.memmap(fname, dtype=header.dtype, mode="r",
+                     offset=header.data_offset, shape=(header.point_count,))
+
+
+def iter_points(fname, header=None, chunk_size=1000000):
+    """
+    Yield the point records in chunks of (at most) chunk_size points.
+    The chunks are copies, so the file is not kept mapped.
+    """
+    if header is None:
+        header = LasHeader(fname)
+    points = map_points(fname, header)
+    for i0 in range(0, points.shape[0], chunk_size):
+        yield np.array(points[i0:i0 + chunk_size])
+    del points
+
+
+def get_dimension(records, header, name):
+    """
+    Get a dimension from point records, scaled like laspy would do it
+    for x, y, z and with the bit fields of flag_byte unpacked.
+    """
+    if name in ("x", "y", "z"):
+        i = "xyz".index(name)
+        return records[name.upper()] * header.scale[i] + header.offset[i]
+    legacy = header.point_format < 6
+    if name == "return_num":
+        return records["flag_byte"] & (7 if legacy else 15)
+    if name == "num_returns":
+        return (records["flag_byte"] >> (3 if legacy else 4)) & (7 if legacy else 15)
+    if name == "classification":
+        return records["raw_classification"] & (31 if legacy else 255)
+    return records[name]
+
+
+def has_dimension(header, name):
+    """Can get_dimension decode name from records of this header?"""
+    return (name in ("x", "y", "z", "return_num", "num_returns", "classification")
+            or name in header.dtype.names)
+
+
+# The pool of decoder processes, started once - see start_pool
+_pool = None
+
+
+def start_pool(processes=None):
+    """
+    Start the processes of decode_parallel, if not running yet. They are
+    spawned where possible: forking would copy the parent with its
+    threads (Qt, GL, job workers) in whatever state they are. Else (on
+    python 2) call this early, before any threads are started.
+    """
+    global _pool
+    if _pool is None:
+        if hasattr(multiprocessing, "get_context"):
+            _pool = multiprocessing.get_context("spawn").Pool(processes)
+        else:
+            _pool = multiprocessing.Pool(processes)
+    return _pool
+
+
+def _shared_file(nbytes):
+    """
+    A temporary file of nbytes to map, shared with the decoder processes
+    - in memory (/dev/shm) where possible, like multiprocessing does.
+    """
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    fd, path = tempfile.mkstemp(prefix="lasio_", dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.truncate(nbytes)
+    return path
+
+
+def _decode_chunk(task):
+    bounds, (fname, header, names, outputs, origin) = task
+    i0, i1 = bounds
+    if not os.path.exists(outputs[0][0]):
+        return bounds  # abandoned, see _decode_chunks
+    # map only the byte range of this chunk
+    records = np.memmap(fname, dtype=header.dtype, mode="r",
+                        offset=header.data_offset + i0 * header.record_length,
+                        shape=(i1 - i0,))
+    for name, (path, dtype) in zip(names, outputs):
+        out = np.memmap(path, dtype=dtype, mode="r+",
+                        offset=i0 * dtype.itemsize, shape=(i1 - i0,))
+        if origin is not None and name in ("x", "y", "z"):
+            i = "xyz".index(name)
+            out[:] = (records[name.upper()] * header.scale[i] +
+                      (header.offset[i] - origin[i]))
+        else:
+            out[:] = get_dimension(records, header, name)
+        del out
+    del records
+    return bounds
+
+
+def decode_parallel(fname, names, header=None, processes=None,
+                    chunk_size=PARALLEL_CHUNK, origin=None):
+    """
+    Decode the dimensions names in the pool of processes of start_pool
+    (of processes, when started here), each mapping its own byte range
+    of the point records. The outputs are mapped from shared files, so
+    only the chunk bounds (and the header) are pickled.
+    If origin is given, x, y and z are decoded relative to it as float32.
+    Returns the output arrays and a generator, which yields (i0, i1) in
+    order as the chunks are done - the outputs are then filled up to i1.
+    """
+    if header is None:
+        header = LasHeader(fname)
+    if header.compressed:
+        raise ValueError("Compressed (LAZ) files can not be mapped")
+    n = header.point_count
+    probe = np.zeros(1, dtype=header.dtype)
+    dtypes = []
+    for name in names:
+        if origin is not None and name in ("x", "y", "z"):
+            dtypes.append(np.dtype(np.float32))
+        else:
+            dtypes.append(np.asarray(get_dimension(probe, header, name)).dtype)
+    if n == 0:
+        return [np.zeros(0, dtype=dtype) for dtype in dtypes], iter(())
+    paths = [_shared_file(n * dtype.itemsize) for dtype in dtypes]
+    outputs = [np.memmap(path, dtype=dtype, mode="r+", shape=(n,))
+               for path, dtype in zip(paths, dtypes)]
+    ranges = [(i0, min(n, i0 + chunk_size)) for i0 in range(0, n, chunk_size)]
+    state = (fname, header, names, list(zip(paths, dtypes)), origin)
+    return outputs, _decode_chunks(ranges, state, paths, processes)
+
+
+def _decode_chunks(ranges, state, paths, processes):
+    try:
+        if len(ranges) <= 1:
+            # not worth the round trip to the processes
+            for bounds in ranges:
+                yield _decode_chunk((bounds, state))
+            return
+        tasks = [(bounds, state) for bounds in ranges]
+        for bounds in start_pool(processes).imap(_decode_chunk, tasks):
+            yield bounds
+    finally:
+        # the outputs stay mapped. If the caller stops early, the chunks
+        # still queued find their files gone and are skipped.
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def read_dimensions(fname, names, header=None, processes=None,
+                    chunk_size=PARALLEL_CHUNK):
+    """Decode whole dimensions in parallel, see decode_parallel."""
+    outputs, chunks = decode_parallel(fname, names, header, processes,
+                                      chunk_size)
+    for bounds in chunks:
+        pass
+    return outputs
+
+
+def write_points(fname, out_fname, mask=None, header=None,
+                 chunk_size=PARALLEL_CHUNK, progress=None):
+    """
+    Write the points of fname selected by mask (bool per point, all if
+    None) to a new LAS file - chunk by chunk, so memory use does not
+    depend on the size of the file. Header, VLRs, point format, scale and
+    offset are copied as they are; the point counts (also by return) and
+    the bounds are set from the points written. Data after the points
+    (waveform packets, extended VLRs) is copied and pointed to.
+    progress(fraction) is called after each chunk.
+    The points go to out_fname + ".tmp" first, which is renamed when
+    done - or removed if anything (also cancelling) stops the writing.
+    Returns the number of points written.
+    """
+    if header is None:
+        header = LasHeader(fname)
+    points = map_points(fname, header)
+    tmp = out_fname + ".tmp"
+    done = False
+    try:
+        count = _write_points(fname, tmp, points, mask, header, chunk_size,
+                              progress)
+        if os.path.exists(out_fname):
+            os.remove(out_fname)  # rename does not replace on Windows
+        os.rename(tmp, out_fname)
+        done = True
+    finally:
+        if not done and os.path.exists(tmp):
+            os.remove(tmp)
+    return count
+
+
+def _write_points(fname, out_fname, points, mask, header, chunk_size, progress):
+    n = header.point_count
+    return_counts = np.zeros(16, dtype=np.int64)
+    lo = np.full(3, np.iinfo(np.int64).max, dtype=np.int64)
+    hi = np.full(3, np.iinfo(np.int64).min, dtype=np.int64)
+    count = 0
+    with open(fname, "rb") as src, open(out_fname, "wb") as dst:
+        prefix = bytearray(src.read(header.data_offset))
+        dst.write(bytes(prefix))
+        for i0 in range(0, n, chunk_size):
+            records = points[i0:i0 + chunk_size]
+            if mask is not None:
+                records = records[mask[i0:i0 + chunk_size]]
+            else:
+                records = np.array(records)
+            if records.shape[0] > 0:
+                count += records.shape[0]
+                for i, name in enumerate("XYZ"):
+                    lo[i] = min(lo[i], records[name].min())
+                    hi[i] = max(hi[i], records[name].max())
+                return_counts += np.bincount(
+                    get_dimension(records, header, "return_num"), minlength=16)[:16]
+                dst.write(records.tobytes())
+            if progress is not None:
+                progress(float(min(i0 + chunk_size, n)) / n)
+        del points
+        # anything after the point records
+        end = header.data_offset + n * header.record_length
+        src.seek(end)
+        tail_offset = dst.tell()
+        while True:
+            block = src.read(1 << 24)
+            if not block:
+                break
+            dst.write(block)
+        _update_header(prefix, header, count, return_counts, lo, hi,
+                       tail_offset - end)
+        dst.seek(0)
+        dst.write(bytes(prefix[:header.header_size]))
+    return count
+
+
+def _update_header(raw, header, count, return_counts, lo, hi, shift):
+    """Patch the public header block raw for the points written."""
+    legacy = header.point_format < 6
+    legacy_count = struct.unpack_from("<I", raw, 107)[0]
+    if legacy and count < 2 ** 32:
+        legacy_count = count
+    elif legacy_count > 0:
+        legacy_count = 0  # does not fit
+    struct.pack_into("<I", raw, 107, legacy_count)
+    by_return = return_counts[1:6] if legacy_count > 0 else np.zeros(5)
+    struct.pack_into("<5I", raw, 111, *[int(c) for c in by_return])
+    if count > 0:
+        bounds = []
+        for i in range(3):
+            bounds += [hi[i] * header.scale[i] + header.offset[i],
+                       lo[i] * header.scale[i] + header.offset[i]]
+    else:
+        bounds = [0.0] * 6
+    struct.pack_into("<6d", raw, 179, *bounds)
+    if header.version >= (1, 3) and header.header_size >= 235:
+        start = struct.unpack_from("<Q", raw, 227)[0]
+        if start > 0:
+            struct.pack_into("<Q", raw, 227, start + shift)
+    if header.version >= (1, 4) and header.header_size >= 375:
+        start = struct.unpack_from("<Q", raw, 235)[0]
+        if start > 0:
+            struct.pack_into("<Q", raw, 235, start + shift)
+        struct.pack_into("<Q", raw, 247, count)
+        struct.pack_into("<15Q", raw, 255, *[int(c) for c in return_counts[1:16]])
@@ -4,49 +4,31 @@ from PyQt4.QtGui import *
 from PyQt4.QtOpenGL import *
 import numpy as np
 import traceback
-import threading
 import sys
 import os
 import json
+import time
+import tempfile
 import laspy.file as lasf
 import qt_glviewer
+import lasio
+import sidecar
+import query
+import dimstore
+import tiles
+import copc
+import jobs
+import metrics
+import profile_view
+import overview
+import maskhistory
+import voxels
+import stats
+import stats_view
+from lascolors import CLS_MAP, dimension_to_coloring
 
 ABOUT = "A pointcloud viewer based on laspy"
-
-CLS_MAP = {1: (0.9, 0.9, .9), 6: (0.8, 0, 0), 9: (0, 0, 0.9), 2: (0.6, 0.5, 0), 3: (
-    0, 0.8, 0), 4: (0, 0.6, 0), 5: (0.1, 0.9, 0), 17: (0, 0.35, 0.3), 18: (0.1, 0.5, 0.5)}
-
-COLOR_LIST = ((0.9, 0, 0), (0, 0.9, 0), (0, 0, 0.9),
-              (0.7, 0.8, 0), (0, 0.8, 0.7))
-
-
-# Some colormap methods
-def class_to_color(cls, cls_map):
-    colors = np.ones((cls.shape[0], 3), dtype=np.float32) * 0.5
-    for c in cls_map:
-        colors[cls == c] = cls_map[c]
-    return colors
-
-
-def discrete_dimension_to_color(all_vals, color_list):
-    colors = np.zeros((all_vals.shape[0], 3), dtype=np.float32)
-    vals = np.unique(all_vals)
-    for i, val in enumerate(vals):
-        M = (all_vals == val)
-        colors[M] = color_list[i % len(color_list)]
-    return colors
-
-
-def linear_colormap(all_vals, color_low, color_high):
-    c1 = np.ones((all_vals.shape[0], 3), dtype=np.float32) * color_low
-    c2 = np.ones((all_vals.shape[0], 3), dtype=np.float32) * color_high
-    m1 = np.percentile(all_vals, 5)
-    m2 = np.percentile(all_vals, 95)
-    dv = ((all_vals - m1) / (m2 - m1)).reshape((all_vals.shape[0], 1))
-    dv[dv < 0] = 0
-    dv[dv > 1] = 1
-    colors = c1 + c2 * dv
-    return colors
+FILTER_HINT = '{"x": [xmin,xmax], "y": [ymin,ymax],...}'
 
 
 class RedirectOutput(object):
@@ -96,6 +78,11 @@ class TextViewer(QDialog):
 menu_model = (
     {"name": "&File",
      "items": (("Open", "onOpenFile"),
+               ("Open tiles", "onOpenTiles"),
+               ("Open COPC URL", "onOpenUrl"),
+               ("Export shown points", "onExport"),
+               ("Log", "showLog"),
+               ("Profile next job", "profileNextJob"),
                ("About", "onAbout"),
                ("Exit", "onClose"))
      },
@@ -110,9 +97,30 @@ menu_model = (
     {"name": "&Display",
      "items": (("Increase point size", "increasePointSize"),
                ("Decrease point size", "decreasePointSize"),
+               ("Point budget", "setPointBudget"),
+               ("Dimension cache size", "setDimensionBudget"),
+               ("Tile memory limit", "setTileMemoryLimit"),
+               ("Show stats", "toggleStats"),
+               ("Dimension statistics", "showStatistics"),
+               ("Overview map", "toggleOverview"),
                ("Filtering", "setFilter"),
+               ("Lasso select", "lassoSelect"),
+               ("Rectangle select", "rectangleSelect"),
+               ("Profile", "drawProfile"),
+               ("Profile width", "setProfileWidth"),
+               ("Voxel size", "setVoxelSize"),
+               ("Thin to voxels", "thinVoxels"),
+               ("Remove duplicates", "removeDuplicates"),
                ("Clear mask", "clearMask"),
-               ("Reset", "resetView"))}
+               ("Reset", "resetView"))},
+    {"name": "&Masks",
+     "items": (("Undo mask", "undoMask", "Ctrl+Z"),
+               ("Redo mask", "redoMask", "Ctrl+Y"),
+               ("Mask history", "chooseMask"),
+               ("Name mask", "nameMask"),
+               ("Union with", "unionMask"),
+               ("Intersect with", "intersectMask"),
+               ("Invert mask", "invertMask"))}
 )
 
 
@@ -127,27 +135,89 @@ class LasViewer(QtGui.QMainWindow):
         menubar = self.menuBar()
         for menu_def in menu_model:
             menu = menubar.addMenu(menu_def["name"])
-            for item, handler in menu_def["items"]:
+            for entry in menu_def["items"]:
+                item, handler = entry[:2]
                 action = QAction(item, self)
+                if len(entry) > 2:
+                    action.setShortcut(QKeySequence(entry[2]))
                 menu.addAction(action)
                 if handler:
                     action.triggered.connect(getattr(self, handler))
 
         self.dir = "/"
         self.logWindow = TextViewer(self)
-        self.filtering_expression = '{"x": [xmin,xmax], "y": [ymin,ymax],...}'
+        self.filtering_expression = FILTER_HINT
         # threading stuff
-        self.background_task_signal = QtCore.SIGNAL("__my_backround_task")
+        self.chunk_loaded_signal = QtCore.SIGNAL("__chunk_loaded")
         self.log_stdout_signal = QtCore.SIGNAL("__stdout_signal")
+        self.log_info_signal = QtCore.SIGNAL("__info_signal")
         self.log_stderr_signal = QtCore.SIGNAL("__stderr_signal")
+        self.job_progress_signal = QtCore.SIGNAL("__job_progress")
+        QtCore.QObject.connect(
+            self, self.job_progress_signal, self.onJobProgress)
+        QtCore.QObject.connect(
+            self, self.chunk_loaded_signal, self.viewer.update)
         QtCore.QObject.connect(
-            self, self.background_task_signal, self.finishBackgroundTask)
+            self.viewer, self.viewer.point_picked_signal, self.onPointPicked)
+        QtCore.QObject.connect(
+            self.viewer, self.viewer.selection_signal, self.onSelection)
+        QtCore.QObject.connect(
+            self.viewer, self.viewer.profile_signal, self.onProfileLine)
         QtCore.QObject.connect(self, self.log_stdout_signal, self.logStdout)
+        QtCore.QObject.connect(self, self.log_info_signal, self.logDebug)
         QtCore.QObject.connect(self, self.log_stderr_signal, self.logStderr)
         self.filename = None
+        # Background jobs. Jobs touching the viewer are all in one group,
+        # so they run one at a time - self.job is the one running. Their
+        # results go to the viewer in finishBackgroundTask, on the GUI
+        # thread, before the next job starts.
+        self.jobs = jobs.JobScheduler(
+            on_progress=lambda job: self.emit(self.job_progress_signal, job),
+            on_finished=lambda job: self.viewer.on_gui_thread(
+                lambda: self.finishBackgroundTask(job)))
+        self.job = None
+        self.profile_next = False
+        # Stage timings of the viewer and of the jobs go to the log
+        self.metrics = self.viewer.metrics
+        self.metrics.on_timing = lambda name, seconds: self.logInfo(
+            "%s: %.3fs" % (name, seconds))
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setMaximumWidth(150)
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(self.onCancel)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.statusBar().addPermanentWidget(self.cancel_button)
+        self.updateProgress()
+        self.query = None
         self.display_dimension = "raw_classification"
         self.lasf_object = None
+        # decoded dimensions of lasf_object
+        self.dimensions = dimstore.DimensionStore(self.readDimension)
+        # masks applied so far, for undo / redo
+        self.masks = maskhistory.MaskHistory()
+        self.header = None
         self.err_msg = None
+        # Read point records in chunks and show them while loading
+        self.streaming = "nostream" not in sys.argv
+        self.chunk_size = 1000000
+        # Keep preprocessed points and colors on disk for fast re-opening
+        self.use_cache = "nocache" not in sys.argv
+        self.cache = None
+        # Memory for the loaded tiles of a tiled dataset
+        self.tile_memory_limit = 4 * 1024 ** 3
+        # Profiles: the line (viewer coordinates) and width of the
+        # corridor
+        self.profile_view = profile_view.ProfileView(self)
+        QtCore.QObject.connect(self.profile_view, self.profile_view.shift_signal,
+                               self.onProfileShift)
+        self.profile_line = None
+        self.profile_width = 1.0
+        # Statistics of the dimensions: {dimension: stats.Histogram}
+        self.stats = None
+        self.stats_view = stats_view.StatsView(self)
+        # Voxel thinning: the size of the voxels and which point to keep
+        self.voxel_size = 0.1
+        self.voxel_keep = "first"
         # redirect textual output
         if "debug" not in sys.argv:
             sys.stdout = RedirectOutput(self, self.log_stdout_signal)
@@ -157,12 +227,16 @@ class LasViewer(QtGui.QMainWindow):
             self.openFile(fname)
         else:
             QMessageBox.information(
-                self, "Movement", "Use first and second mouse button as well as 'asdw' to move around.")
+                self, "Movement", "Use first and second mouse button as well as 'asdw' to move around.\n"
+                "Ctrl + click a point to see its attributes.")
 
     # Menu event handlers here
     def onClose(self):
         self.close()
 
+    def showLog(self):
+        self.logWindow.show()
+
     def onAbout(self):
         msg = ABOUT
         QMessageBox.about(self, "About", msg)
@@ -173,6 +247,71 @@ class LasViewer(QtGui.QMainWindow):
         if len(my_file) > 0:
             self.openFile(my_file)
 
+    def onExport(self):
+        if self.lasf_object is None:
+            return
+        if self.header is None or self.header.compressed:
+            QMessageBox.warning(self, "Export", "Only uncompressed LAS files can be exported.")
+            return
+        out_file = unicode(QFileDialog.getSaveFileName(
+            self, "Export the points shown to", self.dir, "LAS files (*.las)"))
+        if len(out_file) > 0:
+            mask = self.viewer.mask
+            self.runInBackground("export", lambda: self.exportPoints(out_file, mask))
+
+    def exportPoints(self, out_file, mask):
+        """Write the points of mask to out_file (background thread)."""
+        try:
+            with self.metrics.stage("export"):
+                count = lasio.write_points(
+                    self.filename, out_file, mask, self.header,
+                    progress=lambda f: self.progress(f, "Exporting to %s (%d%%)" % (
+                        out_file, int(f * 100))))
+            self.log("%d points written to %s" % (count, out_file))
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+
+    def profileNextJob(self):
+        self.profile_next = True
+        self.logInfo("The next job will be profiled")
+        self.showLog()
+
+    def toggleStats(self):
+        self.viewer.toggle_stats()
+
+    def showStatistics(self):
+        if self.stats is None:
+            QMessageBox.information(self, "Statistics",
+                                    "No statistics - they are gathered while "
+                                    "loading uncompressed LAS files.")
+            return
+        self.stats_view.set_histograms(self.stats, os.path.basename(self.filename))
+        self.stats_view.show()
+
+    def toggleOverview(self):
+        """Cycle the minimap through its modes and off."""
+        modes = (None,) + overview.MODES
+        mode = modes[(modes.index(self.viewer.overview_mode) + 1) % len(modes)]
+        self.viewer.set_overview_mode(mode)
+        self.statusBar().showMessage("Overview map: %s" % (mode or "off"))
+
+    def onCancel(self):
+        self.jobs.cancel_all()
+
+    def onOpenTiles(self):
+        my_dir = unicode(QFileDialog.getExistingDirectory(
+            self, "Select a directory of LAS tiles", self.dir))
+        if len(my_dir) > 0:
+            self.openFile(my_dir)
+
+    def onOpenUrl(self):
+        url, ok = QInputDialog.getText(self, "Open COPC URL",
+                                       "URL of a cloud optimized point cloud:")
+        url = unicode(url).strip()
+        if ok and len(url) > 0:
+            self.openFile(url)
+
     def colorByClass(self):
         self.display_dimension = "raw_classification"
         self.onChangeColorMode()
@@ -205,136 +344,804 @@ class LasViewer(QtGui.QMainWindow):
 
     def resetView(self):
         self.viewer.reset_all()
+
+    def setPointBudget(self):
+        budget, ok = QInputDialog.getInt(self,
+                                         "Point budget",
+                                         "Max. points drawn per frame:",
+                                         self.viewer.point_budget, 1)
+        if ok:
+            self.viewer.set_point_budget(budget)
     
+    def setDimensionBudget(self):
+        budget, ok = QInputDialog.getInt(self,
+                                         "Dimension cache",
+                                         "Memory for decoded dimensions (MB):",
+                                         self.dimensions.budget // 1024 ** 2, 1)
+        if ok:
+            self.dimensions.set_budget(budget * 1024 ** 2)
+            self.logInfo(self.dimensions.stats())
+
+    def setTileMemoryLimit(self):
+        limit, ok = QInputDialog.getInt(self,
+                                        "Tiles",
+                                        "Memory for loaded tiles (MB):",
+                                        self.tile_memory_limit // 1024 ** 2, 1)
+        if ok:
+            self.tile_memory_limit = limit * 1024 ** 2
+            if self.viewer.tileset is not None:
+                self.viewer.tileset.memory_limit = self.tile_memory_limit
+                self.viewer.update()
+
+    def setProfileWidth(self):
+        width, ok = QInputDialog.getDouble(self,
+                                           "Profile",
+                                           "Width of the profile:",
+                                           self.profile_width, 0.001, 1e6, 3)
+        if ok:
+            self.profile_width = width
+            if self.profile_line is not None:
+                self.runInBackground("profile", self.cutProfile)
+
     def setFilter(self):
         if self.lasf_object is not None:
+            text = self.filtering_expression
+            if text == FILTER_HINT and self.stats is not None:
+                # the ranges of the file to start from
+                text = json.dumps(dict((dim, [self.stats[dim].lo, self.stats[dim].hi])
+                                       for dim in ("x", "y", "z") if dim in self.stats),
+                                  sort_keys=True)
             expression, ok = QInputDialog.getText(self,
                                     "Filtering",
                                     "JSON expression:",
-                                    text=self.filtering_expression)
+                                    text=text)
             if ok:
                 self.filtering_expression = str(expression)
-                conditions = json.loads(self.filtering_expression)
-                M = np.ones((len(self.lasf_object),), dtype = np.bool)
-                for key in conditions:
-                    val_min, val_max = conditions[key]
-                    vals = getattr(self.lasf_object, key)
-                    M &= vals <= val_max
-                    M &= vals >= val_min
-                self.viewer.set_mask(M)
-                self.log("Updating view..")
-                self.viewer.update_view()
+                self.runInBackground("mask", self.applyFilter)
+
+    def applyFilter(self):
+        """
+        Evaluate the filtering expression via the range query engine,
+        which keeps sorted indexes of the dimensions used so far.
+        This can happen in a background thread.
+        """
+        try:
+            conditions = json.loads(self.filtering_expression)
+            if self.query is None:
+                self.query = query.RangeQuery(
+                    len(self.lasf_object),
+                    self.dimensions.get)
+            for i, key in enumerate(conditions):
+                if not self.query.has_index(key):
+                    self.progress(float(i) / len(conditions),
+                                  "Indexing " + key + "...")
+                    with self.metrics.stage("index " + key):
+                        self.query.index(key)
+            with self.metrics.stage("filter"):
+                M = self.query.query(conditions)
+            self.logInfo(self.dimensions.stats())
+            self.job.check()
+            self.masks.push(self.filtering_expression, M)
+            self.log("Updating view..")
+            return [lambda: self.viewer.set_mask(M)]
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
     
     def clearMask(self):
-        self.viewer.clear_mask()
-        self.log("Updating view..")
-        self.viewer.update_view()
+        # after any filtering still to be done
+        self.runInBackground("mask", self.applyClearMask)
+
+    def applyClearMask(self):
+        self.masks.push("all points", None)
+        return [self.viewer.clear_mask]
+
+    # The mask history. Its jobs replace none, so that they all take
+    # effect in the order asked for.
+    def undoMask(self):
+        self.runInBackground("history", lambda: self.stepMask("undo"), ())
+
+    def redoMask(self):
+        self.runInBackground("history", lambda: self.stepMask("redo"), ())
+
+    def stepMask(self, step):
+        if not getattr(self.masks, step)():
+            self.log("Nothing to %s" % step)
+            return
+        return self.showMask(self.masks.mask())
+
+    def showMask(self, mask):
+        """The result of a mask history job."""
+        self.log("Mask: %s" % self.masks.name)
+        return [lambda: self.viewer.set_mask(mask)]
+
+    def pickMask(self, title, label):
+        """Let the user choose an entry of the mask history - or None."""
+        if self.lasf_object is None:
+            return None
+        items = ["%d: %s" % item for item in enumerate(self.masks.names())]
+        item, ok = QInputDialog.getItem(self, title, label, items,
+                                        self.masks.position, False)
+        if not ok:
+            return None
+        return items.index(item)
+
+    def chooseMask(self):
+        i = self.pickMask("Masks", "Show mask:")
+        if i is not None:
+            self.runInBackground("history", lambda: self.showMask(
+                self.masks.go_to(i)), ())
+
+    def nameMask(self):
+        name, ok = QInputDialog.getText(self, "Masks", "Name of the current mask:",
+                                        text=self.masks.name)
+        if ok:
+            self.masks.rename(unicode(name))
+
+    def unionMask(self):
+        i = self.pickMask("Masks", "Show the current mask or:")
+        if i is not None:
+            self.runInBackground("history", lambda: self.combineMask("union", i), ())
+
+    def intersectMask(self):
+        i = self.pickMask("Masks", "Show the current mask and:")
+        if i is not None:
+            self.runInBackground("history",
+                                 lambda: self.combineMask("intersection", i), ())
+
+    def invertMask(self):
+        if self.lasf_object is not None:
+            self.runInBackground("history",
+                                 lambda: self.combineMask("invert", None), ())
+
+    def combineMask(self, op, i):
+        return self.showMask(self.masks.combine(op, i, self.viewer.n_loaded))
+
+    def lassoSelect(self):
+        self.startSelection("lasso")
+
+    def rectangleSelect(self):
+        self.startSelection("rectangle")
+
+    def startSelection(self, mode):
+        if self.lasf_object is not None:
+            self.viewer.start_selection(mode)
+            self.statusBar().showMessage(
+                "Drag with the left mouse button to select - Esc cancels")
+
+    def onSelection(self, polygon):
+        # Selections refine each other, so none replaces another
+        self.runInBackground("select", lambda: self.applySelection(polygon), ())
+
+    def applySelection(self, polygon):
+        """Keep only the points inside the selection drawn on the viewer."""
+        try:
+            with self.metrics.stage("select"):
+                M = self.viewer.select_screen(polygon)
+            if M is None:
+                return
+            self.log("%d points selected" % M.sum())
+            self.job.check()
+            return self.refineMask("selection", M)
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
                 
+    def setVoxelSize(self):
+        size, ok = QInputDialog.getDouble(self,
+                                          "Voxel thinning",
+                                          "Size of the voxels:",
+                                          self.voxel_size, 1e-6, 1e6, 3)
+        if not ok:
+            return
+        keep, ok = QInputDialog.getItem(self, "Voxel thinning",
+                                        "Point to keep per voxel:",
+                                        list(voxels.KEEP),
+                                        voxels.KEEP.index(self.voxel_keep), False)
+        if ok:
+            self.voxel_size = size
+            self.voxel_keep = str(keep)
+
+    def thinVoxels(self):
+        if self.lasf_object is not None:
+            size, keep = self.voxel_size, self.voxel_keep
+            self.runInBackground("thin", lambda: self.applyThinning(
+                size, keep, "voxels %g (%s)" % (size, keep)), ())
+
+    def removeDuplicates(self):
+        if self.lasf_object is not None:
+            self.runInBackground("thin", self.applyDeduplication, ())
+
+    def applyDeduplication(self):
+        """
+        Show the first of the points shown with the same X, Y, Z records
+        - the integers, as the float32 coordinates of the viewer may be
+        off by more than the scale far from the centre.
+        This can happen in a background thread.
+        """
+        try:
+            X, Y, Z = [self.dimensions.get(dim) for dim in ("X", "Y", "Z")]
+            self.job.check()
+            with self.metrics.stage("duplicates"):
+                M = voxels.unique(X, Y, Z, self.viewer.mask)
+            self.log("%d of %d points kept" % (M.sum(), M.shape[0]))
+            self.job.check()
+            return self.refineMask("no duplicates", M)
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+
+    def applyThinning(self, size, keep, name):
+        """
+        Show one point per voxel of the points shown (the export
+        of the points shown then gives the thinned point set).
+        This can happen in a background thread.
+        """
+        try:
+            M = self.viewer.thin_voxels(size, keep)
+            if M is None:
+                return
+            self.log("%d of %d points kept" % (M.sum(), M.shape[0]))
+            self.job.check()
+            return self.refineMask(name, M)
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+
+    def refineMask(self, name, M):
+        """Show the points of M among those shown - a job result."""
+        if self.viewer.mask is not None:
+            M &= self.viewer.mask
+        self.masks.push(name, M)
+        self.log("Updating view..")
+        return [lambda: self.viewer.set_mask(M)]
+
+    def drawProfile(self):
+        if self.lasf_object is not None and self.viewer.x is not None:
+            self.viewer.start_selection("profile")
+            self.statusBar().showMessage(
+                "Drag a line with the left mouse button - Esc cancels")
+
+    def onProfileLine(self, p0, p1):
+        self.profile_line = (p0[:2], p1[:2])
+        self.runInBackground("profile", self.cutProfile)
+
+    def onProfileShift(self, step):
+        """Move the profile across itself by step widths."""
+        if self.profile_line is None:
+            return
+        p0, p1 = self.profile_line
+        d = p1 - p0
+        length = np.sqrt(d.dot(d))
+        if length > 0:
+            offset = np.array((-d[1], d[0])) / length * self.profile_width * step
+            self.profile_line = (p0 + offset, p1 + offset)
+            self.runInBackground("profile", self.cutProfile)
+
+    def cutProfile(self):
+        """Cut the points of the profile corridor (background thread)."""
+        try:
+            p0, p1 = self.profile_line
+            width = self.profile_width
+            with self.metrics.stage("profile"):
+                along, across, z, colors = self.viewer.cut_profile(p0, p1, width)
+            self.job.check()
+            self.log("%d points in the profile" % along.shape[0])
+            data = (along, across, z, colors, np.sqrt(((p1 - p0) ** 2).sum()))
+            return [lambda: self.showProfile(p0, p1, width, data)]
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+
+    def showProfile(self, p0, p1, width, data):
+        along, across, z, colors, length = data
+        self.viewer.show_corridor(p0, p1, width)
+        p0, p1 = [p + self.viewer.center[:2] for p in (p0, p1)]
+        self.profile_view.set_profile(
+            along, across, z, colors, length, self.viewer.center[2],
+            "(%.2f, %.2f) - (%.2f, %.2f), width: %.2f" % (
+                p0[0], p0[1], p1[0], p1[1], width))
+        self.profile_view.show()
+        self.viewer.update()
+
+    def onPointPicked(self, index):
+        if index is None:
+            self.statusBar().showMessage("No point there")
+            return
+        try:
+            attributes = self.pointAttributes(index)
+        except Exception as e:
+            self.statusBar().showMessage("Could not read point %d: %s" % (index, e))
+            return
+        text = ", ".join("%s: %s" % (name, value) for name, value in attributes)
+        self.statusBar().showMessage(text)
+        self.logInfo("Point %d: %s" % (index, text))
+
     # Other methods
+    def pointAttributes(self, index):
+        """(name, value) of the LAS attributes of a point."""
+        names = ["x", "y", "z", "raw_classification", "intensity",
+                 "return_num", "num_returns", "pt_src_id"]
+        header = self.header
+        if header is not None and not header.compressed:
+            # just the one record
+            records = lasio.map_points(self.filename, header)[index:index + 1]
+            if "red" in records.dtype.names:
+                names += ["red", "green", "blue"]
+            values = [lasio.get_dimension(records, header, name)[0]
+                      for name in names]
+        else:
+            values = [self.dimensions.get(name)[index] for name in names]
+        return [(name, "%.3f" % value if name in ("x", "y", "z") else value)
+                for name, value in zip(names, values)]
+
     def onChangeColorMode(self):
-        if self.lasf_object is not None:
-            self.runInBackground(self._setColorsInBackground)
+        if self.viewer.tileset is not None:
+            # the tiles are colored when loaded, so load them again
+            self.viewer.tileset.unload_all()
+            self.viewer.update()
+        elif self.lasf_object is not None:
+            if (not self.jobs.busy("viewer") and
+                    self.viewer.select_coloring(self.display_dimension)):
+                # Still on the GPU - nothing to compute or upload
+                self.showSource()
+                self.viewer.update_colors()
+            else:
+                self.runInBackground("colors", self.setColors)
 
     def openFile(self, my_file):
-        self.dir = os.path.dirname(my_file)
+        if not copc.is_copc(my_file) or os.path.exists(my_file):
+            self.dir = os.path.dirname(my_file)
         self.log("Opening " + my_file + "...")
-        self.filename = my_file
+        self.profile_line = None
+        self.profile_view.hide()
+        self.stats_view.hide()
+        # a new file makes all pending work on the old one obsolete
+        supersedes = ("load", "tiles", "colors", "mask", "select", "profile",
+                      "history", "thin")
+        if os.path.isdir(my_file) or my_file.lower().endswith((".txt", ".lst")):
+            # a directory of tiles or a list of them
+            kind, open_method = "tiles", self.openTiles
+        elif copc.is_copc(my_file):
+            # nodes are read as they come into view, like tiles
+            kind, open_method = "tiles", self.openCopc
+        else:
+            # When streaming, chunks can be inspected while they arrive.
+            kind, open_method = "load", self.load
+        self.runInBackground(kind, lambda: self.switchFile(my_file, open_method),
+                             supersedes)
+
+    def switchFile(self, my_file, open_method):
+        """
+        Release the current file, then open my_file. The jobs of the
+        viewer run one at a time, so those still using the current file
+        (cancelled, or not superseded) are done by now.
+        """
         if self.lasf_object is not None:  # hmm check destructor
             self.lasf_object.close()
-        self.runInBackground(self._loadInBackground)
-
-    def runInBackground(self, run_method):
-        """
-        Start a background task.
-        finishBackgroundTask should be triggered by an event when done.
-        """
-        self.setEnabled(False)
-        self.err_msg = None  # Nothing bad - yet!
-        thread = threading.Thread(target=run_method)
-        # probably exceptions in the run method should be handled
-        # there in order to avoid a freeze...
-        # Avoud calling GUI methods in thread!
-        thread.start()
-
-    def finishBackgroundTask(self):
-        # This is called from an emmitted event -
-        # the last execution from the run method...
-        self.setEnabled(True)
-        if self.err_msg is not None:
-            # Something went wrong!
-            raise Exception(self.err_msg)
+        self.lasf_object = None
+        self.query = None
+        self.dimensions.clear()
+        self.masks.clear()
+        self.stats = None
+        self.filename = my_file
+        return open_method()
+
+    def runInBackground(self, kind, run_method, supersedes=None):
+        """
+        Queue run_method as a job of the given kind (see jobs.py) - it
+        replaces queued and running jobs of the same kind.
+        finishBackgroundTask is triggered by an event when done.
+        Avoid calling GUI methods in run_method! It may return a list of
+        functions handing its results to the viewer, which
+        finishBackgroundTask calls on the GUI thread.
+        """
+        def run(job):
+            self.job = job
+            self.err_msg = None  # Nothing bad - yet!
+            if profile:
+                path = os.path.join(tempfile.gettempdir(), "lasviewer_%s_%d.prof" %
+                                    (kind, time.time()))
+                result, summary = metrics.profiled(run_method, path)
+                self.logInfo("Profile of %s job saved to %s\n%s" %
+                             (kind, path, summary))
+            else:
+                result = run_method()
+            job.error = self.err_msg
+            return result
+        profile = self.profile_next
+        self.profile_next = False
+        self.jobs.submit(kind, run, "viewer", supersedes)
+        self.updateProgress()
+
+    def progress(self, fraction, text):
+        """
+        Report progress of the running job. Raises jobs.JobCancelled
+        if the job has been cancelled.
+        """
+        self.log(text)
+        self.job.progress(fraction, text)
+
+    def updateProgress(self, job=None):
+        busy = self.jobs.busy()
+        self.progress_bar.setVisible(busy)
+        self.cancel_button.setVisible(busy)
+        if job is None:
+            self.progress_bar.setRange(0, 0)  # just busy
         else:
-            # Everything should have been transfered to the viewer
-            # and we're good to go
-            self.statusBar().showMessage("Source: %s, display dimension: %s" %
-                                         (self.filename, self.display_dimension))
-            self.viewer.update_view()
+            self.progress_bar.setRange(0, 100)
+            self.progress_bar.setValue(int(job.fraction * 100))
+
+    def onJobProgress(self, job):
+        if not job.cancelled:
+            self.updateProgress(job)
 
-    def _setColorsInBackground(self):
-        self.setColors()
-        self.emit(self.background_task_signal)
+    def showSource(self):
+        self.statusBar().showMessage("Source: %s, display dimension: %s" %
+                                     (self.filename, self.display_dimension))
+
+    def finishBackgroundTask(self, job):
+        # This is called on the GUI thread when a job is done - the next
+        # job of the viewer waits for it
+        self.updateProgress()
+        if job.started is not None:
+            self.metrics.record("%s job" % job.kind, job.elapsed)
+        if job.cancelled:
+            self.log("Cancelled")
+            return
+        if job.error is not None:
+            # Something went wrong!
+            raise Exception(job.error)
+        # The results go to the viewer here, between frames
+        for update in job.result or ():
+            update()
+        self.showSource()
+        if job.kind == "load":
+            self.viewer.update_view()
+        elif job.kind == "colors":
+            self.viewer.update_colors()
+        elif job.kind == "tiles":
+            self.viewer.update()
+        elif job.kind == "export":
+            self.statusBar().showMessage("Export done")
+        elif job.kind != "profile":
+            self.viewer.update_mask()
 
     def setColors(self):
         """
         This can happen in a background thread,
         so beware not to call any GUI methods.
+        The coloring goes to the viewer as the result of the job.
         """
         dim = self.display_dimension
 
         try:
+            if self.cache is not None and self.cache.has_coloring(dim):
+                self.log("Reading cached colors")
+                coloring = self.cache.load_coloring(dim)
+                return [lambda: self.viewer.set_coloring(dim, coloring,
+                                                         ordered=True)]
+            ordered = False
+            hist = self.stats.get(dim) if self.stats is not None else None
             if dim == "rgb":
                 self.log("Getting rgb")
-                colors = np.array([getattr(self.lasf_object, color) for color
-                                   in ("red", "green", "blue")]).T.astype(np.float32)
-                _max = np.max(colors)
-                _min = np.min(colors)
-                diff = _max - _min
-                colors -= _min
-                colors /= diff
+                with self.metrics.stage("dimension rgb"):
+                    data = self.dimensions.get("rgb")
+            elif dim == "z":
+                # evaluated on the z coordinates held by the viewer
+                data = self.viewer.z
+                ordered = True
+                if hist is not None:
+                    hist = hist.scaled(1.0, -self.viewer.center[2])
             else:
                 self.log("Getting dimension " + dim)
-                data = getattr(self.lasf_object, dim)
-                self.log("Generating colors...")
-                if dim == "intensity":  # normalise
-                    data = data.astype(np.float32)
-                    data /= data.max()
-                if dim == "raw_classification":
-                    colors = class_to_color(data, CLS_MAP)
-                elif data.dtype == np.float32 or data.dtype == np.float64:
-                    colors = linear_colormap(
-                        data, (0.1, 0.1, 0.1), (0.9, 0.9, 0.9))
-                else:
-                    colors = discrete_dimension_to_color(data, COLOR_LIST)
-            self.viewer.set_colors(colors)
+                with self.metrics.stage("dimension " + dim):
+                    data = self.dimensions.get(dim)
+            self.progress(0.5, "Generating colors...")
+            with self.metrics.stage("colormap " + dim):
+                coloring = dimension_to_coloring(dim, data, use_z=(dim == "z"),
+                                                 hist=hist)
+            self.logInfo(self.dimensions.stats())
+            self.job.check()
+            if not ordered and coloring.values is not None:
+                # to viewer order here, not on the GUI thread
+                coloring.values = coloring.values[self.viewer.order]
+            if self.cache is not None and self.cache.exists():
+                self.cache.save_coloring(dim, coloring)
+            return [lambda: self.viewer.set_coloring(dim, coloring, ordered=True)]
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+        return []
+
+    def openTiles(self):
+        """
+        Index the tiles by their headers. The points are read when
+        the tiles come into view.
+        """
+        self.cache = None
+        try:
+            paths = tiles.tile_paths(self.filename)
+            self.log("Reading %d tile headers..." % len(paths))
+            tileset = tiles.TileSet(paths, self.loadTile, self.viewer.release,
+                                    lambda: self.emit(self.chunk_loaded_signal),
+                                    self.tile_memory_limit, self.onTileError)
+            quantum = min(tile.header.scale.min() for tile in tileset.tiles)
+            self.viewer.set_tiles(tileset)
+            self.logInfo("%d tiles, %d points" % (len(tileset.tiles),
+                                                  tileset.point_count))
+            return [lambda: self.viewer.set_quantum(quantum)]
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+
+    def openCopc(self):
+        """
+        Read the header and the root of the hierarchy of a COPC file (or
+        URL). The nodes are read when they come into view.
+        """
+        self.cache = None
+        try:
+            self.log("Reading the COPC hierarchy...")
+            tileset = copc.CopcSet(self.filename, self.loadCopcNode,
+                                   self.viewer.release,
+                                   lambda: self.emit(self.chunk_loaded_signal),
+                                   self.tile_memory_limit, self.onTileError)
+            self.header = tileset.copc.header
+            quantum = self.header.scale.min()
+            self.viewer.set_tiles(tileset)
+            self.logInfo("COPC, %d points, %d nodes in the root page" %
+                         (tileset.point_count, len(tileset.tiles)))
+            return [lambda: self.viewer.set_quantum(quantum)]
         except Exception as e:
             self.err_msg = traceback.format_exc()
             self.err_msg += "\n" + str(e)
 
-    def _loadInBackground(self):
-        self.load()
-        self.emit(self.background_task_signal)
+    def onTileError(self, message):
+        """Called from the loader thread - the tile is not tried again."""
+        self.emit(self.log_stderr_signal, "Could not load %s" % message)
+
+    def loadCopcNode(self, node):
+        """Called from the loader thread of the COPC set."""
+        tileset = self.viewer.tileset
+        header = tileset.copc.header
+        records = tileset.copc.read_points(node)
+        x, y, z = [lasio.get_dimension(records, header, dim)
+                   for dim in ("x", "y", "z")]
+        return self.viewer.make_tile(x, y, z, self.chunkColors(
+            records, header, self.tileHistogram(tileset)))
+
+    def loadTile(self, tile):
+        """Called from the loader thread of the tile set."""
+        self.log("Loading " + tile.path)
+        records = np.array(lasio.map_points(tile.path, tile.header))
+        x, y, z = [lasio.get_dimension(records, tile.header, dim)
+                   for dim in ("x", "y", "z")]
+        hist = self.tileHistogram(self.viewer.tileset)
+        return self.viewer.make_tile(x, y, z,
+                                     self.chunkColors(records, tile.header, hist))
+
+    def tileHistogram(self, tileset):
+        """
+        The histogram of the display dimension over a sample of the tile
+        set, so that every tile is colored from the same ranges - the
+        range of x, y and z from the headers. Gathered in the loader
+        thread when first needed.
+        """
+        dim = self.display_dimension
+        hist = tileset.histograms.get(dim)
+        if hist is None:
+            with self.metrics.stage("dataset sample " + dim):
+                chunks = (self.dimensionData(records, header, dim)
+                          for records, header in tileset.sample())
+                hist = stats.dimension_histogram(
+                    data for data in chunks if data is not None)
+            if hist is not None and dim in ("x", "y", "z"):
+                i = "xyz".index(dim)
+                hist.lo = min(hist.lo, float(tileset.min[i]))
+                hist.hi = max(hist.hi, float(tileset.max[i]))
+            tileset.histograms[dim] = hist
+        return hist
 
     def load(self):
         """
         This can happen in a background thread,
         so beware not to call any GUI methods.
         """
+        self.cache = None
+        try:
+            self.header = lasio.LasHeader(self.filename)
+        except Exception:
+            self.header = None
+        # LAS coordinates are integers in steps of the scale, so
+        # the viewer can quantize with that without any loss.
+        quantum = self.header.scale.min() if self.header is not None else None
+        updates = [lambda: self.viewer.set_quantum(quantum)]
+        if self.use_cache:
+            try:
+                self.cache = sidecar.SidecarCache(self.filename)
+            except (IOError, OSError):
+                pass
+            if self.loadFromCache():
+                return updates + self.setColors() + self.buildOverview()
+        # The records of LAZ (or unreadable) files can not be mapped and
+        # decoded in parallel - they are left to laspy.
+        if (self.streaming and self.header is not None and
+                not self.header.compressed):
+            self.loadStreaming()
+        else:
+            try:
+                self.lasf_object = lasf.File(self.filename)
+            except Exception as e:
+                self.lasf_object = None
+                self.err_msg = str(e)
+                return
+            else:
+                self.progress(0.0, "Reading points...")
+                # Transfer x, y, z (will reset position)
+                with self.metrics.stage("read points"):
+                    self.viewer.set_points(*[self.readDimension(dim)
+                                             for dim in ("x", "y", "z")])
+                self.readStats()
+        if self.err_msg is None:
+            # first, so that the colors go to the cache as well
+            self.saveToCache()
+            return updates + self.setColors() + self.buildOverview()
+
+    def loadFromCache(self):
+        """
+        Map centred points, octree and colors from the cache.
+        Returns False if there is no (valid) cache entry.
+        """
+        if self.cache is None or not self.cache.exists():
+            return False
         try:
+            self.log("Reading cache...")
+            with self.metrics.stage("cache read"):
+                self.viewer.set_prepared_points(*self.cache.load_points())
             self.lasf_object = lasf.File(self.filename)
         except Exception as e:
-            self.lasf_object = None
-            self.err_msg = str(e)
+            self.log("Could not read cache: %s" % e)
+            return False
+        try:
+            if self.cache.has_stats():
+                self.stats = self.cache.load_stats()
+        except Exception as e:
+            self.log("Could not read cached statistics: %s" % e)
+        if self.stats is None:
+            self.readStats()
+        return True
+
+    def saveToCache(self):
+        if self.cache is None:
             return
-        else:
-            # Transfer x, y, z (will reset position)
-            self.viewer.set_points(self.lasf_object.x,
-                                   self.lasf_object.y,
-                                   self.lasf_object.z)
-            self.setColors()
+        self.log("Writing cache...")
+        try:
+            with self.metrics.stage("cache write"):
+                self.cache.save_points(self.viewer.center, self.viewer.x,
+                                       self.viewer.y, self.viewer.z,
+                                       self.viewer.octree)
+            if self.stats is not None:
+                self.cache.save_stats(self.stats)
+        except Exception as e:
+            self.log("Could not write cache: %s" % e)
+
+    def readStats(self):
+        """
+        Statistics of all dimensions in one pass over the point records -
+        of uncompressed files, which can be mapped.
+        """
+        if self.header is None or self.header.compressed:
+            return
+        try:
+            with self.metrics.stage("statistics"):
+                self.stats = stats.read_stats(self.filename, self.header)
+        except Exception as e:
+            self.log("No statistics: %s" % e)
+
+    def buildOverview(self):
+        """
+        Minimap of the points just loaded, in one pass over them.
+        This can happen in a background thread - the minimap goes to the
+        viewer as a result of the job.
+        """
+        viewer = self.viewer
+        if viewer.x is None:
+            return []
+        try:
+            # usually decoded for the colors already
+            classes = self.dimensions.get("raw_classification")
+        except Exception as e:
+            self.log("No classes for the overview: %s" % e)
+            classes = None
+        try:
+            with self.metrics.stage("overview"):
+                minimap = overview.Overview(viewer.x, viewer.y, viewer.z,
+                                            classes, viewer.order)
+            return [lambda: viewer.set_overview(minimap, CLS_MAP)]
+        except Exception as e:
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+        return []
+
+    def loadStreaming(self):
+        """
+        Read the point records chunk by chunk and hand each chunk
+        to the viewer as it arrives. The colors of the chunks are
+        preliminary (e.g. percentiles of the chunk only) and are
+        replaced by the usual ones when all points are in.
+        """
+        self.lasf_object = None
+        try:
+            header = lasio.LasHeader(self.filename)
+            n = header.point_count
+            # x, y, z are decoded in parallel processes straight into
+            # the (centred, float32) arrays of the viewer
+            xyz, chunks = lasio.decode_parallel(
+                self.filename, ("x", "y", "z"), header,
+                chunk_size=self.chunk_size, origin=(header.min + header.max) * 0.5)
+            self.viewer.begin_points(n, header.min, header.max, xyz)
+            points = lasio.map_points(self.filename, header)
+            # gathered from the records while they are at hand anyway
+            statistics = stats.PointStats(header)
+            t = time.time()
+            for i0, done in chunks:
+                statistics.add(points[i0:done])
+                colors = self.chunkColors(points[i0:done], header)
+                self.viewer.append_prepared(done, colors)
+                self.progress(float(done) / max(n, 1),
+                              "Loading %s: %d of %d points (%d%%)" %
+                              (self.filename, done, n, 100 * done // max(n, 1)))
+                self.emit(self.chunk_loaded_signal)
+            self.metrics.record("stream points", time.time() - t)
+            self.stats = statistics.histograms()
+            self.progress(1.0, "Building octree...")
+            self.viewer.finish_points()
+            self.lasf_object = lasf.File(self.filename)
+        except Exception as e:
+            self.lasf_object = None
+            self.err_msg = traceback.format_exc()
+            self.err_msg += "\n" + str(e)
+
+    def readDimension(self, dim):
+        """
+        Decode a dimension of the current file - in parallel if the
+        point records can be mapped, else through laspy.
+        """
+        header = self.header
+        if (header is not None and not header.compressed and
+                lasio.has_dimension(header, dim)):
+            return lasio.read_dimensions(self.filename, (dim,), header)[0]
+        return getattr(self.lasf_object, dim)
+
+    def dimensionData(self, records, header, dim):
+        if dim == "rgb":
+            if "red" not in records.dtype.names:
+                return None
+            return np.column_stack([records[color] for color
+                                    in ("red", "green", "blue")])
+        return lasio.get_dimension(records, header, dim)
+
+    def chunkColors(self, records, header, hist=None):
+        """hist: of the dimension over all of the data, if known."""
+        dim = self.display_dimension
+        data = self.dimensionData(records, header, dim)
+        if data is None:
+            return np.ones((records.shape[0], 3), dtype=np.float32) * 0.5
+        if hist is not None and hist.exact and data.shape[0] > 0:
+            if data.min() < hist.lo or data.max() > hist.hi:
+                # values missing from a sample - the lookup tables
+                # must cover them
+                hist = stats.combined([hist, stats.dimension_histogram([data])])
+        return dimension_to_coloring(dim, data, hist=hist).colors()
 
     def log(self, text):
         self.emit(self.log_stdout_signal, text)
 
+    def logInfo(self, text):
+        # To the log window, from any thread
+        self.emit(self.log_info_signal, text)
+
     def logDebug(self, text, color="blue"):
         # For logging to logWindow (debug etc...)
         # TODO: use event propagation to capture
@@ -353,10 +1160,12 @@ class LasViewer(QtGui.QMainWindow):
         self.statusBar().showMessage(text)
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1 and os.path.isfile(sys.argv[1]):
+    if len(sys.argv) > 1 and os.path.exists(sys.argv[1]):
         fname = sys.argv[1]
     else:
         fname = None
+    # the decoder processes, before Qt or the job workers start threads
+    lasio.start_pool()
     app = QtGui.QApplication(sys.argv)
     window = LasViewer(fname)
     sys.exit(app.exec_())
@@ -0,0 +1,134 @@
+import threading
+import numpy as np
+
+"""
+History of the masks applied to a pointcloud, for undo / redo.
+Masks are kept compactly: as bits (n / 8 bytes) or as the indices of
+the points shown - or hidden - if there are few of them.
+Not LAS specific.
+"""
+
+
+class PackedMask(object):
+    """A bool mask stored as bits or as sparse indices, whichever is smaller."""
+
+    def __init__(self, mask):
+        self.n = n = mask.shape[0]
+        self.count = int(np.count_nonzero(mask))
+        index_size = 4 if n < 2 ** 32 else 8
+        sizes = {"bits": (n + 7) // 8,
+                 "shown": self.count * index_size,
+                 "hidden": (n - self.count) * index_size}
+        self.encoding = min(sizes, key=lambda k: (sizes[k], k != "bits"))
+        dtype = np.uint32 if index_size == 4 else np.int64
+        if self.encoding == "bits":
+            self.data = np.packbits(mask.view(np.uint8))
+        elif self.encoding == "shown":
+            self.data = np.flatnonzero(mask).astype(dtype)
+        else:
+            self.data = np.flatnonzero(~mask).astype(dtype)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def unpack(self):
+        if self.encoding == "bits":
+            return np.unpackbits(self.data)[:self.n].view(np.bool_)
+        if self.encoding == "shown":
+            mask = np.zeros(self.n, dtype=bool)
+            mask[self.data] = True
+        else:
+            mask = np.ones(self.n, dtype=bool)
+            mask[self.data] = False
+        return mask
+
+
+class MaskHistory(object):
+    """
+    Named masks in the order they were applied. A mask of None shows
+    all points. Pushing a mask drops the entries which were undone.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = [["all points", None]]
+            self.position = 0
+
+    def push(self, name, mask):
+        packed = None if mask is None else PackedMask(mask)
+        with self.lock:
+            del self.entries[self.position + 1:]
+            self.entries.append([name, packed])
+            self.position += 1
+
+    def mask(self, i=None):
+        """The mask of entry i (default the current one) - or None."""
+        with self.lock:
+            packed = self.entries[self.position if i is None else i][1]
+        return None if packed is None else packed.unpack()
+
+    def names(self):
+        with self.lock:
+            return [name for name, packed in self.entries]
+
+    @property
+    def name(self):
+        with self.lock:
+            return self.entries[self.position][0]
+
+    def rename(self, name):
+        with self.lock:
+            self.entries[self.position][0] = name
+
+    def go_to(self, i):
+        """Make entry i current (without dropping any) - returns its mask."""
+        with self.lock:
+            if not 0 <= i < len(self.entries):
+                raise IndexError("No mask %d" % i)
+            self.position = i
+        return self.mask()
+
+    def undo(self):
+        """Step back - returns False if there is nothing to undo."""
+        if self.position == 0:
+            return False
+        self.go_to(self.position - 1)
+        return True
+
+    def redo(self):
+        with self.lock:
+            if self.position + 1 >= len(self.entries):
+                return False
+        self.go_to(self.position + 1)
+        return True
+
+    def combine(self, op, i, n):
+        """
+        Push the current mask combined with entry i, op being "union"
+        or "intersection" - or "invert" (i is ignored) - for n points.
+        """
+        current = self.mask()
+        if current is None:
+            current = np.ones(n, dtype=bool)
+        if op == "invert":
+            name = "not (%s)" % self.name
+            mask = ~current
+        else:
+            other = self.mask(i)
+            if other is None:
+                other = np.ones(n, dtype=bool)
+            symbol = {"union": "|", "intersection": "&"}[op]
+            name = "(%s) %s (%s)" % (self.name, symbol, self.names()[i])
+            mask = current | other if op == "union" else current & other
+        self.push(name, mask)
+        return mask
+
+    def nbytes(self):
+        with self.lock:
+            return sum(packed.nbytes for name, packed in self.entries
+                       if packed is not None)
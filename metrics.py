@@ -0,0 +1,104 @@
+import time
+import threading
+import cProfile
+import pstats
+from collections import deque
+from contextlib import contextmanager
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+"""
+Timings of the pipeline stages and of the frames drawn, plus a
+profiler which can be wrapped around a single job.
+"""
+
+
+class Metrics(object):
+    """
+    Wall time of named stages, e.g.
+        with metrics.stage("octree"):
+            ...
+    on_timing(name, seconds) is called (from the thread running the
+    stage) when a stage is done. The last timing of each stage is kept.
+    """
+
+    def __init__(self, on_timing=None):
+        self.on_timing = on_timing
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - t)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.timings[name] = seconds
+        if self.on_timing is not None:
+            self.on_timing(name, seconds)
+
+
+class FrameStats(object):
+    """
+    Frame rate - from the interval between the starts of successive
+    frames - and the time spent rendering each frame, both averaged over
+    the last window frames. Frames are only drawn when asked for, so
+    gaps longer than idle seconds are not counted as intervals.
+    """
+
+    def __init__(self, window=30, idle=1.0):
+        self.intervals = deque(maxlen=window)
+        self.render_times = deque(maxlen=window)
+        self.idle = idle
+        self.last_start = None
+        self.last = None
+
+    def frame(self, seconds, start=None):
+        """A frame started at start (time.time()) took seconds to render."""
+        if start is None:
+            start = time.time() - seconds
+        if self.last_start is not None and 0 < start - self.last_start <= self.idle:
+            self.intervals.append(start - self.last_start)
+        self.last_start = start
+        self.render_times.append(seconds)
+        self.last = seconds
+
+    @property
+    def frame_time(self):
+        """Average interval between frames."""
+        if not self.intervals:
+            return 0.0
+        return sum(self.intervals) / len(self.intervals)
+
+    @property
+    def render_time(self):
+        if not self.render_times:
+            return 0.0
+        return sum(self.render_times) / len(self.render_times)
+
+    @property
+    def fps(self):
+        frame_time = self.frame_time
+        return 1.0 / frame_time if frame_time > 0 else 0.0
+
+
+def profiled(func, path, lines=25):
+    """
+    Run func under cProfile, save the stats to path and return the
+    result and a summary of the top lines by cumulative time.
+    Only the calling thread is profiled.
+    """
+    profile = cProfile.Profile()
+    try:
+        result = profile.runcall(func)
+    finally:
+        profile.dump_stats(path)
+    out = StringIO()
+    pstats.Stats(profile, stream=out).sort_stats("cumulative").print_stats(lines)
+    return result, out.getvalue()
@@ -0,0 +1,297 @@
+import heapq
+import numpy as np
+
+"""
+Spatial octree for level-of-detail rendering of large pointclouds.
+Not LAS specific - works on plain (centred) x, y, z arrays.
+
+Every node stores its own subsample of the points inside its cube, chosen
+as one point per cell of a regular grid inside the node. The children
+refine that sample, so drawing any subtree which contains the root gives
+a complete - but coarser - picture of the cloud.
+Points are reordered so that each node is a contiguous range, which
+makes it possible to draw a node with a single glDrawArrays call.
+Within a node the points are shuffled, so any prefix of the range is a
+uniform subsample of the node.
+"""
+
+# Bits per axis in the morton codes. 21 * 3 = 63 bits fits in uint64.
+CODE_BITS = 21
+
+
+def _spread_bits(v):
+    """Insert two zero bits between each of the lower 21 bits of v."""
+    v = v.astype(np.uint64) & np.uint64(0x1fffff)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return v
+
+
+def _compact_bits(v):
+    """Inverse of _spread_bits."""
+    v = v.astype(np.uint64) & np.uint64(0x1249249249249249)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v >> np.uint64(32))) & np.uint64(0x1fffff)
+    return v
+
+
+def morton_codes(x, y, z, origin, size, chunk_size=4000000):
+    """
+    Interleaved 3 * CODE_BITS morton codes of the points
+    relative to the cube given by origin and size.
+    """
+    n = x.shape[0]
+    codes = np.empty(n, dtype=np.uint64)
+    scale = (1 << CODE_BITS) / float(size)
+    top = (1 << CODE_BITS) - 1
+    for i0 in range(0, n, chunk_size):
+        i1 = min(n, i0 + chunk_size)
+        c = np.zeros(i1 - i0, dtype=np.uint64)
+        for shift, v, o in ((2, x, origin[0]), (1, y, origin[1]), (0, z, origin[2])):
+            q = np.floor((v[i0:i1] - o) * scale)
+            np.clip(q, 0, top, out=q)
+            c |= _spread_bits(q) << np.uint64(shift)
+        codes[i0:i1] = c
+    return codes
+
+
+def _shuffle_runs(counts, seed=0):
+    """
+    A permutation which shuffles each of the consecutive runs of
+    counts items, leaving the runs in place.
+    """
+    n = int(counts.sum())
+    rng = np.random.RandomState(seed)
+    keys = np.repeat(np.arange(counts.shape[0], dtype=np.uint64) << np.uint64(32),
+                     counts)
+    keys |= rng.randint(0, 1 << 32, n, dtype=np.uint64)
+    return np.argsort(keys)
+
+
+def _run_starts(keys):
+    """Start indices of runs of equal values in a sorted array."""
+    if keys.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+
+
+class Octree(object):
+    """
+    Build an octree over the points x, y, z.
+
+    max_points: A node holding no more than this number of (not yet
+        sampled) points keeps them all and is not subdivided further.
+    grid_bits: Each node samples its points on a 2**grid_bits grid
+        along each axis.
+
+    After construction self.order holds the permutation which brings the
+    input points into node order, i.e. node i is the range
+    self.starts[i]:self.starts[i]+self.counts[i] of x[self.order] etc.
+    """
+
+    def __init__(self, x, y, z, max_points=20000, grid_bits=7):
+        n = x.shape[0]
+        self.grid_bits = grid_bits
+        self.max_depth = CODE_BITS - grid_bits
+        self.n_points = n
+        lo = np.array([x.min(), y.min(), z.min()], dtype=np.float64)
+        hi = np.array([x.max(), y.max(), z.max()], dtype=np.float64)
+        self.size = max(float((hi - lo).max()), 1e-6) * 1.0001
+        self.origin = lo
+        codes = morton_codes(x, y, z, self.origin, self.size)
+        order = np.argsort(codes, kind="mergesort")
+        codes = codes[order]
+        # Assign a level (depth of the node which will draw it) to each point.
+        level = np.full(n, self.max_depth, dtype=np.int8)
+        active = np.arange(n)
+        for d in range(self.max_depth):
+            if active.shape[0] == 0:
+                break
+            c = codes[active]
+            node = c >> np.uint64(3 * (CODE_BITS - d))
+            starts = _run_starts(node)
+            counts = np.diff(np.append(starts, c.shape[0]))
+            take = np.repeat(counts <= max_points, counts)
+            cell = c >> np.uint64(3 * (CODE_BITS - d - grid_bits))
+            take[_run_starts(cell)] = True
+            level[active[take]] = d
+            active = active[~take]
+        del active
+        # Within a level the points are still in morton order, so a stable
+        # sort on level alone makes every node contiguous.
+        by_level = np.argsort(level, kind="mergesort")
+        codes = codes[by_level]
+        level = level[by_level]
+        self.order = order[by_level]
+        if n < 2 ** 31:
+            self.order = self.order.astype(np.int32)
+        del order, by_level
+        depths, node_codes, starts = [], [], []
+        level_starts = np.searchsorted(level, np.arange(self.max_depth + 2))
+        for d in range(self.max_depth + 1):
+            i0, i1 = level_starts[d], level_starts[d + 1]
+            if i0 == i1:
+                continue
+            node = codes[i0:i1] >> np.uint64(3 * (CODE_BITS - d))
+            s = _run_starts(node)
+            depths.append(np.full(s.shape[0], d, dtype=np.int8))
+            node_codes.append(node[s])
+            starts.append(s + i0)
+        self.depth = np.concatenate(depths)
+        self.codes = np.concatenate(node_codes)
+        self.starts = np.concatenate(starts)
+        self.counts = np.diff(np.append(self.starts, n))
+        self.order = self.order[_shuffle_runs(self.counts)]
+        self._build_hierarchy()
+        self._build_boxes()
+
+    # Names of the arrays which fully describe a built tree
+    ARRAYS = ("order", "depth", "codes", "starts", "counts")
+
+    def to_arrays(self):
+        """The tree as a dict of arrays, e.g. for saving with np.save."""
+        arrays = dict((name, getattr(self, name)) for name in self.ARRAYS)
+        arrays["params"] = np.array([self.origin[0], self.origin[1],
+                                     self.origin[2], self.size,
+                                     self.grid_bits, self.n_points])
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Recreate a tree from to_arrays output without rebuilding it."""
+        tree = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(tree, name, arrays[name])
+        params = arrays["params"]
+        tree.origin = np.array(params[:3], dtype=np.float64)
+        tree.size = float(params[3])
+        tree.grid_bits = int(params[4])
+        tree.n_points = int(params[5])
+        tree.max_depth = CODE_BITS - tree.grid_bits
+        tree._build_hierarchy()
+        tree._build_boxes()
+        return tree
+
+    def _build_hierarchy(self):
+        k = self.depth.shape[0]
+        self.parent = np.full(k, -1, dtype=np.int64)
+        # Nodes are sorted by (depth, code), so parents can be found by
+        # a binary search among the nodes one level up.
+        bounds = np.searchsorted(self.depth, np.arange(self.max_depth + 2))
+        for d in range(1, self.max_depth + 1):
+            i0, i1 = bounds[d], bounds[d + 1]
+            p0, p1 = bounds[d - 1], bounds[d]
+            if i0 == i1:
+                continue
+            pcodes = self.codes[i0:i1] >> np.uint64(3)
+            self.parent[i0:i1] = np.searchsorted(self.codes[p0:p1], pcodes) + p0
+        self.children = [[] for _ in range(k)]
+        for i in np.flatnonzero(self.parent >= 0):
+            self.children[self.parent[i]].append(i)
+        self.roots = list(np.flatnonzero(self.parent < 0))
+
+    def _build_boxes(self):
+        cell = self.size / (2.0 ** self.depth.astype(np.float64))
+        ijk = np.column_stack([_compact_bits(self.codes >> np.uint64(s))
+                               for s in (2, 1, 0)]).astype(np.float64)
+        self.box_min = self.origin + ijk * cell[:, None]
+        self.box_max = self.box_min + cell[:, None]
+        self.center = (self.box_min + self.box_max) * 0.5
+        self.radius = cell * (np.sqrt(3.0) * 0.5)
+        # Average distance between the points sampled in a node.
+        self.spacing = cell / (2 ** self.grid_bits)
+
+    def visible_nodes(self, planes):
+        """Frustum test of all node boxes, see boxes_visible."""
+        return boxes_visible(planes, self.box_min, self.box_max)
+
+    def node_errors(self, planes, eye, proj_factor):
+        """
+        Visibility and screen space error (projected point spacing
+        in pixels) of all nodes.
+        """
+        visible = self.visible_nodes(planes)
+        diff = self.center - eye
+        dist = np.sqrt((diff * diff).sum(axis=1)) - self.radius
+        dist = np.maximum(dist, 1e-3)
+        return visible, self.spacing / dist * proj_factor
+
+    def select(self, planes, eye, proj_factor, budget, min_error=1.0,
+               counts=None):
+        """
+        Select the nodes to draw. Starting at the root, visible nodes are
+        refined in order of decreasing screen space error (projected point
+        spacing in pixels) until the point budget is spent or the error
+        of the remaining nodes is below min_error.
+        counts may give the number of points to be drawn per node, if not
+        all of them (e.g. when masking).
+        Returns a list of node indices.
+        """
+        selected = select_nodes([self], planes, eye, proj_factor, budget,
+                                min_error, None if counts is None else [counts])
+        return [i for _, i in selected]
+
+
+def boxes_visible(planes, box_min, box_max):
+    """
+    Frustum test of boxes against planes (6 x 4 array of
+    a, b, c, d with the inside being a*x + b*y + c*z + d >= 0).
+    """
+    visible = np.ones(box_min.shape[0], dtype=bool)
+    for a, b, c, d in planes:
+        # The box corner furthest along the plane normal
+        px = np.where(a >= 0, box_max[:, 0], box_min[:, 0])
+        py = np.where(b >= 0, box_max[:, 1], box_min[:, 1])
+        pz = np.where(c >= 0, box_max[:, 2], box_min[:, 2])
+        visible &= (a * px + b * py + c * pz + d) >= 0
+    return visible
+
+
+def ray_boxes(origin, direction, box_min, box_max):
+    """Which boxes does the ray origin + t * direction, t >= 0, hit?"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv = 1.0 / direction
+        t1 = (box_min - origin) * inv
+        t2 = (box_max - origin) * inv
+        # nan where the ray runs along a box face - ignored
+        t_near = np.nanmax(np.minimum(t1, t2), axis=1)
+        t_far = np.nanmin(np.maximum(t1, t2), axis=1)
+    return t_far >= np.maximum(t_near, 0)
+
+
+def select_nodes(trees, planes, eye, proj_factor, budget, min_error=1.0,
+                 counts=None):
+    """
+    Octree.select for several trees sharing one point budget.
+    Returns a list of (tree index, node index).
+    """
+    if counts is None:
+        counts = [tree.counts for tree in trees]
+    heap = []
+    errors = []
+    for t, tree in enumerate(trees):
+        visible, error = tree.node_errors(planes, eye, proj_factor)
+        errors.append((visible, error))
+        heap.extend((-error[i], t, i) for i in tree.roots if visible[i])
+    heapq.heapify(heap)
+    selected = []
+    used = 0
+    while heap:
+        neg_err, t, i = heapq.heappop(heap)
+        if selected and used + counts[t][i] > budget:
+            break
+        selected.append((t, i))
+        used += counts[t][i]
+        if -neg_err < min_error:
+            continue
+        visible, error = errors[t]
+        for j in trees[t].children[i]:
+            if visible[j]:
+                heapq.heappush(heap, (-error[j], t, j))
+    return selected
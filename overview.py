@@ -0,0 +1,105 @@
+import threading
+import numpy as np
+import colormaps
+
+"""
+Top down overview (minimap) of a pointcloud: per cell of a small raster
+the number of points, the highest z and the most common class - all
+from one pass over the points. Not LAS specific.
+"""
+
+# Cells on the longer side of the raster
+SIZE = 256
+# Classes are counted modulo this
+N_CLASSES = 32
+MODES = ("density", "height", "class")
+# ufunc.at is unbuffered - orders of magnitude slower than a sort - before 1.25
+FAST_UFUNC_AT = np.lib.NumpyVersion(np.__version__) >= "1.25.0"
+
+
+class Overview(object):
+    """
+    Cell (i, j) covers x_min + i * cell ... and y_min + j * cell ...
+    The rasters are ny x nx, row j. classes are optional (in input
+    order if order maps the order of x, y, z to input order).
+    """
+
+    def __init__(self, x, y, z, classes=None, order=None, size=SIZE):
+        n = x.shape[0]
+        self.x_min, x_max = [float(v) for v in colormaps.value_range(x)]
+        self.y_min, y_max = [float(v) for v in colormaps.value_range(y)]
+        self.cell = max(x_max - self.x_min, y_max - self.y_min, 1e-6) / size
+        self.nx = min(int((x_max - self.x_min) / self.cell) + 1, size)
+        self.ny = min(int((y_max - self.y_min) / self.cell) + 1, size)
+        cells = self.nx * self.ny
+        self.counts = np.zeros(cells, dtype=np.int64)
+        self.z_max = np.full(cells, -np.inf, dtype=np.float32)
+        class_counts = None
+        if classes is not None:
+            class_counts = np.zeros(cells * N_CLASSES, dtype=np.int64)
+        key_type = np.uint16 if cells <= (1 << 16) else np.int32
+        lock = threading.Lock()
+
+        def work(i0, i1):
+            i = ((x[i0:i1] - self.x_min) / self.cell).astype(np.int32)
+            j = ((y[i0:i1] - self.y_min) / self.cell).astype(np.int32)
+            np.minimum(i, self.nx - 1, out=i)
+            np.minimum(j, self.ny - 1, out=j)
+            keys = j * self.nx + i
+            counts = np.bincount(keys, minlength=cells)
+            z_max = np.full(cells, -np.inf, dtype=np.float32)
+            if FAST_UFUNC_AT:
+                np.maximum.at(z_max, keys, z[i0:i1])
+            else:
+                # group by cell (a radix sort of 16 bit keys) and reduce
+                # each group
+                by_cell = np.argsort(keys.astype(key_type), kind="stable")
+                occupied = np.flatnonzero(counts)
+                starts = (np.cumsum(counts) - counts)[occupied]
+                z_max[occupied] = np.maximum.reduceat(z[i0:i1][by_cell], starts)
+            if class_counts is not None:
+                cls = classes[i0:i1] if order is None else classes[order[i0:i1]]
+                keys *= N_CLASSES
+                keys += cls % N_CLASSES
+                cls_counts = np.bincount(keys, minlength=cells * N_CLASSES)
+            with lock:
+                self.counts += counts
+                np.maximum(self.z_max, z_max, out=self.z_max)
+                if class_counts is not None:
+                    np.add(class_counts, cls_counts, out=class_counts)
+        colormaps.chunked(n, work)
+        self.dominant = None
+        if class_counts is not None:
+            self.dominant = class_counts.reshape((cells, N_CLASSES)).argmax(axis=1)
+
+    @property
+    def extent(self):
+        """x_min, y_min, width and height of the raster."""
+        return self.x_min, self.y_min, self.nx * self.cell, self.ny * self.cell
+
+    def image(self, mode, class_colors=None):
+        """
+        ny x nx x 3 uint8 image: "density" (log of the counts), "height"
+        (highest z) or "class" (colors of class_colors, a dict of rgb).
+        Empty cells are black.
+        """
+        occupied = self.counts > 0
+        rgb = np.zeros((self.counts.shape[0], 3), dtype=np.float32)
+        if mode == "class" and self.dominant is not None:
+            class_colors = class_colors or {}
+            lut = np.full((N_CLASSES, 3), 0.5, dtype=np.float32)
+            for cls, color in class_colors.items():
+                if 0 <= cls < N_CLASSES:
+                    lut[cls] = color
+            rgb[:] = lut[self.dominant]
+        else:
+            if mode == "height" and occupied.any():
+                values = self.z_max.astype(np.float64)
+                lo = values[occupied].min()
+                t = (values - lo) / max(values[occupied].max() - lo, 1e-6)
+            else:
+                values = np.log1p(self.counts)
+                t = values / max(values.max(), 1e-6)
+            rgb[:] = (0.1 + 0.8 * t)[:, None]
+        rgb[~occupied] = 0
+        return (rgb * 255).astype(np.uint8).reshape((self.ny, self.nx, 3))
@@ -0,0 +1,86 @@
+from PyQt4 import QtGui, QtCore
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+import numpy as np
+
+"""
+A 2D side view of a profile (corridor) cut out of a pointcloud.
+Not LAS specific - takes distances along the profile, heights and colors.
+"""
+
+MARGIN = 30
+
+
+class ProfileView(QDialog):
+    """
+    Points drawn with the distance along the profile to the right and
+    z up, at the same scale. Points nearer to the eye (larger distance
+    across the profile, see gridindex.GridIndex.corridor) are drawn last.
+    Left / right arrows emit shift_signal with -1 / 1, asking to move
+    the slice by its width.
+    """
+
+    def __init__(self, parent):
+        QDialog.__init__(self, parent)
+        self.setWindowTitle("Profile")
+        self.setMinimumSize(800, 300)
+        self.shift_signal = QtCore.SIGNAL("__profile_shift")
+        self.along = None
+        self.z = None
+        self.rgb = None
+        self.length = 0.0
+        self.z_offset = 0.0
+        self.title = ""
+        self._pixels = None
+
+    def set_profile(self, along, across, z, colors, length, z_offset=0.0, title=""):
+        """z + z_offset is the height shown."""
+        order = np.argsort(across)
+        self.along = along[order]
+        self.z = z[order]
+        rgb = (np.clip(colors[order], 0, 1) * 255).astype(np.uint32)
+        self.rgb = 0xff000000 | (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        self.length = float(length)
+        self.z_offset = z_offset
+        self.title = title
+        self.update()
+
+    def render(self):
+        """The points as an image the size of the widget and the z range."""
+        w, h = self.width(), self.height()
+        pixels = np.zeros((h, w), dtype=np.uint32)
+        pixels[:] = 0xff000000
+        if self.along is None or self.along.shape[0] == 0:
+            return pixels, (0.0, 0.0)
+        z_min, z_max = float(self.z.min()), float(self.z.max())
+        scale = min((w - 2 * MARGIN) / max(self.length, 1e-6),
+                    (h - 2 * MARGIN) / max(z_max - z_min, 1e-6))
+        cols = (MARGIN + self.along * scale).astype(np.int64)
+        rows = (h - MARGIN - (self.z - z_min) * scale).astype(np.int64)
+        ok = (cols >= 0) & (cols < w) & (rows >= 0) & (rows < h)
+        # later (nearer) points overwrite earlier ones
+        pixels[rows[ok], cols[ok]] = self.rgb[ok]
+        return pixels, (z_min, z_max)
+
+    def paintEvent(self, event):
+        pixels, (z_min, z_max) = self.render()
+        # keep the pixels alive while the image is drawn
+        self._pixels = pixels
+        image = QImage(pixels.data, pixels.shape[1], pixels.shape[0],
+                       pixels.shape[1] * 4, QImage.Format_RGB32)
+        painter = QPainter(self)
+        painter.drawImage(0, 0, image)
+        painter.setPen(QColor(255, 255, 255))
+        painter.drawText(10, 20, "%s  length: %.2f, z: %.2f - %.2f" % (
+            self.title, self.length, z_min + self.z_offset, z_max + self.z_offset))
+        painter.drawText(10, self.height() - 10,
+                         "Left / right arrow: move the slice")
+        painter.end()
+
+    def keyPressEvent(self, event):
+        if event.key() == QtCore.Qt.Key_Left:
+            self.emit(self.shift_signal, -1)
+        elif event.key() == QtCore.Qt.Key_Right:
+            self.emit(self.shift_signal, 1)
+        else:
+            QDialog.keyPressEvent(self, event)
@@ -5,8 +5,19 @@ from PyQt4.QtOpenGL import *
 import OpenGL.GL as gl
 import OpenGL.GLU as glu
 from OpenGL.arrays import vbo
+from OpenGL.GL import shaders
+from collections import OrderedDict
 import math
+import time
+import copy
 import numpy as np
+import octree
+import colormaps
+import metrics
+import camera
+import selection
+import gridindex
+import voxels
 
 """
 OpenGL pointcloud rendering.
@@ -15,28 +26,401 @@ Generalized - is not LAS specific.
 """
 
 
+# Per point attributes are uploaded in their own (compact) type
+GL_TYPES = {np.dtype(np.uint8): gl.GL_UNSIGNED_BYTE,
+            np.dtype(np.uint16): gl.GL_UNSIGNED_SHORT,
+            np.dtype(np.uint32): gl.GL_UNSIGNED_INT,
+            np.dtype(np.float32): gl.GL_FLOAT}
+
+# Location of the position attribute. Bound to 0, as some drivers will
+# not draw anything unless generic attribute 0 is enabled.
+POSITION_LOCATION = 0
+
+# Colormaps evaluated on the GPU, see colormaps.ScalarColoring.
+# Positions are (quantized) offsets from the origin of their chunk.
+# The scalar is looked up per fragment, as vertex texture fetch is
+# not available everywhere.
+VERTEX_SHADER = """
+#version 120
+attribute vec3 position;
+attribute float value;
+attribute vec3 rgb;
+uniform vec3 origin;
+uniform float quantum;
+uniform bool use_z;
+varying float v_value;
+varying vec3 v_rgb;
+void main() {
+    vec4 p = vec4(origin + quantum * position, 1.0);
+    gl_Position = gl_ModelViewProjectionMatrix * p;
+    v_value = use_z ? p.z : value;
+    v_rgb = rgb;
+}
+"""
+
+FRAGMENT_SHADER = """
+#version 120
+uniform int mode;  // 1: lut, 2: ramp, 3: rgb
+uniform sampler1D lut;
+uniform float lut_size;
+uniform bool cycle;
+uniform float vmin;
+uniform float vscale;
+uniform vec3 color_low;
+uniform vec3 color_high;
+varying float v_value;
+varying vec3 v_rgb;
+void main() {
+    vec3 c;
+    if (mode == 1) {
+        float i = cycle ? mod(v_value, lut_size) : v_value;
+        c = texture1D(lut, (i + 0.5) / lut_size).rgb;
+    } else if (mode == 2) {
+        float t = clamp((v_value - vmin) * vscale, 0.0, 1.0);
+        c = color_low + color_high * t;
+    } else {
+        c = clamp((v_rgb - vmin) * vscale, 0.0, 1.0);
+    }
+    gl_FragColor = vec4(c, 1.0);
+}
+"""
+
+SHADER_MODES = {"lut": 1, "ramp": 2, "rgb": 3}
+
+
+def build_program():
+    """Compile and link the colormap shaders."""
+    program = gl.glCreateProgram()
+    for source, kind in ((VERTEX_SHADER, gl.GL_VERTEX_SHADER),
+                         (FRAGMENT_SHADER, gl.GL_FRAGMENT_SHADER)):
+        gl.glAttachShader(program, shaders.compileShader(source, kind))
+    gl.glBindAttribLocation(program, POSITION_LOCATION, "position")
+    gl.glLinkProgram(program)
+    if gl.glGetProgramiv(program, gl.GL_LINK_STATUS) != gl.GL_TRUE:
+        raise RuntimeError(gl.glGetProgramInfoLog(program))
+    return program
+
+
 class VBOProvider(object):
+    """
+    Upload x, y, z (and colors, if given) in chunks of roughly vbsize
+    points. The points are grouped in nodes given by node_starts and
+    node_counts (e.g. from an octree) and no node is split between two
+    VBOs, so that any node can be drawn on its own. A new chunk is also
+    started at each node index in breaks.
 
-    def __init__(self, x, y, z, colors):
+    If generic is True, positions go to the shader attribute at
+    POSITION_LOCATION instead of glVertexPointer. With a quantum they are
+    then stored as uint16 (or uint32, if the chunk is too large) steps of
+    quantum from the minimum corner of the chunk - see chunk_origin. Else
+    as float32 with a zero origin.
+    If use_vaos is True, the attribute setup of each chunk is kept in
+    a vertex array object.
+    """
+
+    def __init__(self, x, y, z, colors=None, node_starts=None, node_counts=None,
+                 generic=False, quantum=None, breaks=None, use_vaos=False):
         n = x.shape[0]
-        i0 = 0
         vbsize = 2000000
+        if node_starts is None:
+            node_starts = np.arange(0, n, vbsize)
+            node_counts = np.diff(np.append(node_starts, n))
+        breaks = np.zeros(0, dtype=np.int64) if breaks is None else np.asarray(breaks)
+        self.node_vbo = np.zeros(node_starts.shape[0], dtype=np.int32)
+        self.node_offset = np.zeros(node_starts.shape[0], dtype=np.int64)
+        self.node_starts = node_starts
+        self.node_counts = node_counts
+        self.has_colors = colors is not None
+        self.generic = generic
+        self.quantum = 1.0 if quantum is None else float(quantum)
+        self.use_vaos = use_vaos
         self.vbos = []
-        while i0 < n:
-            i1 = min(n, i0 + vbsize)
-            data = np.column_stack((x[i0:i1], y[i0:i1], z[i0:i1], colors[i0:i1])).astype(np.float32)
-            vbo_ = vbo.VBO(data=data, usage=gl.GL_DYNAMIC_DRAW,
-                           target=gl.GL_ARRAY_BUFFER)
+        # the range of the input arrays and of the nodes held by each VBO
+        self.ranges = []
+        self.chunk_nodes = []
+        # per chunk: origin, gl type of positions and stride
+        self.chunk_origin = []
+        self.chunk_format = []
+        self.nbytes = 0
+        self._vaos = {}
+        k = 0
+        while k < node_starts.shape[0]:
+            i0 = node_starts[k]
+            # last node which still starts inside this chunk
+            k1 = max(np.searchsorted(node_starts, i0 + vbsize), k + 1)
+            b = np.searchsorted(breaks, k, side="right")
+            if b < breaks.shape[0]:
+                k1 = min(k1, max(breaks[b], k + 1))
+            i1 = node_starts[k1 - 1] + node_counts[k1 - 1]
+            origin = (0.0, 0.0, 0.0)
+            fmt = (gl.GL_FLOAT, 12)
+            if i1 > i0:
+                columns = [x[i0:i1], y[i0:i1], z[i0:i1]]
+                if quantum is not None:
+                    data, origin, fmt = self._quantize(columns, self.quantum)
+                else:
+                    if self.has_colors:
+                        columns.append(colors[i0:i1])
+                        fmt = (gl.GL_FLOAT, 24)
+                    data = np.column_stack(columns).astype(np.float32)
+                vbo_ = vbo.VBO(data=data, usage=gl.GL_DYNAMIC_DRAW,
+                               target=gl.GL_ARRAY_BUFFER)
+                self.nbytes += data.nbytes
+            else:
+                vbo_ = None  # only empty (masked out) nodes
+            self.node_vbo[k:k1] = len(self.vbos)
+            self.node_offset[k:k1] = node_starts[k:k1] - i0
             self.vbos.append((vbo_, i1 - i0))
-            i0 += vbsize
+            self.ranges.append((i0, i1))
+            self.chunk_nodes.append((k, k1))
+            self.chunk_origin.append(origin)
+            self.chunk_format.append(fmt)
+            k = k1
 
-    def draw(self):
-        for vbo_, n in self.vbos:
-            vbo_.bind()
-            gl.glVertexPointer(3, gl.GL_FLOAT, 24, vbo_)
-            gl.glColorPointer(3, gl.GL_FLOAT, 24, vbo_ + 12)
-            gl.glDrawArrays(gl.GL_POINTS, 0, n)
-            vbo_.unbind()
+    @staticmethod
+    def _quantize(columns, quantum):
+        origin = tuple(float(c.min()) for c in columns)
+        steps = max(float(c.max()) - o for c, o in zip(columns, origin)) / quantum
+        if steps < (1 << 16) - 1:
+            # pad to 4 components to keep vertices 4 byte aligned
+            dtype, fmt = np.uint16, (gl.GL_UNSIGNED_SHORT, 8)
+        else:
+            dtype, fmt = np.uint32, (gl.GL_UNSIGNED_INT, 12)
+        data = np.zeros((columns[0].shape[0], fmt[1] // np.dtype(dtype).itemsize),
+                        dtype=dtype)
+        for i, (c, o) in enumerate(zip(columns, origin)):
+            data[:, i] = np.round((c - o) / quantum)
+        return data, origin, fmt
+
+    def draw(self, nodes=None, attributes=(), origin_location=None, mask=None,
+             fraction=1.0):
+        """
+        Draw all points, or only the given nodes. attributes is a list of
+        (location, AttributeBuffers) of generic vertex attributes to bind.
+        The chunk origin is set in the uniform at origin_location.
+        Only the points of a MaskBuffers mask are drawn, if given.
+        With a fraction below 1 only that share of the points of each
+        node is drawn - a uniform subsample, as the octree shuffles the
+        points of its nodes.
+        Returns the number of points drawn.
+        """
+        if nodes is None:
+            nodes = [i for i in range(self.node_counts.shape[0])]
+        drawn = 0
+        nodes = sorted(nodes, key=lambda i: self.node_vbo[i])
+        current = None
+        for i in nodes:
+            count = self.node_counts[i]
+            visible = count if mask is None else mask.node_visible[i]
+            if visible == 0:
+                continue
+            k = self.node_vbo[i]
+            if k != current:
+                self._bind(k, attributes)
+                if origin_location is not None:
+                    gl.glUniform3f(origin_location, *self.chunk_origin[k])
+                current = k
+            n = visible if fraction >= 1 else int(math.ceil(visible * fraction))
+            if visible == count:
+                gl.glDrawArrays(gl.GL_POINTS, int(self.node_offset[i]), n)
+            else:
+                ebo = mask.ebos[k]
+                ebo.bind()
+                gl.glDrawElements(gl.GL_POINTS, n, gl.GL_UNSIGNED_INT,
+                                  ebo + int(mask.node_index_offset[i]) * 4)
+                ebo.unbind()
+            drawn += n
+        self._unbind(attributes)
+        return drawn
+
+    def _bind(self, k, attributes):
+        if self.use_vaos:
+            key = tuple((location, buffers.serial) for location, buffers in attributes)
+            vao, old_key = self._vaos.get(k, (None, None))
+            if vao is None:
+                vao = gl.glGenVertexArrays(1)
+            gl.glBindVertexArray(vao)
+            if key != old_key:
+                self._set_pointers(k, attributes)
+                self._vaos[k] = (vao, key)
+        else:
+            self._set_pointers(k, attributes)
+
+    def _set_pointers(self, k, attributes):
+        vbo_ = self.vbos[k][0]
+        gltype, stride = self.chunk_format[k]
+        vbo_.bind()
+        if self.generic:
+            gl.glEnableVertexAttribArray(POSITION_LOCATION)
+            gl.glVertexAttribPointer(POSITION_LOCATION, 3, gltype,
+                                     gl.GL_FALSE, stride, vbo_)
+        else:
+            gl.glVertexPointer(3, gl.GL_FLOAT, stride, vbo_)
+            if self.has_colors:
+                gl.glColorPointer(3, gl.GL_FLOAT, stride, vbo_ + 12)
+        vbo_.unbind()
+        for location, buffers in attributes:
+            gl.glEnableVertexAttribArray(location)
+            buffers.bind(k, location)
+
+    def _unbind(self, attributes):
+        if self.use_vaos:
+            gl.glBindVertexArray(0)
+            return
+        if self.generic:
+            gl.glDisableVertexAttribArray(POSITION_LOCATION)
+        for location, _ in attributes:
+            gl.glDisableVertexAttribArray(location)
+
+    @property
+    def n_buffers(self):
+        return sum(1 for vbo_, _ in self.vbos if vbo_ is not None)
+
+    def delete(self):
+        for vbo_, _ in self.vbos:
+            if vbo_ is not None:
+                vbo_.delete()
+        for vao, _ in self._vaos.values():
+            gl.glDeleteVertexArrays(1, [vao])
+        self._vaos = {}
+
+
+class MaskBuffers(object):
+    """
+    A mask (bool per point, in the order of the points of a
+    VBOProvider) as element index buffers. Nodes which are fully visible
+    or fully hidden need no indices, so only partially visible nodes
+    cost memory - 4 bytes per visible point.
+    Given the buffers of the previous mask of the same provider, the
+    index buffers of chunks where the mask did not change are taken over.
+    """
+
+    def __init__(self, provider, mask, previous=None, previous_mask=None):
+        if previous is not None and (previous.provider is not provider or
+                                     previous_mask is None):
+            previous = None
+        self.provider = provider
+        m = mask.view(np.uint8)
+        counts = provider.node_counts
+        self.node_visible = np.add.reduceat(m, provider.node_starts,
+                                            dtype=np.int64) if counts.shape[0] else counts
+        partial = (self.node_visible > 0) & (self.node_visible < counts)
+        self.node_index_offset = np.zeros(counts.shape[0], dtype=np.int64)
+        self.ebos = []
+        self.sizes = []
+        self.nbytes = 0
+        self.reused = 0
+        for c, ((i0, i1), (k0, k1)) in enumerate(zip(provider.ranges,
+                                                     provider.chunk_nodes)):
+            if (previous is not None and
+                    np.array_equal(mask[i0:i1], previous_mask[i0:i1])):
+                self.ebos.append(previous.ebos[c])
+                self.sizes.append(previous.sizes[c])
+                self.node_index_offset[k0:k1] = previous.node_index_offset[k0:k1]
+                self.nbytes += previous.sizes[c]
+                previous.ebos[c] = None  # taken over
+                self.reused += 1
+                continue
+            if not partial[k0:k1].any():
+                self.ebos.append(None)
+                self.sizes.append(0)
+                continue
+            sel = np.repeat(partial[k0:k1], counts[k0:k1])
+            sel &= mask[i0:i1]
+            indices = np.flatnonzero(sel).astype(np.uint32)
+            visible = np.where(partial[k0:k1], self.node_visible[k0:k1], 0)
+            self.node_index_offset[k0:k1] = np.cumsum(visible) - visible
+            self.ebos.append(vbo.VBO(data=indices, usage=gl.GL_STATIC_DRAW,
+                                     target=gl.GL_ELEMENT_ARRAY_BUFFER))
+            self.sizes.append(indices.nbytes)
+            self.nbytes += indices.nbytes
+
+    @property
+    def n_buffers(self):
+        return sum(1 for ebo in self.ebos if ebo is not None)
+
+    def delete(self):
+        for ebo in self.ebos:
+            if ebo is not None:
+                ebo.delete()
+
+
+class AttributeBuffers(object):
+    """
+    A per point attribute (n or n x k values) uploaded in the
+    same chunks as the points of a VBOProvider.
+    """
+
+    _count = 0
+
+    def __init__(self, provider, values):
+        # identifies the buffers in VAOs
+        AttributeBuffers._count += 1
+        self.serial = AttributeBuffers._count
+        if values.dtype not in GL_TYPES:
+            values = values.astype(np.float32)
+        self.size = 1 if values.ndim == 1 else values.shape[1]
+        self.gltype = GL_TYPES[values.dtype]
+        self.nbytes = values.nbytes
+        self.vbos = []
+        for i0, i1 in provider.ranges:
+            if i1 > i0:
+                self.vbos.append(vbo.VBO(
+                    data=np.ascontiguousarray(values[i0:i1]),
+                    usage=gl.GL_STATIC_DRAW, target=gl.GL_ARRAY_BUFFER))
+            else:
+                self.vbos.append(None)
+
+    def bind(self, k, location):
+        vbo_ = self.vbos[k]
+        vbo_.bind()
+        gl.glVertexAttribPointer(location, self.size, self.gltype,
+                                 gl.GL_FALSE, 0, vbo_)
+        vbo_.unbind()
+
+    @property
+    def n_buffers(self):
+        return sum(1 for vbo_ in self.vbos if vbo_ is not None)
+
+    def delete(self):
+        for vbo_ in self.vbos:
+            if vbo_ is not None:
+                vbo_.delete()
+
+
+class TileData(object):
+    """The octree and vertex buffers of a loaded tile."""
+
+    def __init__(self, tree, buffer):
+        self.tree = tree
+        self.buffer = buffer
+        self.nbytes = buffer.nbytes
+
+    def delete(self):
+        self.buffer.delete()
+
+
+def clip_matrix(projection, modelview):
+    """
+    The 4 x 4 matrix taking points to clip coordinates, from the OpenGL
+    projection and modelview matrices (as returned by glGetDoublev).
+    """
+    P = np.array(projection, dtype=np.float64).reshape((4, 4)).T
+    M = np.array(modelview, dtype=np.float64).reshape((4, 4)).T
+    return P.dot(M)
+
+
+def frustum_planes(projection, modelview):
+    """
+    Extract the six clipping planes (a, b, c, d) from the
+    OpenGL projection and modelview matrices (as returned by glGetDoublev).
+    """
+    C = clip_matrix(projection, modelview)
+    planes = np.array([C[3] + C[0], C[3] - C[0],
+                       C[3] + C[1], C[3] - C[1],
+                       C[3] + C[2], C[3] - C[2]])
+    norms = np.sqrt((planes[:, :3] ** 2).sum(axis=1))
+    return planes / norms[:, None]
 
 
 class PointcloudViewerWidget(QGLWidget):
@@ -52,11 +436,12 @@ class PointcloudViewerWidget(QGLWidget):
         self.setFocusPolicy(Qt.StrongFocus)
         self.parent = parent
         self.initial_z = 1500.0
-        # The far and near z clipping planes -
-        # we should be able to change these at some point, e.g. for
-        # 'galaxies'
+        # The far and near z clipping planes - set from the extent of
+        # the data in set_extent
         self.far_z = 3000.0
         self.near_z = 0.01
+        # set when the planes change, the projection is set in paintGL
+        self.projection_stale = False
         # Initial locations and camera position
         self.location = np.array([0.0, 0.0, self.initial_z])
         self.focus = np.array([0.0, 0.0, 0.0])
@@ -79,7 +464,87 @@ class PointcloudViewerWidget(QGLWidget):
         self.y = None
         self.z = None
         self.colors = None
+        # ... or give a colormap to be evaluated on the GPU. Values of
+        # colormaps are kept (in viewer order) for the most recently
+        # used dimensions, and so are their buffers on the GPU.
+        self.colorings = OrderedDict()
+        self.coloring_name = None
+        self.attributes = OrderedDict()
+        self.max_resident_colorings = 4
+        self.shader = None
+        self.has_vaos = False
+        # Positions are quantized in steps of quantum on the GPU (at least
+        # the float32 resolution) - e.g. the scale of LAS coordinates.
+        self.quantum = None
+        self._uniforms = {}
+        self._lut_texture = None
+        self._lut_coloring = None
+        self._stale_buffers = []
+        self.view_mask = None  # self.mask in viewer order, as drawn
+        self.mask_buffers = None
         self.mask = None  # We can mask points ...
+        # Level of detail: the octree reorders the points, self.order maps
+        # viewer order to input order. Only point_budget points are drawn.
+        self.octree = None
+        self.order = None
+        self.point_budget = 5000000
+        self.points_drawn = 0
+        # While streaming points in, each appended chunk gets its own VBOs
+        # which are drawn as they are until the octree has been built.
+        self.stream_buffers = []
+        self.n_loaded = 0
+        # The points are loaded in worker threads, but swapped in on the
+        # GUI thread, between frames - see on_gui_thread.
+        self.swap_signal = QtCore.SIGNAL("__swap")
+        QtCore.QObject.connect(self, self.swap_signal, lambda func: func(),
+                               Qt.BlockingQueuedConnection)
+        # ... or a tiles.TileSet, which loads the tiles in view by itself
+        self.tileset = None
+        self.fov = camera.FOV
+        # Timings of the stages here, and of the frames (shown with the
+        # stats overlay)
+        self.metrics = metrics.Metrics()
+        self.frame_stats = metrics.FrameStats()
+        self.show_stats = False
+        # Progressive refinement: while the camera moves, only a fraction
+        # of the selected points is drawn - adapted to the measured draw
+        # rate to stay near target_frame_time. The rest is filled in over
+        # the next frames once the camera has been still for a moment.
+        self.target_frame_time = 1 / 30.0
+        self.draw_fraction = 1.0
+        self.moving = False
+        self.points_per_second = None
+        self.idle_timer = QtCore.QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.setInterval(200)
+        self.idle_timer.timeout.connect(self.on_idle)
+        # Picking: the view and nodes of the last frame, and the point
+        # picked (in viewer coordinates) which is highlighted.
+        self.point_picked_signal = QtCore.SIGNAL("__point_picked")
+        self.clip = None
+        self.proj_factor = 1.0
+        self.drawn_nodes = []
+        self.picked = None
+        # Selection: while selection_mode is "lasso" or "rectangle" a drag
+        # with the left button draws the outline (in window pixels), which
+        # is emitted as a selection.ScreenPolygon on release.
+        self.selection_signal = QtCore.SIGNAL("__selection")
+        self.selection_mode = None
+        self.outline = []
+        # Profiles: a "profile" selection is a line, which is emitted as
+        # its end points (viewer coordinates, on the plane z = 0) with
+        # profile_signal. The corridor last cut is outlined in the view.
+        # The 2D grid to cut them with is built on first use.
+        self.profile_signal = QtCore.SIGNAL("__profile")
+        self.corridor = None
+        self.grid = None
+        # Overview: an overview.Overview shown as a minimap in the lower
+        # right corner (unless overview_mode is None) - click to go there.
+        self.overview = None
+        self.overview_mode = "density"
+        self.class_colors = None
+        self._overview_texture = None
+        self._overview_image = None
         # Appearence
         self.setMinimumSize(600, 600)
 
@@ -106,56 +571,424 @@ class PointcloudViewerWidget(QGLWidget):
             self.update()
             self.setFocus()
 
+    def camera_changed(self):
+        """Redraw after a camera move - coarsely, if drawing is slow."""
+        self.moving = True
+        self.idle_timer.start()
+        self.update()
+
+    def on_idle(self):
+        self.moving = False
+        self.update()
+
+    def adapt_fraction(self, seconds):
+        """Adapt draw_fraction to the time it took to draw points_drawn."""
+        if self.points_drawn == 0 or seconds <= 0:
+            return
+        rate = self.points_drawn / seconds
+        if self.points_per_second is None:
+            self.points_per_second = rate
+        else:
+            self.points_per_second = 0.7 * self.points_per_second + 0.3 * rate
+        selected = self.points_drawn / self.draw_fraction
+        wanted = self.points_per_second * self.target_frame_time
+        self.draw_fraction = min(max(wanted / selected, 0.01), 1.0)
+
+    def toggle_stats(self):
+        self.show_stats = not self.show_stats
+        self.update()
+        self.setFocus()
+
+    def set_point_budget(self, budget):
+        self.point_budget = max(int(budget), 1)
+        self.update()
+        self.setFocus()
+
+    def on_gui_thread(self, func):
+        """
+        Call func on the GUI thread and wait for it - to change what
+        paintGL draws from a worker without a frame seeing half of it.
+        """
+        if QtCore.QThread.currentThread() == self.thread():
+            func()
+        else:
+            self.emit(self.swap_signal, func)
+
     def set_points(self, x, y, z):
         """
         Input will (probably) be float64 arrays.
         Subtract mean and store as float32.
+        The points are stored in octree order, see self.order.
         """
         # The center in real coordinates
-        self.center[0] = x.mean()
-        self.center[1] = y.mean()
-        self.center[2] = z.mean()
+        center = np.array([x.mean(), y.mean(), z.mean()])
         # store as float32
-        self.x = (x-self.center[0]).astype(np.float32)
-        self.y = (y-self.center[1]).astype(np.float32)
-        self.z = (z-self.center[2]).astype(np.float32)
+        x = (x - center[0]).astype(np.float32)
+        y = (y - center[1]).astype(np.float32)
+        z = (z - center[2]).astype(np.float32)
+        tree, x, y, z = self.build_octree(x, y, z)
         # Check how much we need to move 'up'
-        r = max(self.x.max(), self.y.max())
-        self.initial_z = r * 1.5
+        r = max(x.max(), y.max())
+
+        def swap():
+            self.clear_buffers()
+            self.center[:] = center
+            self.x, self.y, self.z = x, y, z
+            self.octree, self.order = tree, tree.order
+            self.n_loaded = x.shape[0]
+            self.stream_buffers = []
+            self.set_extent(r)
+        self.on_gui_thread(swap)
+
+    def begin_points(self, n, lo, hi, arrays=None):
+        """
+        Prepare for receiving n points chunk by chunk via append_points.
+        As the mean is not known yet, the points are centred on the
+        middle of the bounding box lo, hi (e.g. from a LAS header).
+        Or give the x, y, z float32 arrays which the caller fills in
+        (already centred) - see append_prepared.
+        """
+        lo = np.asarray(lo, dtype=np.float64)
+        hi = np.asarray(hi, dtype=np.float64)
+        if arrays is None:
+            arrays = [np.empty(n, dtype=np.float32) for i in range(3)]
+
+        def swap():
+            self.clear_buffers()
+            self.octree = None
+            self.order = None
+            self.mask = None
+            self.stream_buffers = []
+            self.n_loaded = 0
+            self.center[:] = (lo + hi) * 0.5
+            self.x, self.y, self.z = arrays
+            self.set_extent(max(hi[0] - lo[0], hi[1] - lo[1]) * 0.5)
+        self.on_gui_thread(swap)
+
+    def append_points(self, x, y, z, colors):
+        """
+        Add a chunk of points (real coordinates) and colors.
+        The chunk will be drawn as soon as the viewer is updated.
+        """
+        i0 = self.n_loaded
+        i1 = i0 + x.shape[0]
+        self.x[i0:i1] = x - self.center[0]
+        self.y[i0:i1] = y - self.center[1]
+        self.z[i0:i1] = z - self.center[2]
+        self.append_prepared(i1, colors)
+
+    def append_prepared(self, i1, colors):
+        """
+        Like append_points for points which the caller has written
+        to self.x, y and z up to i1.
+        """
+        i0 = self.n_loaded
+        buffer = VBOProvider(self.x[i0:i1], self.y[i0:i1], self.z[i0:i1], colors)
+
+        def swap():
+            self.stream_buffers.append(buffer)
+            self.n_loaded = i1
+        self.on_gui_thread(swap)
+
+    def finish_points(self):
+        """Called when all points have been appended."""
+        n = self.n_loaded
+        tree, x, y, z = self.build_octree(self.x[:n], self.y[:n], self.z[:n])
+
+        def swap():
+            self.x, self.y, self.z = x, y, z
+            self.octree, self.order = tree, tree.order
+            self.grid = None
+        self.on_gui_thread(swap)
+
+    def set_prepared_points(self, center, x, y, z, tree):
+        """
+        Take over points which have already been centred and put
+        in octree order (e.g. memory mapped from a cache).
+        """
+        def swap():
+            self.clear_buffers()
+            self.mask = None
+            self.stream_buffers = []
+            self.center[:] = center
+            self.x, self.y, self.z = x, y, z
+            self.n_loaded = x.shape[0]
+            self.octree = tree
+            self.order = tree.order
+            self.set_extent(max(tree.box_max[0, 0], tree.box_max[0, 1]))
+        self.on_gui_thread(swap)
+
+    def set_tiles(self, tileset):
+        """
+        Show a tiles.TileSet. Tiles are made with make_tile and
+        are drawn as they get loaded.
+        """
+        def swap():
+            self.clear_buffers()
+            self.x = self.y = self.z = None
+            self.octree = None
+            self.order = None
+            self.mask = None
+            self.stream_buffers = []
+            self.center[:] = tileset.origin
+            self.n_loaded = tileset.point_count
+            self.tileset = tileset
+            extent = tileset.max - tileset.min
+            self.set_extent(max(extent[0], extent[1]) * 0.5)
+        self.on_gui_thread(swap)
+
+    def make_tile(self, x, y, z, colors):
+        """
+        Octree and VBOs of the points (real coordinates) and colors of
+        a tile, centred like the rest of the tile set.
+        This can happen in a background thread.
+        """
+        x = (x - self.center[0]).astype(np.float32)
+        y = (y - self.center[1]).astype(np.float32)
+        z = (z - self.center[2]).astype(np.float32)
+        tree = octree.Octree(x, y, z)
+        order = tree.order
+        colors = colors[order].astype(np.float32)
+        buffer = VBOProvider(x[order], y[order], z[order], colors,
+                             tree.starts, tree.counts)
+        return TileData(tree, buffer)
+
+    def has_points(self):
+        return self.x is not None or self.tileset is not None
+
+    def build_octree(self, x, y, z):
+        """The octree of the points and the points in its order."""
+        with self.metrics.stage("octree"):
+            tree = octree.Octree(x, y, z)
+            order = tree.order
+            return tree, x[order], y[order], z[order]
+
+    def clear_buffers(self):
+        """Forget everything derived from the current points."""
+        self.release(self.data_buffer)
+        self.data_buffer = None
+        self.release(self.mask_buffers)
+        self.mask_buffers = None
+        self.view_mask = None
+        for buffers in self.attributes.values():
+            self.release(buffers)
+        self.attributes.clear()
+        self.colorings.clear()
+        self.coloring_name = None
+        self.colors = None
+        self.drawn_nodes = []
+        self.picked = None
+        self.grid = None
+        self.corridor = None
+        self.overview = None
+        if self.tileset is not None:
+            self.tileset.close()
+            self.tileset = None
+
+    def set_extent(self, r):
+        """Set up initial camera position from the radius of the cloud."""
         # The location in viewer coordinates
-        self.location = np.array([0.0, 0.0, self.initial_z])
+        self.location = camera.preset("top", r)[0]
+        self.initial_z = self.location[2]
         self.movement_granularity = max(r / 500.0 * 6, 1)
         # Position in real coordinates
         self.real_pos = self.location + self.center
+        # Far enough to see all of the cloud from well outside it - the
+        # near plane at the ratio of the defaults, for the depth buffer.
+        # May be called from a worker: no GL here.
+        self.far_z = max(10.0 * r, 1.0)
+        self.near_z = self.far_z / 300000.0
+        self.projection_stale = True
 
-    def set_colors(self, colors):
-        self.colors = colors.astype(np.float32)
+    def set_colors(self, colors, ordered=False):
+        """
+        Colors are given in input order - or in viewer order
+        if ordered is True, in which case they are used as they are.
+        """
+        if ordered:
+            self.colors = colors
+        else:
+            self.colors = colors[self.order].astype(np.float32)
+        self.coloring_name = None
+
+    def set_quantum(self, quantum):
+        self.quantum = quantum
+
+    def gpu_quantum(self):
+        """The quantum used for positions on the GPU."""
+        tree = self.octree
+        extent = max(np.abs(tree.box_min[tree.roots]).max(),
+                     np.abs(tree.box_max[tree.roots]).max())
+        return max(self.quantum or 0.0, float(extent) * 2 ** -23)
+
+    def set_coloring(self, name, coloring, ordered=False):
+        """
+        Color by a colormaps.ScalarColoring. With shaders only its values
+        are uploaded - and only if they are not on the GPU already.
+        Call update_colors afterwards.
+        """
+        if coloring.values is not None and not ordered:
+            coloring.values = coloring.values[self.order]
+        self.colorings.pop(name, None)
+        self.colorings[name] = coloring  # most recently used last
+        self.release(self.attributes.pop(name, None))
+        while len(self.colorings) > self.max_resident_colorings:
+            evicted = next(iter(self.colorings))
+            del self.colorings[evicted]
+            self.release(self.attributes.pop(evicted, None))
+        self.coloring_name = name
+        self.colors = None
+
+    def select_coloring(self, name):
+        """
+        Switch to a coloring which has been set before. Returns False
+        if it is no longer kept.
+        """
+        if name not in self.colorings:
+            return False
+        self.colorings[name] = self.colorings.pop(name)
+        self.coloring_name = name
+        self.colors = None
+        return True
+
+    def release(self, buffers):
+        """
+        Delete GPU buffers next time the GL context is current - this
+        may be called from any thread.
+        """
+        if buffers is not None:
+            self._stale_buffers.append(buffers)
+
+    def update_colors(self):
+        """
+        Show the current coloring. Without shaders, colors are computed
+        here and the view is regenerated.
+        """
+        if self.shader is None and self.coloring_name is not None:
+            self.update_view()
+        else:
+            self.update()
+            self.setFocus()
 
     def update_view(self):
         """
-        Regenerate VBOs. If self.mask is not None, perform a prefiltering.
-        Note, this may consume more memory.
+        Regenerate VBOs. A mask is applied via update_mask.
+        """
+        t = time.time()
+        starts, counts = self.octree.starts, self.octree.counts
+        colors = None
+        if self.coloring_name is None and self.colors is not None:
+            if self.shader is not None:
+                # plain colors go to the GPU as normalized uint8 rgb
+                self.set_coloring("colors", colormaps.ScalarColoring(
+                    "rgb", colormaps.colors_to_uint8(self.colors),
+                    vscale=1 / 255.0), ordered=True)
+            else:
+                colors = self.colors
+        elif self.shader is None:
+            coloring = self.colorings[self.coloring_name]
+            self.colors = coloring.colors(z=self.z)
+            colors = self.colors
+        x, y, z = self.x, self.y, self.z
+        self.release(self.data_buffer)
+        for buffers in self.attributes.values():
+            self.release(buffers)
+        self.attributes.clear()
+        if self.shader is not None:
+            # start new chunks at each new depth, so that the chunks of
+            # the deeper levels cover small areas and quantize to uint16
+            depth = self.octree.depth
+            breaks = np.flatnonzero(depth[1:] != depth[:-1]) + 1
+            self.data_buffer = VBOProvider(
+                x, y, z, None, starts, counts, generic=True,
+                quantum=self.gpu_quantum(), breaks=breaks,
+                use_vaos=self.has_vaos)
+        else:
+            self.data_buffer = VBOProvider(x, y, z, colors, starts, counts)
+        self.stream_buffers = []
+        self.metrics.record("update_view", time.time() - t)
+        self.update_mask()
+
+    def update_mask(self):
         """
-        x = self.x[self.mask] if self.mask is not None else self.x
-        y = self.y[self.mask] if self.mask is not None else self.y
-        z = self.z[self.mask] if self.mask is not None else self.z
-        colors = self.colors[self.mask] if self.mask is not None else self.colors
-        self.data_buffer = VBOProvider(x, y, z, colors)
+        Apply self.mask as index buffers on top of the vertex buffers,
+        which are left untouched. Only the index buffers of the chunks
+        where the mask changed are rebuilt.
+        """
+        previous, previous_mask = self.mask_buffers, self.view_mask
+        self.mask_buffers = None
+        self.view_mask = None
+        if self.mask is not None and self.data_buffer is not None:
+            with self.metrics.stage("update_mask"):
+                self.view_mask = self.mask[self.order]
+                self.mask_buffers = MaskBuffers(self.data_buffer, self.view_mask,
+                                                previous, previous_mask)
+        self.release(previous)
         self.update()
         self.setFocus()
 
     def paintGL(self):
+        t = time.time()
+        while self._stale_buffers:
+            self._stale_buffers.pop().delete()
+        if self.projection_stale:
+            self.projection_stale = False
+            self.resizeGL(self.width(), self.height())
         gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
         gl.glLoadIdentity()
         glu.gluLookAt(self.location[0], self.location[1], self.location[2],
                       self.focus[0], self.focus[1], self.focus[2],
                       self.up[0], self.up[1], self.up[2])
-        if self.data_buffer is not None:
+        if (self.data_buffer is not None or self.stream_buffers or
+                self.tileset is not None):
+            t_draw = time.time()
             self.draw_points()
+            if self.moving:
+                gl.glFinish()
+                self.adapt_fraction(time.time() - t_draw)
+            elif self.draw_fraction < 1:
+                # fill in: the next frame draws twice as many points
+                self.draw_fraction = min(self.draw_fraction * 2, 1.0)
+                QtCore.QTimer.singleShot(0, self.update)
             diff = self.focus - self.location
             d = np.sqrt(diff.dot(diff))
+            if self.picked is not None:
+                self.draw_picked()
+            if self.corridor is not None:
+                self.draw_corridor()
+            if self.outline:
+                self.draw_outline()
+            if self.overview is not None and self.overview_mode is not None:
+                self.draw_overview()
             self.renderText(10, 10, "Position: %.2f,%.2f,%.2f, dist: %.2f" % (
                 self.real_pos[0], self.real_pos[1], self.real_pos[2], d))
+            self.renderText(10, 25, "Points: %d of %d" % (
+                self.points_drawn, self.n_loaded))
+            if self.show_stats:
+                self.draw_stats()
+        if self.show_stats:
+            gl.glFinish()  # to count the time spent by the GPU too
+        self.frame_stats.frame(time.time() - t, t)
+
+    def gpu_buffers(self):
+        """Everything holding buffer objects on the GPU."""
+        buffers = [self.data_buffer, self.mask_buffers]
+        buffers.extend(self.attributes.values())
+        buffers.extend(self.stream_buffers)
+        if self.tileset is not None:
+            buffers.extend(tile.data.buffer for tile in self.tileset.loaded())
+        return [b for b in buffers if b is not None]
+
+    def draw_stats(self):
+        stats = self.frame_stats
+        buffers = self.gpu_buffers()
+        self.renderText(10, 45, "FPS: %.1f, frame time: %.1f ms, render time: %.1f ms" % (
+            stats.fps, stats.frame_time * 1000, stats.render_time * 1000))
+        self.renderText(10, 60, "Drawn: %.1f%% of the points" % (
+            100.0 * self.points_drawn / max(self.n_loaded, 1)))
+        self.renderText(10, 75, "Buffers: %d, GPU memory: %.1f MB" % (
+            sum(b.n_buffers for b in buffers),
+            sum(b.nbytes for b in buffers) / 1024.0 ** 2))
 
     def resizeGL(self, w, h):
         ratio = w if h == 0 else float(w) / h
@@ -163,34 +996,490 @@ class PointcloudViewerWidget(QGLWidget):
         gl.glLoadIdentity()
         gl.glViewport(0, 0, w, h)
         gl.glLoadIdentity()
-        glu.gluPerspective(90, float(ratio), self.near_z, self.far_z)
+        glu.gluPerspective(self.fov, float(ratio), self.near_z, self.far_z)
         gl.glMatrixMode(gl.GL_MODELVIEW)
 
     def initializeGL(self):
         gl.glClearColor(0.0, 0.0, 0.0, 1.0)
         gl.glClearDepth(1.0)
+        try:
+            self.shader = build_program()
+            self.has_vaos = bool(gl.glGenVertexArrays)
+        except Exception as e:
+            print("No shaders, colormaps will be evaluated on the CPU: %s" % e)
+            self.shader = None
+        else:
+            self._attribute_locations = dict(
+                (name, gl.glGetAttribLocation(self.shader, name))
+                for name in ("value", "rgb"))
 
-    def draw_points(self):
+    def view_parameters(self):
+        """Frustum planes and the projection factor of the current view."""
+        projection = gl.glGetDoublev(gl.GL_PROJECTION_MATRIX)
+        modelview = gl.glGetDoublev(gl.GL_MODELVIEW_MATRIX)
+        planes = frustum_planes(projection, modelview)
+        proj_factor = self.height() / (2 * math.tan(math.radians(self.fov) / 2))
+        # kept for picking
+        self.clip = clip_matrix(projection, modelview)
+        self.proj_factor = proj_factor
+        return planes, proj_factor
+
+    def select_nodes(self):
+        """
+        Select the visible octree nodes with the largest screen space
+        error within the point budget.
+        """
+        planes, proj_factor = self.view_parameters()
+        counts = None
+        if self.mask_buffers is not None:
+            # spend the budget on visible points only
+            counts = self.mask_buffers.node_visible
+        self.drawn_nodes = self.octree.select(planes, self.location, proj_factor,
+                                              self.point_budget, counts=counts)
+        return self.drawn_nodes
+
+    def pick(self, px, py, radius=5):
+        """
+        The point drawn nearest to the camera within radius pixels of
+        the window position px, py as an index in input order - or None.
+        Only the octree nodes drawn in the last frame which the ray
+        through px, py passes near are searched.
+        """
+        tree = self.octree
+        if tree is None or self.clip is None or len(self.drawn_nodes) == 0:
+            return None
+        w, h = float(self.width()), float(self.height())
+        C = self.clip
+        far = np.linalg.solve(C, [2 * px / w - 1, 1 - 2 * py / h, 1.0, 1.0])
+        direction = far[:3] / far[3] - self.location
+        direction /= np.sqrt(direction.dot(direction))
+        nodes = np.asarray(self.drawn_nodes)
+        # grow the boxes by the radius at their distance
+        diff = tree.center[nodes] - self.location
+        dist = np.sqrt((diff * diff).sum(axis=1)) + tree.radius[nodes]
+        pad = (radius / self.proj_factor * dist)[:, None]
+        hit = octree.ray_boxes(self.location, direction, tree.box_min[nodes] - pad,
+                               tree.box_max[nodes] + pad)
+        best_depth, best = np.inf, None
+        for i in nodes[hit]:
+            i0, i1 = tree.starts[i], tree.starts[i] + tree.counts[i]
+            idx = np.arange(i0, i1)
+            if self.view_mask is not None:
+                idx = idx[self.view_mask[i0:i1]]
+            p = C[:, :3].dot(np.vstack((self.x[idx], self.y[idx], self.z[idx])))
+            p += C[:, 3:]
+            depth = p[3]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sx = (p[0] / depth + 1) * 0.5 * w
+                sy = (1 - p[1] / depth) * 0.5 * h
+            near = (depth > self.near_z) & ((sx - px) ** 2 + (sy - py) ** 2 <= radius ** 2)
+            if near.any():
+                j = np.argmin(np.where(near, depth, np.inf))
+                if depth[j] < best_depth:
+                    best_depth, best = depth[j], idx[j]
+        if best is None:
+            return None
+        self.picked = np.array([self.x[best], self.y[best], self.z[best]])
+        return int(self.order[best])
+
+    def draw_picked(self):
+        gl.glPointSize(self.point_size + 6)
+        gl.glColor3f(1.0, 1.0, 0.0)
+        gl.glBegin(gl.GL_POINTS)
+        gl.glVertex3f(*self.picked)
+        gl.glEnd()
+        gl.glPointSize(self.point_size)
+
+    def start_selection(self, mode):
+        """
+        Let the next left drag draw a "lasso", a "rectangle" or
+        a "profile" line.
+        """
+        self.selection_mode = mode
+        self.outline = []
+        self.setCursor(QtCore.Qt.CrossCursor)
+
+    def cancel_selection(self):
+        self.selection_mode = None
+        self.outline = []
+        self.unsetCursor()
+        self.update()
+
+    def finish_selection(self):
+        outline, mode = self.outline, self.selection_mode
+        self.cancel_selection()
+        if len(outline) < 2:
+            return
+        # the view the outline was drawn in
+        self.makeCurrent()
+        self.view_parameters()
+        if mode == "profile":
+            ends = [self.ground_point(*p) for p in (outline[0], outline[-1])]
+            if ends[0] is not None and ends[1] is not None:
+                self.emit(self.profile_signal, ends[0], ends[1])
+            return
+        args = (self.clip, self.width(), self.height(), self.near_z)
+        if mode == "rectangle":
+            polygon = selection.ScreenPolygon.rectangle(outline[0], outline[-1], *args)
+        else:
+            polygon = selection.ScreenPolygon(outline, *args)
+        self.emit(self.selection_signal, polygon)
+
+    def select_screen(self, polygon):
+        """
+        Mask (in input order) of the points inside a selection.ScreenPolygon
+        - e.g. for set_mask(mask, refine=True).
+        """
+        if self.x is None:
+            return None
+        view_mask = selection.select(polygon, self.x, self.y, self.z, self.octree)
+        if self.order is None:
+            return view_mask
+        mask = np.empty_like(view_mask)
+        mask[self.order] = view_mask
+        return mask
+
+    def thin_voxels(self, size, keep="first"):
+        """
+        Mask (in input order) keeping one of the points shown per voxel
+        of the given size, see voxels.thin - "first" is first in input order.
+        """
+        if self.x is None:
+            return None
+        x, y, z, rank = self.x, self.y, self.z, self.order
+        shown = None
+        if self.mask is not None:
+            shown = np.flatnonzero(self.mask if rank is None else self.mask[rank])
+            x, y, z = x[shown], y[shown], z[shown]
+            if rank is not None:
+                rank = rank[shown]
+        with self.metrics.stage("voxel thinning"):
+            view_mask = voxels.thin(x, y, z, size, keep, rank)
+        if shown is not None:
+            kept = np.zeros(self.x.shape[0], dtype=bool)
+            kept[shown] = view_mask
+            view_mask = kept
+        if self.order is None:
+            return view_mask
+        mask = np.empty_like(view_mask)
+        mask[self.order] = view_mask
+        return mask
+
+    def ground_point(self, px, py):
+        """
+        Where the ray through the window position px, py meets the plane
+        z = 0 (the mean height) - or None.
+        """
+        w, h = float(self.width()), float(self.height())
+        far = np.linalg.solve(self.clip, [2 * px / w - 1, 1 - 2 * py / h, 1.0, 1.0])
+        direction = far[:3] / far[3] - self.location
+        if abs(direction[2]) < 1e-12:
+            return None
+        t = -self.location[2] / direction[2]
+        if t <= 0:
+            return None
+        return self.location + t * direction
+
+    def grid_index(self):
+        """The gridindex.GridIndex of the points - built once."""
+        if self.grid is None:
+            with self.metrics.stage("grid index"):
+                self.grid = gridindex.GridIndex(self.x, self.y)
+        return self.grid
+
+    def cut_profile(self, p0, p1, width):
+        """
+        The visible points within width / 2 of the line p0 - p1 (viewer
+        coordinates): distances along and across it, z and colors.
+        This can happen in a background thread.
+        """
+        idx, along, across = self.grid_index().corridor(p0, p1, width)
+        if self.view_mask is not None:
+            keep = self.view_mask[idx]
+            idx, along, across = idx[keep], along[keep], across[keep]
+        return along, across, self.z[idx], self.point_colors(idx)
+
+    def show_corridor(self, p0, p1, width):
+        """Outline the corridor of a profile in the view."""
+        self.corridor = (np.asarray(p0)[:2], np.asarray(p1)[:2], width)
+
+    def point_colors(self, idx):
+        """Colors of the points idx (viewer order) as currently shown."""
+        if self.colors is not None:
+            return self.colors[idx]
+        coloring = self.colorings.get(self.coloring_name)
+        if coloring is None:
+            return np.full((len(idx), 3), 0.7, dtype=np.float32)
+        subset = copy.copy(coloring)
+        if coloring.values is not None:
+            subset.values = coloring.values[idx]
+        return subset.colors(z=self.z[idx])
+
+    def draw_corridor(self):
+        p0, p1, width = self.corridor
+        d = p1 - p0
+        length = np.sqrt(d.dot(d))
+        if length == 0:
+            return
+        v = np.array((-d[1], d[0])) / length * width * 0.5
+        gl.glColor3f(0.0, 1.0, 1.0)
+        gl.glBegin(gl.GL_LINE_LOOP)
+        for x, y in (p0 + v, p1 + v, p1 - v, p0 - v):
+            gl.glVertex3f(x, y, 0.0)
+        gl.glEnd()
+
+    def set_overview(self, overview, class_colors=None):
+        """
+        Show an overview.Overview of the points (viewer coordinates),
+        class_colors being used for its "class" mode.
+        Call this on the GUI thread, as paintGL draws it.
+        """
+        self.overview = overview
+        self.class_colors = class_colors
+        self._overview_image = None
+
+    def set_overview_mode(self, mode):
+        """One of overview.MODES - or None to hide the overview."""
+        self.overview_mode = mode
+        self._overview_image = None
+        self.update()
+
+    def overview_rect(self):
+        """x, y, width and height of the minimap in window pixels."""
+        ov = self.overview
+        scale = 200.0 / max(ov.nx, ov.ny)
+        w, h = ov.nx * scale, ov.ny * scale
+        return self.width() - w - 10, self.height() - h - 10, w, h
+
+    def overview_hit(self, px, py):
+        """The x, y (viewer coordinates) of a click on the minimap - or None."""
+        if self.overview is None or self.overview_mode is None:
+            return None
+        x0, y0, w, h = self.overview_rect()
+        if not (x0 <= px <= x0 + w and y0 <= py <= y0 + h):
+            return None
+        x_min, y_min, width, height = self.overview.extent
+        return (x_min + (px - x0) / w * width,
+                y_min + (1 - (py - y0) / h) * height)
+
+    def jump_to(self, x, y):
+        """Move the camera sideways so that it looks at x, y."""
+        delta = np.array((x - self.focus[0], y - self.focus[1], 0.0))
+        self.location = self.location + delta
+        self.focus = self.focus + delta
+        self.real_pos = self.location + self.center
+        self.camera_changed()
+
+    def draw_overview(self):
+        if self._overview_texture is None:
+            self._overview_texture = gl.glGenTextures(1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self._overview_texture)
+        if self._overview_image is None:
+            self._overview_image = np.ascontiguousarray(
+                self.overview.image(self.overview_mode, self.class_colors))
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, self.overview.nx,
+                            self.overview.ny, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE,
+                            self._overview_image)
+        x0, y0, w, h = self.overview_rect()
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glPushMatrix()
+        gl.glLoadIdentity()
+        gl.glOrtho(0, self.width(), self.height(), 0, -1, 1)
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glPushMatrix()
+        gl.glLoadIdentity()
+        gl.glEnable(gl.GL_TEXTURE_2D)
+        gl.glColor3f(1.0, 1.0, 1.0)
+        gl.glBegin(gl.GL_QUADS)
+        # row 0 of the raster is the lowest y
+        for s, t in ((0, 0), (1, 0), (1, 1), (0, 1)):
+            gl.glTexCoord2f(s, t)
+            gl.glVertex2f(x0 + s * w, y0 + (1 - t) * h)
+        gl.glEnd()
+        gl.glDisable(gl.GL_TEXTURE_2D)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        # where the camera looks
+        x_min, y_min, width, height = self.overview.extent
+        gl.glPointSize(5)
+        gl.glColor3f(1.0, 1.0, 0.0)
+        gl.glBegin(gl.GL_POINTS)
+        gl.glVertex2f(x0 + (self.focus[0] - x_min) / width * w,
+                      y0 + (1 - (self.focus[1] - y_min) / height) * h)
+        gl.glEnd()
+        gl.glPointSize(self.point_size)
+        gl.glPopMatrix()
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glPopMatrix()
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+
+    def draw_outline(self):
+        points = self.outline
+        if self.selection_mode == "rectangle":
+            (x0, y0), (x1, y1) = points[0], points[-1]
+            points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glPushMatrix()
+        gl.glLoadIdentity()
+        gl.glOrtho(0, self.width(), self.height(), 0, -1, 1)
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glPushMatrix()
+        gl.glLoadIdentity()
+        gl.glColor3f(1.0, 1.0, 0.0)
+        gl.glBegin(gl.GL_LINE_LOOP)
+        for x, y in points:
+            gl.glVertex2f(x, y)
+        gl.glEnd()
+        gl.glPopMatrix()
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glPopMatrix()
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+
+    def draw_tiles(self):
+        """
+        Let the tile set load what is in view and draw the loaded tiles,
+        which share the point budget.
+        """
+        planes, proj_factor = self.view_parameters()
+        self.tileset.update(planes, self.location, proj_factor)
+        loaded = [tile.data for tile in self.tileset.loaded()]
+        selected = octree.select_nodes([data.tree for data in loaded], planes,
+                                       self.location, proj_factor,
+                                       self.point_budget)
+        nodes = [[] for data in loaded]
+        for t, i in selected:
+            nodes[t].append(i)
         gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
         gl.glEnableClientState(gl.GL_COLOR_ARRAY)
-        self.data_buffer.draw()
+        self.points_drawn = sum(data.buffer.draw(tile_nodes,
+                                                 fraction=self.draw_fraction)
+                                for data, tile_nodes in zip(loaded, nodes)
+                                if tile_nodes)
         gl.glDisableClientState(gl.GL_COLOR_ARRAY)
         gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
 
+    def draw_points(self):
+        if self.tileset is not None:
+            self.draw_tiles()
+        elif self.data_buffer is not None and self.data_buffer.generic:
+            if self.coloring_name is not None:
+                self.points_drawn = self.draw_coloring(self.select_nodes())
+        else:
+            gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+            gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+            if self.data_buffer is not None:
+                self.points_drawn = self.data_buffer.draw(
+                    self.select_nodes(), mask=self.mask_buffers,
+                    fraction=self.draw_fraction)
+            else:
+                self.points_drawn = sum(b.draw() for b in list(self.stream_buffers))
+            gl.glDisableClientState(gl.GL_COLOR_ARRAY)
+            gl.glDisableClientState(gl.GL_VERTEX_ARRAY)
+
+    def resident_attribute(self, name, coloring):
+        """The values of a coloring on the GPU, uploaded if needed."""
+        buffers = self.attributes.get(name)
+        if buffers is None:
+            values = coloring.values
+            buffers = AttributeBuffers(self.data_buffer, values)
+            self.attributes[name] = buffers
+        return buffers
+
+    def uniform(self, name):
+        if name not in self._uniforms:
+            self._uniforms[name] = gl.glGetUniformLocation(self.shader, name)
+        return self._uniforms[name]
+
+    def bind_lut(self, coloring):
+        if self._lut_texture is None:
+            self._lut_texture = gl.glGenTextures(1)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        gl.glBindTexture(gl.GL_TEXTURE_1D, self._lut_texture)
+        if self._lut_coloring is not coloring:
+            gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+            gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+            gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+            gl.glTexImage1D(gl.GL_TEXTURE_1D, 0, gl.GL_RGB, coloring.lut.shape[0],
+                            0, gl.GL_RGB, gl.GL_FLOAT, coloring.lut)
+            self._lut_coloring = coloring
+        gl.glUniform1i(self.uniform("lut"), 0)
+        gl.glUniform1f(self.uniform("lut_size"), float(coloring.lut.shape[0]))
+        gl.glUniform1i(self.uniform("cycle"), int(coloring.cycle))
+
+    def draw_coloring(self, nodes):
+        """Draw the nodes with the current coloring evaluated in the shader."""
+        name = self.coloring_name
+        coloring = self.colorings[name]
+        gl.glUseProgram(self.shader)
+        gl.glUniform1f(self.uniform("quantum"), self.data_buffer.quantum)
+        gl.glUniform1i(self.uniform("mode"), SHADER_MODES[coloring.kind])
+        gl.glUniform1i(self.uniform("use_z"), int(coloring.use_z))
+        gl.glUniform1f(self.uniform("vmin"), coloring.vmin)
+        gl.glUniform1f(self.uniform("vscale"), coloring.vscale)
+        gl.glUniform3f(self.uniform("color_low"), *coloring.color_low)
+        gl.glUniform3f(self.uniform("color_high"), *coloring.color_high)
+        if coloring.kind == "lut":
+            self.bind_lut(coloring)
+        attributes = []
+        if not coloring.use_z:
+            location = self._attribute_locations[
+                "rgb" if coloring.kind == "rgb" else "value"]
+            attributes.append((location, self.resident_attribute(name, coloring)))
+        drawn = self.data_buffer.draw(nodes, attributes, self.uniform("origin"),
+                                      self.mask_buffers, self.draw_fraction)
+        gl.glUseProgram(0)
+        return drawn
+
+    def mousePressEvent(self, event):
+        if self.selection_mode is not None:
+            if event.button() == QtCore.Qt.LeftButton:
+                self.outline = [(event.x(), event.y())]
+            else:
+                self.cancel_selection()
+            return
+        target = self.overview_hit(event.x(), event.y())
+        if target is not None and event.button() == QtCore.Qt.LeftButton:
+            self.jump_to(*target)
+            return
+        # ctrl + click picks a point
+        if (event.button() == QtCore.Qt.LeftButton and
+                int(event.modifiers()) & QtCore.Qt.ControlModifier and
+                self.has_points()):
+            t = time.time()
+            index = self.pick(event.x(), event.y())
+            self.metrics.record("pick", time.time() - t)
+            self.emit(self.point_picked_signal, index)
+            self.update()
+
     def mouseMoveEvent(self, mouseEvent):
-        if int(mouseEvent.buttons()) != QtCore.Qt.NoButton:
+        if self.selection_mode is not None:
+            if self.outline:
+                point = (mouseEvent.x(), mouseEvent.y())
+                if self.selection_mode in ("rectangle", "profile"):
+                    self.outline = [self.outline[0], point]
+                else:
+                    self.outline.append(point)
+                self.update()
+        elif int(mouseEvent.buttons()) != QtCore.Qt.NoButton:
             # user is dragging
             delta_x = mouseEvent.x() - self.old_mouse_x
             delta_y = self.old_mouse_y - mouseEvent.y()
             if int(mouseEvent.buttons()) & QtCore.Qt.LeftButton:
                 self.camera_yaw_pitch(delta_x * 0.03, delta_y * 0.03)
-                self.update()
+                self.camera_changed()
             elif int(mouseEvent.buttons()) & QtCore.Qt.RightButton:
                 self.camera_roll((delta_x) * 0.05)
-                self.update()
+                self.camera_changed()
         self.old_mouse_x = mouseEvent.x()
         self.old_mouse_y = mouseEvent.y()
 
+    def mouseReleaseEvent(self, event):
+        if (self.selection_mode is not None and self.outline and
+                event.button() == QtCore.Qt.LeftButton):
+            self.finish_selection()
+
     def rotate_vector(self, vec_rot, vec_about, theta):
         d = np.sqrt(vec_about.dot(vec_about))
 
@@ -271,31 +1560,34 @@ class PointcloudViewerWidget(QGLWidget):
         self.up /= np.sqrt(self.up.dot(self.up))
 
     def wheelEvent(self, event):
-        if self.data_buffer is not None:
+        if self.has_points():
             self.camera_move(event.delta() * self.movement_granularity * 0.03)
-            self.update()
+            self.camera_changed()
 
     def mouseDoubleClickEvent(self, event):
-        if self.data_buffer is not None:
+        if self.has_points():
             self.camera_move(self.movement_granularity)
-            self.update()
+            self.camera_changed()
 
     # for this to work - we seemingly need to give focus to this widget from
     # time to time...
     def keyPressEvent(self, event):
-        if self.data_buffer is not None:
+        if self.selection_mode is not None and event.key() == QtCore.Qt.Key_Escape:
+            self.cancel_selection()
+            event.accept()
+        elif self.has_points():
             if event.key() == QtCore.Qt.Key_A:
                 self.camera_move(self.movement_granularity, 2)
-                self.update()
+                self.camera_changed()
             elif event.key() == QtCore.Qt.Key_D:
                 self.camera_move(-self.movement_granularity, 2)
-                self.update()
+                self.camera_changed()
             elif event.key() == QtCore.Qt.Key_W:
                 self.camera_move(self.movement_granularity, 3)
-                self.update()
+                self.camera_changed()
             elif event.key() == QtCore.Qt.Key_S:
                 self.camera_move(-self.movement_granularity, 3)
-                self.update()
+                self.camera_changed()
             event.accept()
         else:
             event.ignore()
@@ -0,0 +1,93 @@
+import numpy as np
+
+"""
+Range queries on point dimensions, for interactive filtering.
+A sorted index is built lazily the first time a dimension is used, after
+which a range is just two binary searches. The mask of the last range
+of each dimension is kept, so that tightening or loosening a range only
+touches the points between the old and the new bounds.
+"""
+
+
+class DimensionIndex(object):
+    """Sorted index of one dimension plus the mask of the last range."""
+
+    def __init__(self, values):
+        n = values.shape[0]
+        self.order = np.argsort(values, kind="mergesort")
+        if n < 2 ** 31:
+            self.order = self.order.astype(np.int32)
+        self.sorted = values[self.order]
+        self.mask = None
+        self.bounds = (0, 0)
+
+    def positions(self, val_min, val_max):
+        """Range of self.order holding the values in [val_min, val_max]."""
+        i0 = int(np.searchsorted(self.sorted, val_min, side="left"))
+        i1 = int(np.searchsorted(self.sorted, val_max, side="right"))
+        return i0, max(i0, i1)
+
+    def range_mask(self, val_min, val_max):
+        """
+        Mask of val_min <= values <= val_max. The returned array is
+        owned by the index and changes on the next call.
+        """
+        j0, j1 = self.positions(val_min, val_max)
+        i0, i1 = self.bounds
+        changed = abs(j0 - i0) + abs(j1 - i1)
+        if self.mask is None or changed > j1 - j0:
+            # cheaper to start over
+            if self.mask is None:
+                self.mask = np.zeros(self.order.shape[0], dtype=bool)
+            else:
+                self.mask[:] = False
+            self.mask[self.order[j0:j1]] = True
+        else:
+            for a, b, value in ((min(i0, j0), max(i0, j0), j0 < i0),
+                                (min(i1, j1), max(i1, j1), j1 > i1)):
+                if a < b:
+                    self.mask[self.order[a:b]] = value
+        self.bounds = (j0, j1)
+        return self.mask
+
+    @property
+    def nbytes(self):
+        n = self.order.nbytes + self.sorted.nbytes
+        return n + (self.mask.nbytes if self.mask is not None else 0)
+
+
+class RangeQuery(object):
+    """
+    Answer conditions like {"x": [xmin, xmax], "intensity": [0, 100]}.
+    get_dimension(name) should return the values of a dimension.
+    """
+
+    def __init__(self, n_points, get_dimension):
+        self.n_points = n_points
+        self.get_dimension = get_dimension
+        self.indexes = {}
+
+    def has_index(self, dim):
+        return dim in self.indexes
+
+    def index(self, dim):
+        if dim not in self.indexes:
+            self.indexes[dim] = DimensionIndex(self.get_dimension(dim))
+        return self.indexes[dim]
+
+    def query(self, conditions):
+        """The mask of points satisfying all conditions - a new array."""
+        M = np.ones((self.n_points,), dtype=bool)
+        for key in conditions:
+            val_min, val_max = conditions[key]
+            M &= self.index(key).range_mask(val_min, val_max)
+        return M
+
+    def count(self, dim, val_min, val_max):
+        """Number of points in the range, without building a mask."""
+        i0, i1 = self.index(dim).positions(val_min, val_max)
+        return i1 - i0
+
+    @property
+    def nbytes(self):
+        return sum(index.nbytes for index in self.indexes.values())
@@ -0,0 +1,140 @@
+import math
+import numpy as np
+import colormaps
+
+"""
+Screen space selection of points - by lasso (polygon) or rectangle.
+The polygon is rasterized at window resolution once, so that testing a
+point is a single lookup. Octree nodes are accepted or rejected as a
+whole from the screen bounding box of their corners, and only the points
+of the nodes straddling the outline are projected - in cache sized
+chunks, in the thread pool of colormaps.
+"""
+
+# Points projected per task
+CHUNK_SIZE = 1 << 16
+
+
+class ScreenPolygon(object):
+    """
+    A polygon in window pixels (origin top left) plus the view it was
+    drawn in: clip is the 4 x 4 clip matrix (see qt_glviewer.clip_matrix).
+    """
+
+    def __init__(self, vertices, clip, width, height, near):
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape((-1, 2))
+        self.clip = np.asarray(clip, dtype=np.float64)
+        self.width = int(width)
+        self.height = int(height)
+        self.near = near
+
+    @classmethod
+    def rectangle(cls, corner1, corner2, *args):
+        (x0, y0), (x1, y1) = corner1, corner2
+        return cls([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], *args)
+
+    def raster(self):
+        """Mask of the pixels whose centres are inside (even-odd rule)."""
+        mask = np.zeros((self.height, self.width), dtype=bool)
+        if self.vertices.shape[0] < 3:
+            return mask
+        x0, y0 = self.vertices[:, 0], self.vertices[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        row0 = max(int(math.floor(y0.min())), 0)
+        row1 = min(int(math.ceil(y0.max())) + 1, self.height)
+        for row in range(row0, row1):
+            yc = row + 0.5
+            crossing = (y0 <= yc) != (y1 <= yc)
+            xa, ya, xb, yb = x0[crossing], y0[crossing], x1[crossing], y1[crossing]
+            xs = np.sort(xa + (yc - ya) * (xb - xa) / (yb - ya))
+            for a, b in zip(xs[0::2], xs[1::2]):
+                i0 = max(int(math.ceil(a - 0.5)), 0)
+                i1 = min(int(math.floor(b - 0.5)) + 1, self.width)
+                mask[row, i0:i1] = True
+        return mask
+
+    def project(self, x, y, z):
+        """Pixel column, row and depth of points."""
+        C = self.clip
+        p = C[:, :3].dot(np.vstack((x, y, z)).astype(np.float64)) + C[:, 3:]
+        w = p[3]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            col = np.floor((p[0] / w + 1) * 0.5 * self.width)
+            row = np.floor((1 - p[1] / w) * 0.5 * self.height)
+        return col, row, w
+
+
+def _pixel_count(table, c0, r0, c1, r1):
+    """Pixels set in the rows r0:r1 and columns c0:c1 (summed area table)."""
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+def classify_nodes(polygon, tree, raster):
+    """
+    Per octree node: 0 if none of its points can be inside, 2 if all
+    of them are, else 1.
+    """
+    table = np.zeros((polygon.height + 1, polygon.width + 1), dtype=np.int64)
+    table[1:, 1:] = raster.cumsum(axis=0).cumsum(axis=1)
+    k = tree.depth.shape[0]
+    col_min = np.full(k, np.inf)
+    col_max = np.full(k, -np.inf)
+    row_min, row_max = col_min.copy(), col_max.copy()
+    in_front = np.ones(k, dtype=bool)
+    for corner in range(8):
+        pick = [(corner >> axis) & 1 for axis in range(3)]
+        xyz = [np.where(pick[axis], tree.box_max[:, axis], tree.box_min[:, axis])
+               for axis in range(3)]
+        col, row, w = polygon.project(*xyz)
+        in_front &= w > polygon.near
+        np.fmin(col_min, col, out=col_min)
+        np.fmax(col_max, col, out=col_max)
+        np.fmin(row_min, row, out=row_min)
+        np.fmax(row_max, row, out=row_max)
+    classes = np.ones(k, dtype=np.int8)
+    front = np.flatnonzero(in_front)
+    # pixel rectangles clipped to the window
+    c0 = np.clip(col_min[front], 0, polygon.width).astype(np.int64)
+    c1 = np.clip(col_max[front] + 1, 0, polygon.width).astype(np.int64)
+    r0 = np.clip(row_min[front], 0, polygon.height).astype(np.int64)
+    r1 = np.clip(row_max[front] + 1, 0, polygon.height).astype(np.int64)
+    empty = (c1 <= c0) | (r1 <= r0)
+    c1, r1 = np.maximum(c1, c0), np.maximum(r1, r0)
+    count = _pixel_count(table, c0, r0, c1, r1)
+    area = (c1 - c0) * (r1 - r0)
+    inside_window = ((col_min[front] >= 0) & (col_max[front] < polygon.width) &
+                     (row_min[front] >= 0) & (row_max[front] < polygon.height))
+    classes[front[empty | (count == 0)]] = 0
+    classes[front[~empty & inside_window & (count == area)]] = 2
+    return classes
+
+
+def select(polygon, x, y, z, tree=None, chunk_size=CHUNK_SIZE):
+    """
+    Mask of the points x, y, z in front of the camera which project
+    inside the polygon. With an octree (of the points in the given order)
+    whole nodes are decided from their boxes where possible.
+    """
+    n = x.shape[0]
+    raster = polygon.raster()
+    out = np.zeros(n, dtype=bool)
+    if tree is None:
+        ranges = [(0, n)]
+    else:
+        classes = classify_nodes(polygon, tree, raster)
+        for i in np.flatnonzero(classes == 2):
+            out[tree.starts[i]:tree.starts[i] + tree.counts[i]] = True
+        partial = np.flatnonzero(classes == 1)
+        ranges = zip(tree.starts[partial], tree.starts[partial] + tree.counts[partial])
+    work = [(i0, min(i0 + chunk_size, i1)) for i0, i1 in ranges
+            for i0 in range(i0, i1, chunk_size)]
+
+    def test(a, b):
+        for i0, i1 in work[a:b]:
+            col, row, w = polygon.project(x[i0:i1], y[i0:i1], z[i0:i1])
+            ok = ((w > polygon.near) & (col >= 0) & (col < polygon.width) &
+                  (row >= 0) & (row < polygon.height))
+            idx = np.flatnonzero(ok)
+            out[i0 + idx] = raster[row[idx].astype(np.int64), col[idx].astype(np.int64)]
+    colormaps.chunked(len(work), test, chunk_size=16)
+    return out
@@ -0,0 +1,135 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import octree
+import colormaps
+import stats
+
+"""
+On-disk cache of preprocessed pointclouds.
+Stores what the viewer needs - the centred float32 coordinates in
+octree order, the centre offset, the octree and the colormap values per
+display dimension - as .npy files, which can be memory mapped straight into
+the viewer on the next open. Also the statistics (histograms) of the
+dimensions.
+"""
+
+CACHE_VERSION = 2
+
+
+def default_cache_dir():
+    path = os.environ.get("LASVIEWER_CACHE")
+    if path is None:
+        path = os.path.join(os.path.expanduser("~"), ".cache", "lasviewer")
+    return path
+
+
+class SidecarCache(object):
+    """
+    The cache entry for one file, keyed by path, size and
+    modification time - so a changed file is never read from the cache.
+    """
+
+    def __init__(self, fname, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        fname = os.path.abspath(fname)
+        st = os.stat(fname)
+        self.key = {"path": fname, "size": st.st_size,
+                    "mtime": st.st_mtime, "version": CACHE_VERSION}
+        digest = hashlib.sha1(fname.encode("utf-8")).hexdigest()
+        self.path = os.path.join(cache_dir, digest)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+    def _load(self, name):
+        return np.load(self._file(name), mmap_mode="r")
+
+    def exists(self):
+        try:
+            with open(os.path.join(self.path, "meta.json")) as f:
+                return json.load(f) == self.key
+        except (IOError, OSError, ValueError):
+            return False
+
+    def save_points(self, center, x, y, z, tree):
+        """
+        Store points and spatial index, replacing any stale entry.
+        Written to a temporary directory first, so that a half
+        written entry is never picked up.
+        """
+        tmp = self.path + ".tmp"
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        arrays = {"center": np.asarray(center, dtype=np.float64),
+                  "x": x, "y": y, "z": z}
+        for name, arr in tree.to_arrays().items():
+            arrays["octree_" + name] = arr
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), arr)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(self.key, f)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp, self.path)
+
+    def load_points(self):
+        """Returns center, x, y, z and the octree - arrays are memmaps."""
+        arrays = dict((name, self._load("octree_" + name))
+                      for name in octree.Octree.ARRAYS + ("params",))
+        tree = octree.Octree.from_arrays(arrays)
+        center = np.array(self._load("center"))
+        return center, self._load("x"), self._load("y"), self._load("z"), tree
+
+    def has_coloring(self, dim):
+        return self.exists() and os.path.exists(
+            os.path.join(self.path, "coloring_%s.json" % dim))
+
+    def save_coloring(self, dim, coloring):
+        """A colormaps.ScalarColoring with values in viewer (octree) order."""
+        prefix = "coloring_" + dim
+        for name, arr in (("values", coloring.values), ("lut", coloring.lut)):
+            if arr is not None:
+                np.save(self._file("%s_%s" % (prefix, name)), arr)
+        # the json file marks the entry as complete, so write it last
+        tmp = os.path.join(self.path, prefix + ".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(coloring.params(), f)
+        os.rename(tmp, os.path.join(self.path, prefix + ".json"))
+
+    def load_coloring(self, dim):
+        prefix = "coloring_" + dim
+        with open(os.path.join(self.path, prefix + ".json")) as f:
+            params = json.load(f)
+        arrays = {}
+        for name in ("values", "lut"):
+            if os.path.exists(self._file("%s_%s" % (prefix, name))):
+                arrays[name] = self._load("%s_%s" % (prefix, name))
+        return colormaps.ScalarColoring(params.pop("kind"), arrays.get("values"),
+                                        arrays.get("lut"), **params)
+
+    def has_stats(self):
+        return self.exists() and os.path.exists(os.path.join(self.path, "stats.json"))
+
+    def save_stats(self, histograms):
+        """{dimension: stats.Histogram}"""
+        for i, hist in enumerate(histograms.values()):
+            for name, arr in hist.to_arrays().items():
+                np.save(self._file("stats_%d_%s" % (i, name)), arr)
+        # the json file marks the entry as complete, so write it last
+        tmp = os.path.join(self.path, "stats.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(list(histograms), f)
+        os.rename(tmp, os.path.join(self.path, "stats.json"))
+
+    def load_stats(self):
+        with open(os.path.join(self.path, "stats.json")) as f:
+            names = json.load(f)
+        return dict((dim, stats.Histogram.from_arrays(dict(
+            (name, np.load(self._file("stats_%d_%s" % (i, name))))
+            for name in ("counts", "edges", "params"))))
+            for i, dim in enumerate(names))
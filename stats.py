@@ -0,0 +1,259 @@
+import threading
+import numpy as np
+import colormaps
+import lasio
+
+"""
+Statistics of all dimensions of LAS point records in a single pass:
+count, min, max, mean and a histogram per dimension - counts per value
+for 8 and 16 bit dimensions (so also the class and return counts), else
+fixed bins. Records are added chunk by chunk, from any thread, e.g.
+while streaming. The histograms give percentiles and value ranges
+without another pass, let alone a sort - see colormaps.
+"""
+
+HIST_BINS = colormaps.HIST_BINS
+
+
+class Histogram(object):
+    """
+    counts of the values in the bins between edges, and the min, max
+    and sum of the values. If exact, there is one bin per integer value
+    and edges are the values (plus one past the last).
+    """
+
+    def __init__(self, counts, edges, lo, hi, total, exact):
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.lo = lo
+        self.hi = hi
+        self.total = float(total)
+        self.exact = exact
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    @property
+    def mean(self):
+        return self.total / max(self.count, 1)
+
+    def percentiles(self, qs):
+        """Percentiles (0-100) as colormaps.percentiles would give them."""
+        result = colormaps.histogram_percentiles(self.counts, self.edges,
+                                                 self.exact, qs)
+        return [float(min(max(v, self.lo), self.hi)) for v in result]
+
+    def value_counts(self):
+        """Like colormaps.value_counts - counts of the values 0 - hi, or None."""
+        if not self.exact or self.lo < 0 or self.hi >= (1 << 16):
+            return None
+        counts = np.zeros(int(self.hi) + 1, dtype=np.int64)
+        counts[int(self.lo):] = self.counts
+        return counts
+
+    def values(self):
+        """The values present and their counts - if exact."""
+        present = np.flatnonzero(self.counts)
+        return self.edges[present].astype(np.int64), self.counts[present]
+
+    def scaled(self, scale, offset=0.0):
+        """The histogram of values * scale + offset (scale > 0)."""
+        return Histogram(self.counts, self.edges * scale + offset,
+                         self.lo * scale + offset, self.hi * scale + offset,
+                         self.total * scale + self.count * offset,
+                         self.exact and scale == 1 and offset == int(offset))
+
+    def mapped(self, func):
+        """The exact histogram of func(values), func mapping ints to ints."""
+        values, counts = self.values()
+        mapped = func(values)
+        lo, hi = int(mapped.min()), int(mapped.max())
+        new = np.bincount(mapped - lo, weights=counts, minlength=hi - lo + 1)
+        return Histogram(np.rint(new), np.arange(lo, hi + 2), lo, hi,
+                         (mapped * counts).sum(), True)
+
+    def to_arrays(self):
+        return {"counts": self.counts, "edges": self.edges,
+                "params": np.array([self.lo, self.hi, self.total, self.exact],
+                                   dtype=np.float64)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        lo, hi, total, exact = arrays["params"]
+        return cls(arrays["counts"], arrays["edges"], lo, hi, total, bool(exact))
+
+
+def combined(histograms):
+    """One exact histogram of the values of several exact ones."""
+    lo = int(min(h.lo for h in histograms))
+    hi = int(max(h.hi for h in histograms))
+    counts = np.zeros(hi - lo + 1, dtype=np.int64)
+    for h in histograms:
+        i = int(h.lo) - lo
+        counts[i:i + h.counts.shape[0]] += h.counts
+    return Histogram(counts, np.arange(lo, hi + 2), lo, hi,
+                     sum(h.total for h in histograms), True)
+
+
+class _Accumulator(object):
+    """
+    Count, min, max, sum and histogram of one field. Integers of at most
+    16 bits are counted per value, others in bins over a range which
+    grows (at least doubling) as values outside it come in - the counts
+    so far move to the bin holding their bin centre, so the histogram is
+    accurate to about a bin in the end.
+    """
+
+    def __init__(self, dtype, lo=None, hi=None, bins=HIST_BINS):
+        self.exact = dtype.kind in "ui" and dtype.itemsize <= 2
+        if self.exact:
+            self.base = int(np.iinfo(dtype).min)
+            bins = 1 << (8 * dtype.itemsize)
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.range = None if lo is None else (float(lo), max(float(hi - lo), 1.0))
+        self.lo = self.hi = None
+        self.total = 0.0
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def _bin(self, values, start, width):
+        i = np.floor((values.astype(np.float64) - start) * (self.bins / width))
+        np.clip(i, 0, self.bins - 1, out=i)
+        return np.bincount(i.astype(np.int64), minlength=self.bins)
+
+    def _rebin(self, counts, old, new):
+        """Counts of the bins of range old moved to the bins of range new."""
+        centers = old[0] + (np.arange(self.bins) + 0.5) * (old[1] / self.bins)
+        i = np.floor((centers - new[0]) * (self.bins / new[1]))
+        np.clip(i, 0, self.bins - 1, out=i)
+        return np.rint(np.bincount(i.astype(np.int64), weights=counts,
+                                   minlength=self.bins)).astype(np.int64)
+
+    def add(self, values):
+        if values.shape[0] == 0:
+            return
+        lo, hi = values.min(), values.max()
+        total = float(values.sum(dtype=np.float64))
+        if self.exact:
+            counts = np.bincount(values.astype(np.int64) - self.base,
+                                 minlength=self.bins)
+        else:
+            with self.lock:
+                if self.range is None:
+                    self.range = (float(lo), max(float(hi - lo), 1.0))
+                start, width = self.range
+                if lo < start or hi > start + width:
+                    end = max(start + width, float(hi))
+                    start = min(start, float(lo))
+                    new = (start, max(end - start, 2 * width))
+                    self.counts = self._rebin(self.counts, self.range, new)
+                    self.range = new
+                    self.version += 1
+                version, current = self.version, self.range
+            counts = self._bin(values, *current)
+        with self.lock:
+            if not self.exact and version != self.version:
+                # the range grew while binning
+                counts = self._rebin(counts, current, self.range)
+            self.counts += counts
+            self.lo = lo if self.lo is None else min(self.lo, lo)
+            self.hi = hi if self.hi is None else max(self.hi, hi)
+            self.total += total
+
+    def histogram(self):
+        if self.lo is None:
+            return None
+        lo, hi = self.lo.item(), self.hi.item()
+        if self.exact:
+            i0, i1 = int(lo) - self.base, int(hi) - self.base + 1
+            return Histogram(self.counts[i0:i1], np.arange(lo, hi + 2), lo, hi,
+                             self.total, True)
+        start, width = self.range
+        return Histogram(self.counts, np.linspace(start, start + width, self.bins + 1),
+                         lo, hi, self.total, False)
+
+
+class PointStats(object):
+    """
+    Statistics of the point records of a LAS file. add() chunks of
+    records, then histograms() gives them per dimension, named like
+    lasio.get_dimension - x, y, z scaled and the flags unpacked.
+    """
+
+    def __init__(self, header, bins=HIST_BINS):
+        self.header = header
+        self.fields = {}
+        for name in header.dtype.names:
+            dtype = header.dtype.fields[name][0]
+            if dtype.kind not in "uif":
+                continue  # extra bytes
+            lo = hi = None
+            if name in ("X", "Y", "Z"):
+                # the range of the header - in integer steps of the scale
+                i = "XYZ".index(name)
+                lo = np.floor((header.min[i] - header.offset[i]) / header.scale[i])
+                hi = np.ceil((header.max[i] - header.offset[i]) / header.scale[i])
+            self.fields[name] = _Accumulator(dtype, lo, hi, bins)
+
+    def add(self, records):
+        """
+        Add a chunk of records - the fields in parallel, in the threads
+        of colormaps.chunked, so do not call this from one of them.
+        """
+        names = list(self.fields)
+        colormaps.chunked(len(names), lambda i0, i1: [
+            self.fields[name].add(records[name]) for name in names[i0:i1]], 1)
+
+    def histograms(self):
+        """{dimension: Histogram} - of the fields with any records."""
+        header = self.header
+        fields = dict((name, acc.histogram()) for name, acc in self.fields.items())
+        result = {}
+        for name, hist in fields.items():
+            if hist is None:
+                continue
+            if name in ("X", "Y", "Z"):
+                i = "XYZ".index(name)
+                result[name.lower()] = hist.scaled(header.scale[i], header.offset[i])
+            elif name == "flag_byte":
+                legacy = header.point_format < 6
+                shift, bits = (3, 7) if legacy else (4, 15)
+                result["return_num"] = hist.mapped(lambda v: v & bits)
+                result["num_returns"] = hist.mapped(lambda v: (v >> shift) & bits)
+            else:
+                result[name] = hist
+        if "raw_classification" in result:
+            mask = 31 if header.point_format < 6 else 255
+            result["classification"] = result["raw_classification"].mapped(
+                lambda v: v & mask)
+        if all(color in result for color in ("red", "green", "blue")):
+            result["rgb"] = combined([result[color] for color in
+                                      ("red", "green", "blue")])
+        return result
+
+
+def dimension_histogram(chunks, bins=HIST_BINS):
+    """
+    The histogram of one dimension given as chunks of values, e.g. tile
+    by tile - of all three colors for n x 3 rgb chunks. None if empty.
+    """
+    acc = None
+    for values in chunks:
+        values = values.ravel()
+        if acc is None:
+            acc = _Accumulator(values.dtype, bins=bins)
+        acc.add(values)
+    return None if acc is None else acc.histogram()
+
+
+def read_stats(fname, header=None, chunk_size=colormaps.CHUNK_SIZE):
+    """Histograms of an uncompressed LAS file, in one chunked pass."""
+    if header is None:
+        header = lasio.LasHeader(fname)
+    points = lasio.map_points(fname, header)
+    stats = PointStats(header)
+    for i0 in range(0, points.shape[0], chunk_size):
+        stats.add(points[i0:i0 + chunk_size])
+    return stats.histograms()
@@ -0,0 +1,115 @@
+from PyQt4 import QtGui, QtCore
+from PyQt4.QtCore import *
+from PyQt4.QtGui import *
+import numpy as np
+
+"""
+A panel showing the statistics of the dimensions of a pointcloud:
+count, range, mean, percentiles and the histogram - or the counts per
+value, for dimensions with few values, like classes and returns.
+Takes the {dimension: stats.Histogram} of stats.PointStats.
+"""
+
+MARGIN = 30
+# Dimensions with at most this many values have their counts listed
+MAX_LISTED = 40
+# Histogram bins drawn (merged from the bins of the histogram)
+DRAWN_BINS = 256
+
+
+class StatsView(QDialog):
+    """
+    A dimension picked in the combo box, its numbers as text and its
+    histogram as bars - or the counts per value listed over them.
+    """
+
+    def __init__(self, parent):
+        QDialog.__init__(self, parent)
+        self.setWindowTitle("Statistics")
+        self.setMinimumSize(600, 500)
+        self.histograms = {}
+        self.combo = QComboBox(self)
+        self.combo.move(10, 5)
+        QtCore.QObject.connect(self.combo, QtCore.SIGNAL("currentIndexChanged(int)"),
+                               lambda i: self.update())
+        self._pixels = None
+
+    def set_histograms(self, histograms, title=""):
+        self.histograms = histograms
+        current = unicode(self.combo.currentText())
+        self.combo.blockSignals(True)
+        self.combo.clear()
+        names = sorted(histograms)
+        self.combo.addItems(names)
+        if current in names:
+            self.combo.setCurrentIndex(names.index(current))
+        self.combo.blockSignals(False)
+        self.combo.adjustSize()
+        self.setWindowTitle("Statistics - %s" % title if title else "Statistics")
+        self.update()
+
+    def current(self):
+        return self.histograms.get(unicode(self.combo.currentText()))
+
+    def lines(self, hist):
+        p5, p50, p95 = hist.percentiles((5, 50, 95))
+        lines = ["points: %d" % hist.count,
+                 "min: %.6g  max: %.6g  mean: %.6g" % (hist.lo, hist.hi, hist.mean),
+                 "percentiles 5 / 50 / 95: %.6g / %.6g / %.6g" % (p5, p50, p95)]
+        if hist.exact:
+            values, counts = hist.values()
+            if values.shape[0] <= MAX_LISTED:
+                lines.extend("%6d: %d" % vc for vc in zip(values, counts))
+        return lines
+
+    def render(self, hist, top):
+        """The histogram as bars in an image the size of the widget, below top."""
+        w, h = self.width(), self.height()
+        pixels = np.zeros((h, w), dtype=np.uint32)
+        pixels[:] = 0xff000000
+        counts = hist.counts
+        # merge neighbouring bins into at most DRAWN_BINS bars
+        bins = min(counts.shape[0], DRAWN_BINS)
+        edges = np.linspace(0, counts.shape[0], bins + 1).astype(np.int64)
+        bars = np.add.reduceat(counts, edges[:-1]).astype(np.float64)
+        x0, x1 = MARGIN, w - MARGIN
+        y0, y1 = top, h - MARGIN
+        if bars.max() <= 0 or x1 <= x0 or y1 <= y0:
+            return pixels
+        heights = (bars / bars.max() * (y1 - y0)).astype(np.int64)
+        cols = np.arange(x0, x1)
+        bar = (cols - x0) * bins // (x1 - x0)
+        rows = np.arange(y0, y1)[:, None]
+        filled = rows >= y1 - heights[bar][None, :]
+        pixels[y0:y1, x0:x1][filled] = 0xff4080c0
+        return pixels
+
+    def paintEvent(self, event):
+        hist = self.current()
+        painter = QPainter(self)
+        if hist is None:
+            painter.fillRect(self.rect(), QColor(0, 0, 0))
+            painter.end()
+            return
+        lines = self.lines(hist)
+        # the bars go below the numbers, any counts per value over them
+        top = 45 + 16 * 3
+        pixels = self.render(hist, top)
+        # keep the pixels alive while the image is drawn
+        self._pixels = pixels
+        image = QImage(pixels.data, pixels.shape[1], pixels.shape[0],
+                       pixels.shape[1] * 4, QImage.Format_RGB32)
+        painter.drawImage(0, 0, image)
+        painter.setPen(QColor(255, 255, 255))
+        for i, line in enumerate(lines):
+            if i >= 3:
+                # the counts per value over the bars, in columns
+                j = i - 3
+                x = MARGIN + 10 + (j // 20) * 150
+                painter.drawText(x, top + 20 + 16 * (j % 20), line)
+            else:
+                painter.drawText(10, 45 + 16 * i, line)
+        painter.drawText(MARGIN, self.height() - 10, "%.6g" % hist.edges[0])
+        last = "%.6g" % hist.edges[-1 if not hist.exact else -2]
+        painter.drawText(self.width() - MARGIN - 8 * len(last), self.height() - 10, last)
+        painter.end()
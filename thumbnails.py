@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import zlib
+import struct
+import argparse
+import multiprocessing
+import numpy as np
+import lasio
+import tiles
+import camera
+from lascolors import dimension_to_coloring
+
+"""
+Headless batch rendering of thumbnails of LAS files, e.g.
+
+    python thumbnails.py --dimension raw_classification --view oblique \\
+        --size 512 --out thumbs archive/
+
+Each file is rendered by a worker process, so throughput scales with
+the cores. No window, display or GPU is needed: with PyOpenGL and OSMesa
+(software Mesa) the points are drawn with the fixed function pipeline,
+like the viewer does without shaders - else they are splatted into a
+z-buffer with numpy. Camera presets (see camera.py) and colormaps
+(lascolors.py) are those of the viewer.
+"""
+
+# Points drawn per thumbnail - larger files are subsampled
+MAX_POINTS = 2000000
+BACKENDS = ("auto", "osmesa", "numpy")
+
+# Set in each worker process
+_backend = None
+
+
+def write_png(path, rgb):
+    """Write an h x w x 3 uint8 image as an (uncompressed filter) RGB png."""
+    h, w = rgb.shape[:2]
+    rows = np.zeros((h, w * 3 + 1), dtype=np.uint8)  # filter byte 0 per row
+    rows[:, 1:] = rgb.reshape((h, w * 3))
+
+    def chunk(tag, data):
+        return (struct.pack(">I", len(data)) + tag + data +
+                struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def read_points(path, dimension, max_points=MAX_POINTS):
+    """x, y, z and the values of dimension of (a regular subsample of) a file."""
+    header = lasio.LasHeader(path)
+    step = max(1, -(-header.point_count // max_points))
+    if header.compressed:
+        import laspy.file
+        f = laspy.file.File(path)
+        get = lambda name: np.asarray(getattr(f, name))[::step]
+    else:
+        records = np.array(lasio.map_points(path, header)[::step])
+        get = lambda name: lasio.get_dimension(records, header, name)
+    x, y, z = get("x"), get("y"), get("z")
+    if dimension == "z":
+        values = z
+    elif dimension == "rgb":
+        values = np.column_stack([get(color) for color in ("red", "green", "blue")])
+    else:
+        values = get(dimension)
+    return x, y, z, values
+
+
+def render_numpy(xyz, colors, view, width, height, point_size=1):
+    """Splat the points into a z-buffer - nearest point per pixel wins."""
+    location, focus, up, near, far = view
+    C = camera.perspective(camera.FOV, float(width) / height, near, far).dot(
+        camera.look_at(location, focus, up))
+    p = C[:, :3].dot(xyz.T.astype(np.float64)) + C[:, 3:]
+    w = p[3]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ndc = p[:3] / w
+        ok = (w > 0) & (np.abs(ndc) <= 1).all(axis=0)
+    col = np.minimum(((ndc[0, ok] + 1) * 0.5 * width).astype(np.int64), width - 1)
+    row = np.minimum(((1 - ndc[1, ok]) * 0.5 * height).astype(np.int64), height - 1)
+    depth = ndc[2, ok]
+    rgb = (np.clip(colors[ok], 0, 1) * 255).astype(np.uint8)
+    image = np.zeros((height * width, 3), dtype=np.uint8)
+    r = point_size // 2
+    offsets = [(dx, dy) for dy in range(-r, point_size - r)
+               for dx in range(-r, point_size - r)]
+
+    def splat(dx, dy):
+        c, rr = col + dx, row + dy
+        inside = (c >= 0) & (c < width) & (rr >= 0) & (rr < height)
+        return (rr * width + c)[inside], inside
+    # the depth of the nearest point per pixel over all of the splats first ...
+    zbuf = np.full(height * width, np.inf)
+    for dx, dy in offsets:
+        pix, inside = splat(dx, dy)
+        np.minimum.at(zbuf, pix, depth[inside])
+    # ... then each pixel gets the color of that point
+    for dx, dy in offsets:
+        pix, inside = splat(dx, dy)
+        win = depth[inside] == zbuf[pix]
+        image[pix[win]] = rgb[inside][win]
+    return image.reshape((height, width, 3))
+
+
+def render_osmesa(xyz, colors, view, width, height, point_size=1):
+    """Draw the points with OSMesa, like the viewer without shaders."""
+    from OpenGL import GL as gl, GLU as glu, osmesa, arrays
+    location, focus, up, near, far = view
+    ctx = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+    if not ctx:
+        raise RuntimeError("Could not create an OSMesa context")
+    buf = arrays.GLubyteArray.zeros((height, width, 4))
+    try:
+        if not osmesa.OSMesaMakeCurrent(ctx, buf, gl.GL_UNSIGNED_BYTE, width, height):
+            raise RuntimeError("Could not make the OSMesa context current")
+        gl.glViewport(0, 0, width, height)
+        gl.glClearColor(0.0, 0.0, 0.0, 1.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+        gl.glEnable(gl.GL_DEPTH_TEST)
+        gl.glMatrixMode(gl.GL_PROJECTION)
+        gl.glLoadIdentity()
+        glu.gluPerspective(camera.FOV, float(width) / height, near, far)
+        gl.glMatrixMode(gl.GL_MODELVIEW)
+        gl.glLoadIdentity()
+        glu.gluLookAt(*(tuple(location) + tuple(focus) + tuple(up)))
+        gl.glPointSize(point_size)
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_COLOR_ARRAY)
+        gl.glVertexPointer(3, gl.GL_FLOAT, 0, np.ascontiguousarray(xyz, dtype=np.float32))
+        gl.glColorPointer(3, gl.GL_FLOAT, 0, np.ascontiguousarray(colors, dtype=np.float32))
+        gl.glDrawArrays(gl.GL_POINTS, 0, xyz.shape[0])
+        gl.glFinish()
+        pixels = gl.glReadPixels(0, 0, width, height, gl.GL_RGB, gl.GL_UNSIGNED_BYTE)
+    finally:
+        osmesa.OSMesaDestroyContext(ctx)
+    # rows of glReadPixels go bottom up
+    return np.frombuffer(pixels, dtype=np.uint8).reshape((height, width, 3))[::-1]
+
+
+def render(x, y, z, colors, preset, size, point_size=1):
+    """Thumbnail of the points (real coordinates) seen from a camera preset."""
+    center = np.array([x.mean(), y.mean(), z.mean()])
+    xyz = np.column_stack((x - center[0], y - center[1], z - center[2])).astype(np.float32)
+    # the radius as set_extent of the viewer gets it
+    r = max(float(xyz[:, 0].max()), float(xyz[:, 1].max()), 1e-3)
+    location, focus, up = camera.preset(preset, r)
+    view = (location, focus, up, r * 1e-3, r * 10)
+    if _backend in ("auto", "osmesa"):
+        try:
+            return render_osmesa(xyz, colors, view, size, size, point_size)
+        except Exception:
+            if _backend == "osmesa":
+                raise
+    return render_numpy(xyz, colors, view, size, size, point_size)
+
+
+def _init_worker(backend):
+    global _backend
+    _backend = backend
+    if backend in ("auto", "osmesa"):
+        # must be set before OpenGL is imported
+        os.environ.setdefault("PYOPENGL_PLATFORM", "osmesa")
+
+
+def render_file(task):
+    """Render one file - in a worker process. Returns (path, seconds, error)."""
+    path, out_path, dimension, preset, size, point_size, max_points = task
+    t = time.time()
+    try:
+        x, y, z, values = read_points(path, dimension, max_points)
+        coloring = dimension_to_coloring(dimension, values, use_z=(dimension == "z"))
+        colors = coloring.colors(z=z)
+        write_png(out_path, render(x, y, z, colors, preset, size, point_size))
+    except Exception as e:
+        return path, time.time() - t, "%s: %s" % (type(e).__name__, e)
+    return path, time.time() - t, None
+
+
+def input_paths(inputs):
+    """LAS files given directly, as directories or as lists of files."""
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path) or path.lower().endswith((".txt", ".lst")):
+            paths.extend(tiles.tile_paths(path))
+        else:
+            paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render thumbnails of LAS files")
+    parser.add_argument("inputs", nargs="+",
+                        help="LAS files, directories of them or lists of them")
+    parser.add_argument("--out", default="thumbnails", help="output directory")
+    parser.add_argument("--dimension", default="raw_classification",
+                        help="dimension to color by (default raw_classification)")
+    parser.add_argument("--view", default="top", choices=camera.PRESETS)
+    parser.add_argument("--size", type=int, default=512, help="pixels (square)")
+    parser.add_argument("--point-size", type=int, default=1)
+    parser.add_argument("--max-points", type=int, default=MAX_POINTS)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--backend", default="auto", choices=BACKENDS)
+    args = parser.parse_args()
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    tasks = []
+    for path in input_paths(args.inputs):
+        name = os.path.splitext(os.path.basename(path))[0] + ".png"
+        tasks.append((path, os.path.join(args.out, name), args.dimension,
+                      args.view, args.size, args.point_size, args.max_points))
+    t = time.time()
+    failed = 0
+    pool = multiprocessing.Pool(args.processes, _init_worker, (args.backend,))
+    try:
+        for path, seconds, error in pool.imap_unordered(render_file, tasks):
+            if error is None:
+                print("%-60s %6.2fs" % (path, seconds))
+            else:
+                failed += 1
+                print("%-60s FAILED %s" % (path, error))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - t
+    print("%d thumbnails in %.1fs (%.2f per second), %d failed" % (
+        len(tasks) - failed, elapsed, (len(tasks) - failed) / max(elapsed, 1e-9), failed))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
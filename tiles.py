@@ -0,0 +1,203 @@
+import os
+import threading
+import numpy as np
+import lasio
+import octree
+
+"""
+Datasets made of many LAS tiles.
+Only the headers are read up front, giving a bounding box index of the
+tiles. Point data of the tiles in view are then loaded in a background
+thread - nearest first - and the ones out of view are unloaded when the
+memory limit is reached.
+"""
+
+# Rough memory use per loaded point: float32 xyz and colors, octree order
+BYTES_PER_POINT = 28
+# The sample of a set for its color ranges: records of at most this
+# many tiles, spread over the set, at most this many per tile
+SAMPLE_TILES = 16
+SAMPLE_POINTS = 1 << 16
+
+
+def tile_paths(path):
+    """
+    The LAS files of a dataset given as a directory, or as a text
+    file listing one tile per line.
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if name.lower().endswith(".las"))
+    base = os.path.dirname(path)
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines
+            if line and not line.startswith("#")]
+
+
+class Tile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.header = lasio.LasHeader(path)
+        self.nbytes = self.header.point_count * BYTES_PER_POINT
+        self.data = None  # as returned by the load function
+        self.loading = False
+        self.failed = False  # not loaded again, see TileSet.unload_all
+
+
+class TileSet(object):
+    """
+    load_tile(tile) should read the points of the tile and return an
+    object with a delete method, which is called via release(data) when
+    the tile is unloaded. on_loaded() is called (in the loader thread)
+    whenever a tile has been loaded, on_error(message) when one could
+    not be - it is then skipped, not tried again and again.
+    All coordinates given to and kept by this object are relative to
+    self.origin, the centre of the dataset.
+    """
+
+    def __init__(self, paths, load_tile, release, on_loaded=None,
+                 memory_limit=4 * 1024 ** 3, on_error=None):
+        self.tiles = [Tile(path) for path in paths]
+        if len(self.tiles) == 0:
+            raise ValueError("No tiles")
+        lo = np.array([tile.header.min for tile in self.tiles])
+        hi = np.array([tile.header.max for tile in self.tiles])
+        self.min = lo.min(axis=0)
+        self.max = hi.max(axis=0)
+        self.origin = (self.min + self.max) * 0.5
+        self.box_min = lo - self.origin
+        self.box_max = hi - self.origin
+        self.point_count = sum(tile.header.point_count for tile in self.tiles)
+        self._start(load_tile, release, on_loaded, memory_limit, on_error)
+
+    def _start(self, load_tile, release, on_loaded, memory_limit, on_error):
+        self.load_tile = load_tile
+        self.release = release
+        self.on_loaded = on_loaded
+        self.on_error = on_error
+        self.memory_limit = memory_limit
+        self.queue = []
+        self.cond = threading.Condition()
+        self.closed = False
+        self.error = None
+        # {dimension: stats.Histogram} over the whole set, for coloring
+        self.histograms = {}
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, planes, eye, proj_factor=None):
+        """
+        Queue the visible tiles (nearest first) which fit within the
+        memory limit and unload others, if needed, to make room.
+        proj_factor (see octree.select_nodes) is for the level of detail
+        of subclasses - all tiles are at full detail.
+        """
+        visible = np.flatnonzero(octree.boxes_visible(
+            planes, self.box_min, self.box_max))
+        center = (self.box_min[visible] + self.box_max[visible]) * 0.5
+        dist = np.sqrt(((center - eye) ** 2).sum(axis=1))
+        wanted = []
+        used = 0
+        for i in visible[np.argsort(dist)]:
+            if used + self.tiles[i].nbytes > self.memory_limit and wanted:
+                break
+            wanted.append(i)
+            used += self.tiles[i].nbytes
+        self._schedule(wanted, eye)
+
+    def _schedule(self, wanted, eye):
+        """
+        Queue the tiles wanted (in order) which are not loaded - nor
+        failed to - and unload the farthest tiles not wanted if the
+        memory limit is exceeded.
+        """
+        with self.cond:
+            self.queue = [i for i in wanted if self.tiles[i].data is None and
+                          not self.tiles[i].loading and not self.tiles[i].failed]
+            wanted = set(wanted)
+            resident = self.resident_bytes + sum(self.tiles[i].nbytes
+                                                 for i in self.queue)
+            if resident > self.memory_limit:
+                center = (self.box_min + self.box_max) * 0.5
+                dist = np.sqrt(((center - eye) ** 2).sum(axis=1))
+                for i in np.argsort(dist)[::-1]:
+                    tile = self.tiles[i]
+                    if resident <= self.memory_limit:
+                        break
+                    if tile.data is not None and i not in wanted:
+                        self.release(tile.data)
+                        tile.data = None
+                        resident -= tile.nbytes
+            if self.queue:
+                self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                tile = self.tiles[self.queue.pop(0)]
+                tile.loading = True
+            try:
+                data = self.load_tile(tile)
+            except Exception as e:
+                with self.cond:
+                    tile.loading = False
+                    tile.failed = True
+                self._report("%s: %s" % (tile.path, e))
+                continue
+            with self.cond:
+                tile.loading = False
+                if self.closed:
+                    if data is not None:
+                        self.release(data)
+                    return
+                tile.data = data
+            if self.on_loaded is not None:
+                self.on_loaded()
+
+    def _report(self, message):
+        """An error of the loader thread."""
+        self.error = message
+        if self.on_error is not None and not self.closed:
+            self.on_error(message)
+
+    def sample(self):
+        """
+        (records, header) of a sample of the set - every so many records
+        of a few tiles spread over it - to color the tiles alike without
+        reading them all.
+        """
+        step = max(len(self.tiles) // SAMPLE_TILES, 1)
+        for tile in self.tiles[::step][:SAMPLE_TILES]:
+            records = lasio.map_points(tile.path, tile.header)
+            stride = max(records.shape[0] // SAMPLE_POINTS, 1)
+            yield np.array(records[::stride]), tile.header
+
+    def loaded(self):
+        return [tile for tile in self.tiles if tile.data is not None]
+
+    @property
+    def resident_bytes(self):
+        return sum(tile.nbytes for tile in self.tiles if tile.data is not None)
+
+    def unload_all(self):
+        """E.g. to reload the tiles with other colors - failed ones too."""
+        with self.cond:
+            self.queue = []
+            for tile in self.tiles:
+                tile.failed = False
+                if tile.data is not None:
+                    self.release(tile.data)
+                    tile.data = None
+
+    def close(self):
+        self.unload_all()
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
@@ -0,0 +1,148 @@
+import numpy as np
+import colormaps
+
+"""
+Voxel grid thinning: keep one point per cube of a given size. Duplicate
+points are removed by unique, on integer coordinates (like the X, Y, Z
+records of LAS), as rounding float coordinates to their resolution may
+merge neighbours or split duplicates. The voxel of each point is an integer key; points are bucketed
+by slabs of voxels (a cheap radix sort of small ints) and the slabs are
+sorted by key in the thread pool of colormaps.
+Not LAS specific.
+"""
+
+# Which point of a voxel to keep
+KEEP = ("first", "centroid", "highest")
+# Aim for this many points per slab, i.e. per task
+SLAB_POINTS = 1 << 20
+
+
+def voxel_keys(x, y, z, size, n_slabs=1):
+    """
+    Key of the voxel of each point - the voxel indices packed in mixed
+    radix over the extent, so distinct voxels never share a key - and
+    the slab (range of voxel columns along x) of each point, of at
+    most n_slabs.
+    """
+    n = x.shape[0]
+    lo = [float(colormaps.value_range(v)[0]) for v in (x, y, z)]
+    hi = [float(colormaps.value_range(v)[1]) for v in (x, y, z)]
+    # voxels centred on the grid of lo, so that points on a grid of that
+    # step (like LAS coordinates) are not split by rounding
+    nx, ny, nz = [int((h - l) / size + 0.5) + 1 for l, h in zip(lo, hi)]
+    if float(nx) * ny * nz >= 2 ** 63:
+        raise ValueError("Too many voxels of size %g - use a larger size" % size)
+    n_slabs = int(min(max(n_slabs, 1), nx, 1 << 16))
+    keys = np.empty(n, dtype=np.int64)
+    slabs = np.empty(n, dtype=np.uint16)
+
+    def work(i0, i1):
+        index = []
+        for v, l, m in zip((x, y, z), lo, (nx, ny, nz)):
+            # in float64, also for float32 input
+            i = np.floor((v[i0:i1].astype(np.float64) - l) / size + 0.5).astype(np.int64)
+            np.clip(i, 0, m - 1, out=i)
+            index.append(i)
+        ix, iy, iz = index
+        keys[i0:i1] = (ix * ny + iy) * nz + iz
+        slabs[i0:i1] = ix * n_slabs // nx
+    colormaps.chunked(n, work)
+    return keys, slabs
+
+
+def unique(x, y, z, mask=None):
+    """
+    Mask keeping the first (in position) of the points of mask (all if
+    None) with the same integer x, y and z.
+    """
+    n = x.shape[0]
+    kept = np.zeros(n, dtype=bool)
+    shown = np.arange(n) if mask is None else np.flatnonzero(mask)
+    if shown.shape[0] == 0:
+        return kept
+    x, y, z = x[shown], y[shown], z[shown]
+    spans = [float(hi) - float(lo) + 1
+             for lo, hi in (colormaps.value_range(v) for v in (x, y, z))]
+    if spans[0] * spans[1] * spans[2] < 2 ** 63:
+        # voxels of size 1 are the integer positions - exact in float64
+        kept[shown] = thin(x, y, z, 1)
+        return kept
+    # too large an extent for packed keys: a (stable) sort of the rows
+    order = np.lexsort((z, y, x))
+    x, y, z = x[order], y[order], z[order]
+    first = np.ones(order.shape[0], dtype=bool)
+    first[1:] = (x[1:] != x[:-1]) | (y[1:] != y[:-1]) | (z[1:] != z[:-1])
+    kept[shown[order[first]]] = True
+    return kept
+
+
+def _first_minimum(score, starts):
+    """Position of the first minimum of score within each run."""
+    counts = np.diff(np.append(starts, score.shape[0]))
+    best = np.minimum.reduceat(score, starts)
+    candidates = np.flatnonzero(score == np.repeat(best, counts))
+    run = np.searchsorted(starts, candidates, side="right") - 1
+    return candidates[np.append(True, run[1:] != run[:-1])]
+
+
+def thin(x, y, z, size, keep="first", rank=None, slab_points=SLAB_POINTS):
+    """
+    Mask keeping one point per voxel (cube of the given size): the
+    first one (of lowest rank if given, else position), the one closest
+    to the centroid of the points of the voxel or the highest one.
+    """
+    if keep not in KEEP:
+        raise ValueError("keep must be one of %s" % ", ".join(KEEP))
+    if not size > 0:
+        raise ValueError("The voxel size must be positive")
+    n = x.shape[0]
+    mask = np.zeros(n, dtype=bool)
+    if n == 0:
+        return mask
+    keys, slabs = voxel_keys(x, y, z, size, n // slab_points)
+    counts = np.bincount(slabs)
+    starts = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=starts[1:])
+    # radix sort, as slabs are 16 bit
+    order = np.argsort(slabs, kind="stable")
+    del slabs
+
+    def work(s0, s1):
+        for s in range(s0, s1):
+            idx = order[starts[s]:starts[s + 1]]
+            m = idx.shape[0]
+            if m == 0:
+                continue
+            k = keys[idx]
+            k0 = int(k.min())
+            bits = max(int(m - 1).bit_length(), 1)
+            if (int(k.max()) - k0).bit_length() + bits <= 63:
+                # sorting key and position packed together is much
+                # faster than an argsort - and stable
+                packed = ((k - k0) << bits) | np.arange(m, dtype=np.int64)
+                packed.sort()
+                o = packed & ((1 << bits) - 1)
+                k = packed >> bits
+            else:
+                o = np.argsort(k, kind="stable")
+                k = k[o]
+            idx = idx[o]
+            runs = np.flatnonzero(np.append(True, k[1:] != k[:-1]))
+            if keep == "first":
+                if rank is None:
+                    # idx is ascending within each run
+                    mask[idx[runs]] = True
+                    continue
+                score = rank[idx]
+            elif keep == "highest":
+                score = -z[idx]
+            else:
+                sizes = np.diff(np.append(runs, m))
+                score = np.zeros(m)
+                for v in (x, y, z):
+                    v = v[idx].astype(np.float64)
+                    mean = np.add.reduceat(v, runs) / sizes
+                    score += (v - np.repeat(mean, sizes)) ** 2
+            mask[idx[_first_minimum(score, runs)]] = True
+    colormaps.chunked(counts.shape[0], work, 1)
+    return mask